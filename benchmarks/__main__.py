@@ -0,0 +1,59 @@
+""" Runs the benchmark suite
+
+    python -m SICP.benchmarks                     # compare with baseline.json
+    python -m SICP.benchmarks -o results.json     # also write the results
+    python -m SICP.benchmarks --update-baseline   # make them the baseline
+    python -m SICP.benchmarks -k vseval           # only the matching cases
+
+Exits with status 1 when a case is slower than the baseline by more
+than the threshold.
+"""
+import argparse
+import os
+import sys
+
+from SICP.benchmarks.cases import CASES
+from SICP.benchmarks.runner import run_cases, save, load, compare
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m SICP.benchmarks')
+    parser.add_argument('-k', dest='pattern', default='',
+                        help='run only the cases whose name contains this')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='write the results as JSON')
+    parser.add_argument('-b', '--baseline', default=BASELINE)
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='allowed slowdown, as a fraction of the baseline time')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    cases = {name: setup for name, setup in CASES.items() if args.pattern in name}
+    print('%-20s %10s %11s %12s' % ('case', 'time', 'peak', 'rate'))
+    results = run_cases(cases, args.repeat, log=print)
+
+    if args.output:
+        save(results, args.output)
+    if args.update_baseline:
+        save(results, args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('no baseline at %s' % args.baseline)
+        return 0
+
+    print()
+    print('%-20s %10s %10s %7s' % ('case', 'baseline', 'now', 'ratio'))
+    regressions = 0
+    for name, before, now, ratio, regressed in compare(
+            results, load(args.baseline), args.threshold):
+        print('%-20s %9.4fs %9.4fs %6.2fx%s' % (
+            name, before, now, ratio, '  REGRESSION' if regressed else ''))
+        regressions += regressed
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+""" The workloads of the benchmark suite
+
+Each case is a function of no arguments doing the setup, and returning
+a Workload: run() does the timed work, count() tells how many steps one
+run takes, in unit.
+"""
+from collections import namedtuple
+
+from SICP.lisp_parser.lp import parse, parse_all
+from SICP.lisp_parser.bench import generate_source
+from SICP.vanilla_scheme.vseval import vseval, Env, GLOBAL_ENV
+from SICP.vanilla_scheme.profiler import Profiler
+from SICP.register_machine_simulator.rms import Machine
+from SICP.register_machine_simulator.bench import GCD_CONTROLLER, \
+    FIB_CONTROLLER
+from SICP.ch2 import pict
+
+
+Workload = namedtuple('Workload', 'run, count, unit')
+
+CASES = {}
+
+
+def case(name):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+@case('parse')
+def parse_throughput():
+    source, nforms = generate_source(1 << 20)
+
+    def run():
+        assert len(parse_all(source)) == nforms
+    return Workload(run, lambda: len(source), 'bytes')
+
+
+SCHEME_PROGRAMS = {
+    'fib': ("""
+    (define (fib n)
+      (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+    """, "(fib 18)"),
+
+    'tak': ("""
+    (define (tak x y z)
+      (if (not (< y x))
+          z
+          (tak (tak (- x 1) y z)
+               (tak (- y 1) z x)
+               (tak (- z 1) x y))))
+    """, "(tak 18 12 6)"),
+
+    'ackermann': ("""
+    (define (ack m n)
+      (cond ((= m 0) (+ n 1))
+            ((= n 0) (ack (- m 1) 1))
+            (else (ack (- m 1) (ack m (- n 1))))))
+    """, "(ack 3 4)"),
+
+    'sort': ("""
+    (define (random-list n seed)
+      (if (= n 0)
+          '()
+          (cons seed (random-list (- n 1) (rem (+ (* seed 1103) 12345) 65536)))))
+    (define (merge xs ys)
+      (cond ((null? xs) ys)
+            ((null? ys) xs)
+            ((< (car xs) (car ys)) (cons (car xs) (merge (cdr xs) ys)))
+            (else (cons (car ys) (merge xs (cdr ys))))))
+    (define (split xs left right)
+      (if (null? xs)
+          (cons left right)
+          (split (cdr xs) right (cons (car xs) left))))
+    (define (sort xs)
+      (if (or (null? xs) (null? (cdr xs)))
+          xs
+          (let ((halves (split xs '() '())))
+            (merge (sort (car halves)) (sort (cdr halves))))))
+    (define numbers (random-list 300 42))
+    """, "(sort numbers)"),
+
+    'closures': ("""
+    (define (make-counter)
+      (let ((n 0))
+        (lambda () (set! n (+ n 1)) n)))
+    (define (compose f g) (lambda (x) (f (g x))))
+    (define (repeat f n)
+      (if (= n 1) f (compose f (repeat f (- n 1)))))
+    (define (run-closures n acc)
+      (if (= n 0)
+          acc
+          (let ((counter (make-counter)))
+            (counter)
+            (run-closures (- n 1) (+ acc ((repeat (lambda (x) (+ x 1)) 10) (counter)))))))
+    """, "(run-closures 2000 0)"),
+}
+
+
+def scheme_case(name):
+    defs, call = SCHEME_PROGRAMS[name]
+    env = Env()
+    env.upper = GLOBAL_ENV
+    for exp in parse_all(defs):
+        vseval(exp, env)
+    exp = parse(call)
+
+    def count():
+        profiler = Profiler()
+        with profiler:
+            profiler.vseval(exp, env)
+        return sum(stats.calls for stats in profiler.stats.values())
+    return Workload(lambda: vseval(exp, env), count, 'applications')
+
+
+for _name in SCHEME_PROGRAMS:
+    case('vseval ' + _name)(lambda name=_name: scheme_case(name))
+
+
+def executed_instructions(machine, run):
+    "Number of instructions executed by run()"
+    machine.monitor()
+    try:
+        run()
+    finally:
+        machine.unmonitor()
+    return machine.instruction_count
+
+
+def machine_case(machine, registers, rounds):
+    def run():
+        for _ in range(rounds):
+            for name, value in registers.items():
+                machine.get_register(name).value = value
+            machine.pc.value = 0
+            machine.start()
+    return Workload(run, lambda: executed_instructions(machine, run),
+                    'instructions')
+
+
+@case('rms gcd')
+def rms_gcd():
+    machine = Machine(['a', 'b', 't'],
+                      [('rem', lambda x, y: x % y), ('=', lambda x, y: x == y)],
+                      parse(GCD_CONTROLLER))
+    # consecutive Fibonacci numbers take the most steps
+    return machine_case(machine, {'a': 2880067194370816120,
+                                  'b': 1779979416004714189}, 500)
+
+
+@case('rms fib')
+def rms_fib():
+    machine = Machine(['n', 'val', 'continue'],
+                      [('<', lambda a, b: a < b), ('-', lambda a, b: a - b),
+                       ('+', lambda a, b: a + b)],
+                      parse(FIB_CONTROLLER))
+    return machine_case(machine, {'n': 20}, 1)
+
+
+WAVE = [pict.Line(pict.Vect(x1, y1), pict.Vect(x2, y2)) for x1, y1, x2, y2 in [
+    (0.006, 0.840, 0.155, 0.591), (0.006, 0.635, 0.155, 0.392),
+    (0.304, 0.646, 0.155, 0.591), (0.298, 0.591, 0.155, 0.392),
+    (0.304, 0.646, 0.403, 0.646), (0.298, 0.591, 0.354, 0.492),
+    (0.403, 0.646, 0.348, 0.845), (0.354, 0.492, 0.249, 0.000),
+    (0.403, 0.000, 0.502, 0.293), (0.502, 0.293, 0.602, 0.000),
+    (0.348, 0.845, 0.403, 0.999), (0.602, 0.999, 0.652, 0.845),
+    (0.652, 0.845, 0.602, 0.646), (0.602, 0.646, 0.751, 0.646),
+    (0.751, 0.646, 0.999, 0.343), (0.751, 0.000, 0.597, 0.442),
+    (0.597, 0.442, 0.999, 0.144)]]
+
+
+@case('pict square_limit')
+def pict_square_limit():
+    painter = pict.square_limit(pict.shapes2painter(WAVE), 5)
+    frame = pict.Frame(pict.Vect(0, 600), pict.Vect(600, 0), pict.Vect(0, -600))
+
+    def run():
+        pict.draw(painter)
+    return Workload(run, lambda: len(painter(frame)), 'lines')
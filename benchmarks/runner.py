@@ -0,0 +1,80 @@
+""" Measuring the cases, and comparing results with a baseline
+"""
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+
+def measure(workload, repeat=3):
+    """Best wall time of run() out of repeat, tracemalloc peak of one
+    more run, and the number of steps of a run
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        workload.run()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        workload.run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    steps = workload.count()
+    return {'time': best, 'peak_memory': peak, 'steps': steps,
+            'unit': workload.unit, 'rate': steps / best}
+
+
+def run_cases(cases, repeat=3, log=None):
+    "Results of measure() by case name"
+    results = {}
+    for name, setup in cases.items():
+        results[name] = result = measure(setup(), repeat)
+        if log:
+            log(format_result(name, result))
+    return results
+
+
+def format_result(name, result):
+    return '%-20s %9.4fs %9.1fKB %12.0f %s/s' % (
+        name, result['time'], result['peak_memory'] / 1024,
+        result['rate'], result['unit'])
+
+
+def to_json(results):
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(to_json(results), f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, threshold=0.1):
+    """(name, baseline time, time, ratio, regressed) for the cases in both,
+    a case regressed when it is slower than the baseline by more than
+    threshold, a fraction of the baseline time
+    """
+    rows = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['time']
+        ratio = result['time'] / before
+        rows.append((name, before, result['time'], ratio, ratio > 1 + threshold))
+    return rows
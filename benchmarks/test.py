@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+
+from SICP.benchmarks.cases import CASES, Workload, rms_gcd
+from SICP.benchmarks.runner import measure, compare, save, load
+
+
+class RunnerTest(unittest.TestCase):
+    def test_measure(self):
+        result = measure(Workload(lambda: [0] * 1000, lambda: 1000, 'items'), 2)
+        self.assertEqual(result['steps'], 1000)
+        self.assertEqual(result['unit'], 'items')
+        self.assertGreater(result['peak_memory'], 8000)
+        self.assertAlmostEqual(result['rate'], 1000 / result['time'])
+
+    def test_compare(self):
+        baseline = {'a': {'time': 1.0}, 'b': {'time': 1.0}}
+        results = {'a': {'time': 1.05}, 'b': {'time': 1.5}, 'c': {'time': 9}}
+        rows = compare(results, baseline, threshold=0.1)
+        self.assertEqual([(name, regressed) for name, *_, regressed in rows],
+                         [('a', False), ('b', True)])
+
+    def test_save_load(self):
+        results = {'a': {'time': 1.0, 'steps': 3}}
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'results.json')
+            save(results, path)
+            self.assertEqual(load(path), results)
+
+    def test_cases(self):
+        self.assertIn('vseval fib', CASES)
+        workload = rms_gcd()
+        self.assertEqual(workload.unit, 'instructions')
+        # 88 iterations of 6 instructions and the final test and branch
+        self.assertEqual(workload.count(), 500 * (88 * 6 + 2))
+
+
+unittest.main()
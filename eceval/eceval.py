@@ -60,10 +60,53 @@ eval_operations = [
     ("read", lambda: parse(input())),
 
     ('self-evaluating?', is_self_evaluating),
-    ('quoted?', lambda exp: exp[0] == 'quote'),
+    ('quoted?', is_quoted),
     ('text-of-quotation', text_of_quotation),
+    ('variable?', is_variable),
+    ('assignment?', is_assignment),
+    ('assignment-variable', assignment_variable),
+    ('assignment-value', assignment_value),
+    ('definition?', is_definition),
+    ('definition-variable', definition_variable),
+    ('definition-value', definition_value),
+    ('lambda?', is_lambda),
+    ('lambda-parameters', lambda_parameters),
+    ('lambda-body', lambda_body),
+    ('if?', is_if),
+    ('if-predicate', if_predicate),
+    ('if-consequent', if_consequent),
+    ('if-alternative', if_alternative),
+    ('begin?', is_begin),
+    ('begin-actions', begin_actions),
+    ('last-exp?', is_last_exp),
+    ('first-exp', first_exp),
+    ('rest-exps', rest_exps),
+    ('application?', is_application),
+    ('operator', operator),
+    ('operands', operands),
+    ('no-operands?', no_operands),
+    ('first-operand', first_operand),
+    ('rest-operands', rest_operands),
 
-
+    ('true?', is_true),
+    ('make-procedure', make_procedure),
+    ('compound-procedure?', is_compound_procedure),
+    ('procedure-parameters', procedure_parameters),
+    ('procedure-body', procedure_body),
+    ('procedure-environment', procedure_environment),
+    ('extend-environment', extend_environment),
+    ('lookup-variable-value', lookup_variable_value),
+    ('set-variable-value!', set_variable_value),
+    ('define-variable!', define_variable),
+    ('primitive-procedure?', is_primitive_procedure),
+    ('apply-primitive-procedure', apply_primitive_procedure),
+    ('prompt-for-input', prompt_for_input),
+    ('announce-output', announce_output),
+    ('user-print', user_print),
+    ('empty-arglist', empty_arglist),
+    ('adjoin-arg', adjoin_arg),
+    ('last-operand?', is_last_operand),
+    ('get-global-environment', get_global_environment),
 ]
 
 
@@ -262,10 +305,27 @@ ev-definition-1
   (goto (reg continue)))
 """
 
-if __name__ == "__main__":
-    eval_machine = Machine(
-        ['exp', 'env', 'val', 'proc', 'argl', 'continue', 'unev'],
-        eval_operations,
-        parse(eval_code))
+REGISTERS = ['exp', 'env', 'val', 'proc', 'argl', 'continue', 'unev']
+
+
+def make_machine(optimize=False, machine_class=Machine):
+    return machine_class(REGISTERS, eval_operations, parse(eval_code), optimize)
 
+
+def eval_exp(machine, exp, env):
+    """Value of exp, evaluated by the controller from eval-dispatch,
+    continuing at the end of the controller to stop
+    """
+    machine.get_register('exp').value = exp
+    machine.get_register('env').value = env
+    machine.get_register('continue').value = len(machine.insts)
+    machine.pc.value = machine.labels['eval-dispatch']
+    machine.start()
+    return machine.get_register('val').value
+
+
+if __name__ == "__main__":
+    eval_machine = make_machine()
+    # print-stack-statistics reports the pushes counted while monitoring
+    eval_machine.stack.monitor()
     eval_machine.start()
@@ -1 +1,132 @@
+""" Procedures and environments of the explicit-control evaluator
+"""
+from collections import namedtuple
+from operator import sub, mul, eq, lt, gt
 
+from SICP.lisp_parser.lp import Symbol
+from SICP.eceval.syntax import TRUE, FALSE
+
+
+class UnboundVariable(NameError):
+    pass
+
+
+Procedure = namedtuple('Procedure', 'parameters, body, env')
+Primitive = namedtuple('Primitive', 'fn')
+
+
+def is_true(x):
+    return x is not FALSE
+
+
+def make_procedure(parameters, body, env):
+    return Procedure(parameters, body, env)
+
+
+def is_compound_procedure(proc):
+    return isinstance(proc, Procedure)
+
+
+def procedure_parameters(proc):
+    return proc.parameters
+
+
+def procedure_body(proc):
+    return proc.body
+
+
+def procedure_environment(proc):
+    return proc.env
+
+
+def is_primitive_procedure(proc):
+    return isinstance(proc, Primitive)
+
+
+def apply_primitive_procedure(proc, args):
+    return proc.fn(*args)
+
+
+def empty_arglist():
+    return []
+
+
+def adjoin_arg(arg, arglist):
+    return arglist + [arg]
+
+
+# an environment is a (frame, enclosing environment) pair,
+# the empty environment is None
+def extend_environment(variables, values, base_env):
+    if len(variables) != len(values):
+        raise ValueError('Arity mismatch: %s given %s' % (variables, values))
+    return dict(zip(variables, values)), base_env
+
+
+def find_frame(var, env):
+    while env is not None:
+        frame, env = env
+        if var in frame:
+            return frame
+    raise UnboundVariable('Unbound variable: %s' % (var,))
+
+
+def lookup_variable_value(var, env):
+    return find_frame(var, env)[var]
+
+
+def set_variable_value(var, value, env):
+    find_frame(var, env)[var] = value
+
+
+def define_variable(var, value, env):
+    env[0][var] = value
+
+
+def predicate(fn):
+    return lambda *args: TRUE if fn(*args) else FALSE
+
+
+PRIMITIVES = {
+    'car': lambda pair: pair[0],
+    'cdr': lambda pair: pair[1:],
+    'cons': lambda x, rest: [x, *rest],
+    'null?': predicate(lambda x: isinstance(x, (list, tuple)) and not x),
+    'list': lambda *items: list(items),
+    'not': predicate(lambda x: x is FALSE),
+    '+': lambda *args: sum(args),
+    '-': sub,
+    '*': mul,
+    '=': predicate(eq),
+    '<': predicate(lt),
+    '>': predicate(gt),
+}
+
+
+def setup_environment():
+    return extend_environment(list(PRIMITIVES),
+                              [Primitive(fn) for fn in PRIMITIVES.values()],
+                              None)
+
+
+the_global_environment = setup_environment()
+
+
+def get_global_environment():
+    return the_global_environment
+
+
+def prompt_for_input(string):
+    print('\n\n%s' % (string,))
+
+
+def announce_output(string):
+    print('\n%s' % (string,))
+
+
+def user_print(obj):
+    if is_compound_procedure(obj):
+        print([Symbol('compound-procedure'), obj.parameters, obj.body,
+               Symbol('<procedure-env>')])
+    else:
+        print(obj)
@@ -1,11 +1,144 @@
+from SICP.lisp_parser.lp import Symbol
+
+TRUE = Symbol('true')
+FALSE = Symbol('false')
+QUOTE = Symbol('quote')
+SET = Symbol('set!')
+DEFINE = Symbol('define')
+IF = Symbol('if')
+LAMBDA = Symbol('lambda')
+BEGIN = Symbol('begin')
+
+
 def is_self_evaluating(exp):
     """number, string, booleans
     """
-    return \
-        isinstance(exp, int) or isinstance(exp, float) \
-        or (isinstance(exp, str) and len(exp) >= 2 and exp[0] == '"' and exp[-1] == '"') \
-        or exp == 'true' or exp == 'false'
+    if type(exp) is Symbol:
+        return exp is TRUE or exp is FALSE
+    return not isinstance(exp, (list, tuple))
+
+
+def is_variable(exp):
+    return type(exp) is Symbol
+
+
+def is_tagged_list(exp, tag):
+    return isinstance(exp, (list, tuple)) and len(exp) > 0 and exp[0] is tag
+
+
+def is_quoted(exp):
+    return is_tagged_list(exp, QUOTE)
 
 
 def text_of_quotation(exp):
-    pass
+    return exp[1]
+
+
+def is_assignment(exp):
+    return is_tagged_list(exp, SET)
+
+
+def assignment_variable(exp):
+    return exp[1]
+
+
+def assignment_value(exp):
+    return exp[2]
+
+
+def is_definition(exp):
+    return is_tagged_list(exp, DEFINE)
+
+
+def definition_variable(exp):
+    if is_variable(exp[1]):
+        return exp[1]
+    return exp[1][0]
+
+
+def definition_value(exp):
+    if is_variable(exp[1]):
+        return exp[2]
+    return make_lambda(exp[1][1:], exp[2:])
+
+
+def is_lambda(exp):
+    return is_tagged_list(exp, LAMBDA)
+
+
+def lambda_parameters(exp):
+    return exp[1]
+
+
+def lambda_body(exp):
+    return exp[2:]
+
+
+def make_lambda(parameters, body):
+    return [LAMBDA, parameters, *body]
+
+
+def is_if(exp):
+    return is_tagged_list(exp, IF)
+
+
+def if_predicate(exp):
+    return exp[1]
+
+
+def if_consequent(exp):
+    return exp[2]
+
+
+def if_alternative(exp):
+    if len(exp) > 3:
+        return exp[3]
+    return FALSE
+
+
+def is_begin(exp):
+    return is_tagged_list(exp, BEGIN)
+
+
+def begin_actions(exp):
+    return exp[1:]
+
+
+def is_last_exp(seq):
+    return len(seq) == 1
+
+
+def first_exp(seq):
+    return seq[0]
+
+
+def rest_exps(seq):
+    return seq[1:]
+
+
+def is_application(exp):
+    return isinstance(exp, (list, tuple)) and len(exp) > 0
+
+
+def operator(exp):
+    return exp[0]
+
+
+def operands(exp):
+    return exp[1:]
+
+
+def no_operands(ops):
+    return len(ops) == 0
+
+
+def first_operand(ops):
+    return ops[0]
+
+
+def rest_operands(ops):
+    return ops[1:]
+
+
+def is_last_operand(ops):
+    return len(ops) == 1
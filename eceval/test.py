@@ -0,0 +1,63 @@
+import unittest
+from SICP.lisp_parser.lp import parse_all, parse_tree
+from SICP.eceval.eceval import make_machine, eval_exp
+from SICP.register_machine_simulator.rms import Machine
+from SICP.register_machine_simulator.codegen import CompiledMachine
+from SICP.register_machine_simulator.regfile import RegisterFileMachine
+from SICP.eceval.support import setup_environment
+from SICP.eceval.syntax import TRUE, FALSE
+
+
+PROGRAM = """
+(define (fib n)
+  (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+(define (count-leaves tree)
+  (if (null? tree)
+      0
+      (+ 1 (count-leaves (cdr tree)))))
+(define counter 0)
+(define (bump!) (set! counter (+ counter 1)) counter)
+(bump!)
+(begin (bump!) (list (fib 10) (count-leaves '(a b c)) counter))
+"""
+
+
+class ECEvalTest(unittest.TestCase):
+    def run_program(self, optimize, machine_class=Machine, forms=None):
+        m = make_machine(optimize, machine_class)
+        env = setup_environment()
+        for exp in parse_all(PROGRAM) if forms is None else forms:
+            value = eval_exp(m, exp, env)
+        return value
+
+    def test_eval(self):
+        self.assertEqual(self.run_program(False), [55, 3, 2])
+
+    def test_optimized(self):
+        self.assertEqual(self.run_program(True), [55, 3, 2])
+
+    def test_compiled(self):
+        self.assertEqual(self.run_program(False, CompiledMachine), [55, 3, 2])
+        self.assertEqual(self.run_program(True, CompiledMachine), [55, 3, 2])
+
+    def test_register_file(self):
+        self.assertEqual(self.run_program(False, RegisterFileMachine), [55, 3, 2])
+
+    def test_tuple_forms(self):
+        m = make_machine()
+        env = setup_environment()
+        exp = parse_tree("(list (null? (cdr '(a))) (null? 0))").forms[0]
+        self.assertEqual(eval_exp(m, exp, env), [TRUE, FALSE])
+        forms = parse_tree(PROGRAM).forms
+        self.assertEqual(self.run_program(False, forms=forms), [55, 3, 2])
+        self.assertEqual(self.run_program(True, forms=forms), [55, 3, 2])
+
+    def test_lambda(self):
+        m = make_machine()
+        env = setup_environment()
+        value = eval_exp(m, parse_all("((lambda (x y) (* x y)) 6 7)")[0], env)
+        self.assertEqual(value, 42)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,209 @@
+""" Benchmarks for the lisp parser
+
+    python -m SICP.lisp_parser.bench
+"""
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+
+from SICP.lisp_parser.lp import parse, parse_all, tokenize, Reader, \
+    read_stream, ParseCache, parse_tree
+
+
+DEFINITION = """
+(define (fib-%d n)
+  "Computes nth fibonacci number"
+  (if (< n 2)
+      n
+      (+ (fib-%d (- n 1)) (fib-%d (- n 2.5)))))
+(define his-name-%d ''(kenjin che . %d))
+"""
+
+
+def generate_source(size):
+    "Scheme source of at least size bytes, and the number of forms in it"
+    chunks = []
+    length = i = 0
+    while length < size:
+        chunk = DEFINITION % (i, i, i, i, i)
+        chunks.append(chunk)
+        length += len(chunk)
+        i += 1
+    return ''.join(chunks), 2 * i
+
+
+def bench_read_file(size=4 << 20):
+    "Time to read every form of a generated file with read_stream"
+    source, nforms = generate_source(size)
+    with tempfile.NamedTemporaryFile('w', suffix='.scm', delete=False) as f:
+        f.write(source)
+    try:
+        start = time.perf_counter()
+        with open(f.name) as stream:
+            count = sum(1 for _ in read_stream(stream))
+        elapsed = time.perf_counter() - start
+    finally:
+        os.unlink(f.name)
+    assert count == nforms
+    return len(source), elapsed
+
+
+def bench_parse_all(size=4 << 20):
+    "Time to parse_all a generated source of hundreds of thousands of forms"
+    source, nforms = generate_source(size)
+    start = time.perf_counter()
+    forms = parse_all(source)
+    elapsed = time.perf_counter() - start
+    assert len(forms) == nforms
+    return nforms, elapsed
+
+
+def legacy_tokenize(expr):
+    "The tokenizer before typed tokens, with atom() applied to each token"
+    regex = re.compile("""(
+    '|                        # quote
+    \\(|                       # left paren
+    \\)|                       # right paren
+    [\\w.?!+-></=*+]+|         # identifier
+    ".*?"|                    # string
+    \\.
+    )
+    """, re.VERBOSE)
+    for token in (x for x in re.findall(regex, expr) if x != ''):
+        try: yield int(token)
+        except ValueError:
+            try: yield float(token)
+            except ValueError: yield token
+
+
+def bench_tokenize(size=4 << 20):
+    "Tokenizer throughput in MB/s on str, on bytes and of the legacy one"
+    source, _ = generate_source(size)
+    inputs = [('legacy', legacy_tokenize, source),
+              ('str', tokenize, source),
+              ('bytes', tokenize, source.encode())]
+    results = []
+    for name, tokenizer, data in inputs:
+        start = time.perf_counter()
+        for _ in tokenizer(data):
+            pass
+        elapsed = time.perf_counter() - start
+        results.append((name, len(data) / 1e6 / elapsed))
+    return results
+
+
+def bench_multiline_form(lines=1000):
+    """Feeding one multi-line form line by line, to the Reader
+    and to the old REPL scheme of re-joining and re-parsing
+    every buffered line whenever a new one arrives.
+    """
+    form = ['(list'] + ['  (+ %d %d)' % (i, i) for i in range(lines)] + [')']
+
+    start = time.perf_counter()
+    reader = Reader()
+    for line in form:
+        reader.feed(line + '\n')
+    reader_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buffered = []
+    for line in form:
+        buffered.append(line)
+        parse(' '.join(buffered))
+    rejoin_time = time.perf_counter() - start
+    return reader_time, rejoin_time
+
+
+def bench_shapes(depth=10000, width=1000000):
+    """Parse time of lists and quotes nested depth deep,
+    and of one flat list of width atoms, in microseconds per token
+    """
+    sources = {
+        'nested lists': "(" * depth + "a" + ")" * depth,
+        'nested quotes': "'" * depth + "a",
+        'flat list': "(" + " a" * width + ")",
+    }
+    results = []
+    for name, source in sources.items():
+        ntokens = sum(1 for _ in tokenize(source))
+        start = time.perf_counter()
+        parse(source)
+        elapsed = time.perf_counter() - start
+        results.append((name, ntokens, elapsed / ntokens * 1e6))
+    return results
+
+
+def bench_parse_cache(snippets=1000, rounds=10):
+    """Parsing the same snippets again and again: without a cache,
+    through a ParseCache, and from a cache loaded from disk
+    """
+    source, _ = generate_source(1)
+    texts = [source.replace('-0', '-%d' % i) for i in range(snippets)]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            parse_all(text)
+    plain = time.perf_counter() - start
+
+    cache = ParseCache(maxsize=snippets)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            cache.parse_all(text)
+    cached = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'cache.pickle')
+        cache.save(path)
+        start = time.perf_counter()
+        warm = ParseCache(maxsize=snippets)
+        warm.load(path)
+        for text in texts:
+            warm.parse_all(text)
+        warm_start = time.perf_counter() - start
+    return plain, cached, warm_start, cache.info()
+
+
+def bench_ast_memory(size=4 << 20):
+    """Memory held by the parsed program: lists from parse_all, tuples
+    from parse_tree with and without spans
+    """
+    source, _ = generate_source(size)
+    parsers = [('lists', parse_all),
+               ('tuples', parse_tree),
+               ('tuples+spans', lambda s: parse_tree(s, spans=True))]
+    results = []
+    for name, parser in parsers:
+        tracemalloc.start()
+        ast = parser(source)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del ast
+        results.append((name, current))
+    return len(source), results
+
+
+if __name__ == '__main__':
+    size, elapsed = bench_read_file()
+    print("read_stream: %.1f MB in %.2fs, %.2f MB/s"
+          % (size / 1e6, elapsed, size / 1e6 / elapsed))
+    nforms, elapsed = bench_parse_all(16 << 20)
+    print("parse_all: %d forms in %.2fs, %.0f forms/s"
+          % (nforms, elapsed, nforms / elapsed))
+    for name, mbs in bench_tokenize():
+        print("tokenize %-6s %.2f MB/s" % (name, mbs))
+    for name, ntokens, us in bench_shapes():
+        print("%-14s %8d tokens, %.2f us/token" % (name, ntokens, us))
+    size, results = bench_ast_memory()
+    for name, current in results:
+        print("%.1f MB source as %-12s %.1f MB" % (size / 1e6, name, current / 1e6))
+    plain, cached, warm_start, info = bench_parse_cache()
+    print("repeated parsing: plain %.3fs, cached %.3fs %s" % (plain, cached, info))
+    print("warm start from disk: %.3fs" % warm_start)
+    for lines in (250, 500, 1000):
+        reader_time, rejoin_time = bench_multiline_form(lines)
+        print("%5d-line form: Reader %.3fs, re-join %.3fs"
+              % (lines, reader_time, rejoin_time))
@@ -1,66 +1,480 @@
 """ A simple lisp parser for SICP exercises
 """
+import pickle
 import re
+import weakref
+from array import array
+from collections import OrderedDict, namedtuple
 
-__all__ = ["parse"]
+__all__ = ["parse", "parse_all", "iter_forms", "parse_tree", "SourceTree",
+           "Reader", "read_stream", "Symbol", "ParseCache"]
+
+
+class Symbol(str):
+    """Identifier, interned: symbols with the same name are the same
+    object, so they can be compared with `is`. Anything parsed that is
+    a str but not a Symbol is a string literal.
+
+    The table only refers to them weakly, a symbol no expression uses
+    anymore is dropped.
+    """
+    __slots__ = ('__weakref__',)
+    table = weakref.WeakValueDictionary()
+
+    def __new__(cls, name):
+        try:
+            return cls.table[name]
+        except KeyError:
+            symbol = cls.table[name] = super().__new__(cls, name)
+            return symbol
+
+    def __reduce__(self):
+        # unpickled through the table, for every protocol
+        return Symbol, (str(self),)
+
+
+SPECIEAL_TOKENS = {"'": Symbol('quote'),
+                   ".": Symbol('dot'),}
+
+# identifier characters, a token of them that is not a number is a symbol
+SYMBOL_CHARS = r"[\w.?!+-></=*+]"
+
+TOKEN_REGEX = r"""
+    (?P<open>\()|
+    (?P<close>\))|
+    (?P<quote>')|
+    (?P<int>[-+]?\d+)(?!%(sym)s)|
+    (?P<float>[-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)(?!%(sym)s)|
+    (?P<dot>\.)(?!%(sym)s)|
+    (?P<symbol>%(sym)s+)|
+    (?P<string>".*?")
+    """ % {'sym': SYMBOL_CHARS}
+
+# compiled once, the bytes version scans bytes, bytearray and memoryview
+TOKEN_PATTERN = re.compile(TOKEN_REGEX, re.VERBOSE)
+BYTES_TOKEN_PATTERN = re.compile(TOKEN_REGEX.encode(), re.VERBOSE)
+
+IDENTIFIER_CHAR = re.compile(SYMBOL_CHARS)
 
-SPECIEAL_TOKENS = {"'": 'quote',
-                   ".": 'dot',}
 
 def tokenize(expr):
-    regex = re.compile("""(
-    '|                        # quote
-    \(|                       # left paren
-    \)|                       # right paren
-    [\w.?!+-></=*+]+|         # identifier
-    ".*?"|                    # string
-    \.
-    )
-    """, re.VERBOSE)
-    return (x for x in re.findall(regex, expr) if x != '')
+    """Yields (kind, value) pairs, kind being one of 'open', 'close',
+    'quote', 'dot', 'number', 'string' and 'symbol'. Numbers are
+    converted already, strings keep their double quotes.
+    """
+    for _, _, kind, value in token_spans(expr):
+        yield kind, value
+
+
+def token_spans(expr, base=0):
+    "Yields (start, end, kind, value), offsets counted from base"
+    if isinstance(expr, str):
+        pattern = TOKEN_PATTERN
+        text = str
+    else:
+        pattern = BYTES_TOKEN_PATTERN
+        text = lambda b: b.decode('utf-8')
+    for m in pattern.finditer(expr):
+        kind = m.lastgroup
+        start, end = base + m.start(), base + m.end()
+        if kind == 'int':
+            yield start, end, 'number', int(m.group())
+        elif kind == 'float':
+            yield start, end, 'number', float(m.group())
+        elif kind == 'symbol':
+            yield start, end, kind, Symbol(text(m.group()))
+        elif kind == 'string':
+            yield start, end, kind, text(m.group())
+        else:
+            yield start, end, kind, None
 
 
 def parse(expr):
-    reader = token_reader()
-    reader.send(None)
-    try:
-        for token in tokenize(expr):
-            reader.send(token)
-    except StopIteration as e:
-        return e.value
+    reader = TokenReader()
+    for kind, value in tokenize(expr):
+        exp = reader.read(kind, value)
+        if exp is not INCOMPLETE:
+            return exp
+
+
+def iter_forms(expr):
+    """Yields (offset, expression) for every top-level expression
+    in expr, offset being where the expression starts in expr
+    """
+    reader = Reader()
+    for start, _, form in reader.read_tokens(token_spans(expr)):
+        yield start, form
+    reader.close()
+
+
+def parse_all(expr):
+    "Returns the list of every top-level expression in expr"
+    return [form for _, form in iter_forms(expr)]
+
+
+def parse_tree(expr, spans=False):
+    """Returns a SourceTree of every top-level expression in expr,
+    lists being read as tuples. With spans, the offsets of every
+    list are recorded as well.
+    """
+    reader = Reader(immutable=True, spans=Spans() if spans else None)
+    forms = []
+    offsets = []
+    for start, end, form in reader.read_tokens(token_spans(expr)):
+        forms.append(form)
+        offsets.append((start, end))
+    reader.close()
+    return SourceTree(tuple(forms), offsets, reader.reader.spans)
+
+
+class Spans:
+    """(start, end) offsets of the non-empty lists of a parse, in
+    preorder, in two arrays of 8 bytes per list
+    """
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, spans=()):
+        self.starts = array('q', [start for start, _ in spans])
+        self.ends = array('q', [end for _, end in spans])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return self.starts[i], self.ends[i]
+
+    def open(self, start):
+        "Index of a list starting at start, its end is set by close"
+        self.starts.append(start)
+        self.ends.append(start)
+        return len(self.starts) - 1
+
+    def close(self, i, end, empty):
+        if empty:
+            # the last one opened, no list is inside it
+            del self.starts[i], self.ends[i]
+        else:
+            self.ends[i] = end
+
+
+class SourceTree:
+    """Immutable parse of a source text
+
+    forms are the top-level expressions, with tuples in place of
+    lists, so subtrees can be shared and results of analysis can be
+    memoized by node identity. offsets are the (start, end) of each
+    form, and span(node) is the (start, end) of a non-empty tuple
+    when spans were recorded.
+
+    Spans are kept in the preorder of nodes(), the table from the
+    nodes to their index is only built by the first call of span.
+    """
+    __slots__ = ('forms', 'offsets', 'spans', 'index')
+
+    def __init__(self, forms, offsets, spans=None):
+        self.forms = forms
+        self.offsets = offsets
+        self.spans = spans
+        self.index = None
+
+    def span(self, node):
+        if self.spans is None:
+            return None
+        if self.index is None:
+            # the nodes are alive as long as the tree, ids stay theirs
+            self.index = {id(node): i for i, node in enumerate(self.nodes())}
+        i = self.index.get(id(node))
+        return None if i is None else self.spans[i]
+
+    def nodes(self):
+        "Yields every non-empty tuple in preorder, without recursion"
+        stack = [form for form in reversed(self.forms)]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, tuple) and node:
+                yield node
+                stack.extend(reversed(node))
+
+    # spans are pickled as a list of pairs in preorder
+    def __getstate__(self):
+        spans = None
+        if self.spans is not None:
+            spans = [self.spans[i] for i in range(len(self.spans))]
+        return self.forms, self.offsets, spans
 
+    def __setstate__(self, state):
+        self.forms, self.offsets, spans = state
+        self.spans = None if spans is None else Spans(spans)
+        self.index = None
 
-def token_reader():
+
+CacheInfo = namedtuple('CacheInfo', 'hits, misses, evictions, maxsize, currsize')
+
+
+class ParseCache:
+    """Bounded LRU cache of parsed source text
+
+    Evaluators may hold on to the lists they are given, so every hit
+    returns a fresh copy of the cached expression. The cache can be
+    saved to a pickle file and loaded back to skip parsing on warm
+    starts.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def parse(self, expr):
+        return self.lookup(parse, expr)
+
+    def parse_all(self, expr):
+        return self.lookup(parse_all, expr)
+
+    def parse_tree(self, expr):
+        "SourceTrees are immutable, hits share them without copying"
+        return self.lookup(parse_tree, expr)
+
+    def lookup(self, parser, expr):
+        key = (parser.__name__, expr)
+        try:
+            exp = self.table[key]
+        except KeyError:
+            self.misses += 1
+            exp = parser(expr)
+            self.store(key, exp)
+            return copy_tree(exp)
+        self.hits += 1
+        self.table.move_to_end(key)
+        return copy_tree(exp)
+
+    def store(self, key, exp):
+        self.table[key] = exp
+        if len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+            self.evictions += 1
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.maxsize, len(self.table))
+
+    def clear(self):
+        self.table.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def save(self, path):
+        "Writes the cached entries, least recently used first"
+        with open(path, 'wb') as f:
+            pickle.dump(list(self.table.items()), f, pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+        "Adds the entries saved in path, Symbols are interned again"
+        with open(path, 'rb') as f:
+            for key, exp in pickle.load(f):
+                self.store(key, exp)
+
+
+def copy_tree(exp):
+    "Copies the lists of an expression, without recursion"
+    if not isinstance(exp, list):
+        return exp
+    root = []
+    stack = [(exp, root)]
+    while stack:
+        src, dst = stack.pop()
+        for x in src:
+            if isinstance(x, list):
+                y = []
+                dst.append(y)
+                stack.append((x, y))
+            else:
+                dst.append(x)
+    return root
+
+
+class Reader:
+    """Incremental reader
+
+    Feed it source text in chunks of any size, every top-level
+    expression is returned as soon as its last token arrives.
+    Each chunk is tokenized once.
+    """
+    def __init__(self, immutable=False, spans=None):
+        # pieces of the text that may end in the middle of a token,
+        # it starts after the last complete token
+        self.pending = []
+        # whether it starts with a string literal still open
+        self.in_string = False
+        # offset of pending in the whole input
+        self.position = 0
+        # the expression being read and the offset where it starts
+        self.reader = TokenReader(immutable, spans)
+        self.start = None
+
+    def feed(self, chunk):
+        "Returns a list of the expressions completed by chunk"
+        if self.in_string and '"' not in chunk and '\n' not in chunk:
+            # the string goes on, the text is joined once it ends
+            self.pending.append(chunk)
+            return []
+        self.pending.append(chunk)
+        text = ''.join(self.pending)
+        # tokens never span lines, and pending starts outside of a
+        # string or at its opening quote, so the quotes from there
+        # pair up, the last one opens a string when they are odd
+        line = text.rfind('\n') + 1
+        quote = text.rfind('"', line)
+        self.in_string = quote >= 0 and text.count('"', line, quote) % 2 == 0
+        if self.in_string:
+            cut = quote
+        else:
+            # only a symbol or number touching the end of the text can
+            # go on in the next chunk
+            cut = len(text)
+            while cut > 0 and IDENTIFIER_CHAR.match(text, cut - 1):
+                cut -= 1
+        self.pending = [text[cut:]] if cut < len(text) else []
+        tokens = token_spans(text[:cut], self.position)
+        self.position += cut
+        return [form for _, _, form in self.read_tokens(tokens)]
+
+    def close(self):
+        "Returns the remaining expressions at the end of the input"
+        text = ''.join(self.pending)
+        tokens = token_spans(text, self.position)
+        forms = [form for _, _, form in self.read_tokens(tokens)]
+        self.position += len(text)
+        self.pending = []
+        self.in_string = False
+        if self.reader.is_reading():
+            self.reader.reset()
+            raise ValueError('Unexpected end of input')
+        return forms
+
+    def is_reading(self):
+        "True if an expression has been started but not completed"
+        return self.reader.is_reading() or any(
+            piece.strip() for piece in self.pending)
+
+    def read_tokens(self, tokens):
+        "Yields (start, end, expression) completed by token_spans"
+        reader = self.reader
+        for start, end, kind, value in tokens:
+            if not reader.is_reading():
+                if kind == 'close':
+                    raise ValueError('Unexpected ) at %d' % (start,))
+                self.start = start
+            exp = reader.read(kind, value, start, end)
+            if exp is not INCOMPLETE:
+                yield self.start, end, exp
+
+
+def read_stream(stream, size=1 << 16):
+    """Yields the expressions read from a file object,
+    or from any iterable of strings
+    """
+    reader = Reader()
+    chunks = stream
+    if hasattr(stream, 'read'):
+        chunks = iter(lambda: stream.read(size), '')
+    for chunk in chunks:
+        yield from reader.feed(chunk)
+    yield from reader.close()
+
+
+# returned by TokenReader.read until an expression is complete
+INCOMPLETE = object()
+
+# markers on the TokenReader stack besides the lists being read
+QUOTE = object()
+DOT = object()
+# a dotted expression has been read, the list must close
+CLOSE = object()
+
+
+class TokenReader:
     """Consume tokens to construct a lisp expression
+
+    Open lists and pending quotes are kept on an explicit stack,
+    so the cost per token does not depend on the nesting depth
+    and there is no limit on it.
+
+    With immutable set, lists are built as tuples. With a Spans, the
+    (start, end) offsets of every non-empty tuple are recorded in it,
+    in preorder.
     """
-    token = yield
-    if token == '(':
-        parsed_expr = []
-        while True:
-            exp1 = yield from token_reader()
-            if exp1 == ')': return parsed_expr
-            # dotted expression must be the last one in a list
-            if is_dotted(exp1):
-                if (yield from token_reader()) == ')':
-                    return parsed_expr + [exp1]
-                raise ValueError('Invalid dot expression')
-
-            parsed_expr.append(exp1)
-    # quote and dot may not be necessary for the register machine simulator.
-    elif token in SPECIEAL_TOKENS:
-        return [SPECIEAL_TOKENS[token], (yield from token_reader())]
-
-    return atom(token)
-
-
-def atom(token):
-    try: return int(token)
-    except ValueError:
-        try: return float(token)
-        except ValueError: return token
-
-
-def is_dotted(exp):
-    return isinstance(exp, list) \
-        and len(exp) == 2 \
-        and exp[0] == SPECIEAL_TOKENS['.']
+    def __init__(self, immutable=False, spans=None):
+        self.immutable = immutable
+        self.spans = spans
+        self.reset()
+
+    def reset(self):
+        self.stack = []
+        # start offsets of the lists and markers on the stack, or
+        # their index in spans when it is recorded
+        self.starts = []
+
+    def is_reading(self):
+        return self.stack != []
+
+    def read(self, kind, value, start=0, end=0):
+        "Returns the expression completed by a token, or INCOMPLETE"
+        stack = self.stack
+        if stack and stack[-1] is CLOSE and kind != 'close':
+            raise ValueError('Invalid dot expression')
+        if kind == 'open':
+            stack.append([])
+            self.opened(start)
+            return INCOMPLETE
+        if kind == 'close':
+            if stack and stack[-1] is CLOSE:
+                stack.pop()
+            if not stack or not isinstance(stack[-1], list):
+                raise ValueError('Unexpected )')
+            exp = stack.pop()
+            return self.complete(self.node(exp, end), end)
+        # quote and dot may not be necessary for the register machine simulator.
+        if kind == 'quote':
+            stack.append(QUOTE)
+            self.opened(start)
+            return INCOMPLETE
+        if kind == 'dot':
+            stack.append(DOT)
+            self.opened(start)
+            return INCOMPLETE
+        return self.complete(value, end)
+
+    def opened(self, start):
+        "A list starts, spans are opened in preorder"
+        if self.spans is not None:
+            start = self.spans.open(start)
+        self.starts.append(start)
+
+    def node(self, exp, end):
+        "Closes the list exp, read since the innermost start"
+        start = self.starts.pop()
+        if self.spans is not None:
+            self.spans.close(start, end, not exp)
+        if self.immutable:
+            exp = tuple(exp)
+        return exp
+
+    def complete(self, exp, end):
+        "Puts exp where it belongs, returns it if it is a whole expression"
+        stack = self.stack
+        while stack:
+            top = stack[-1]
+            if top is QUOTE:
+                stack.pop()
+                exp = self.node([SPECIEAL_TOKENS["'"], exp], end)
+            elif top is DOT:
+                stack.pop()
+                exp = self.node([SPECIEAL_TOKENS['.'], exp], end)
+                if stack and isinstance(stack[-1], list):
+                    # dotted expression must be the last one in a list
+                    stack[-1].append(exp)
+                    stack.append(CLOSE)
+                    return INCOMPLETE
+            else:
+                top.append(exp)
+                return INCOMPLETE
+        return exp
@@ -1,4 +1,10 @@
-from SICP.lisp_parser.lp import parse
+import gc
+import io
+import os
+import pickle
+import tempfile
+from SICP.lisp_parser.lp import parse, parse_all, iter_forms, \
+    parse_tree, Reader, read_stream, Symbol, ParseCache
 import unittest
 
 class LispParserTest(unittest.TestCase):
@@ -54,4 +60,132 @@ class LispParserTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             print(parse("(a . b c)"))
 
+    def test_reader(self):
+        code = """
+        (define (fib n)
+          "Computes nth fibonacci number"
+          (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+        'abc 42 (a . b)
+        """
+        forms = [parse(code), ['quote', 'abc'], 42, ['a', ['dot', 'b']]]
+        for size in (1, 2, 3, 7, len(code)):
+            reader = Reader()
+            got = []
+            for i in range(0, len(code), size):
+                got.extend(reader.feed(code[i:i + size]))
+            got.extend(reader.close())
+            self.assertEqual(got, forms)
+
+        self.assertEqual(list(read_stream(io.StringIO(code))), forms)
+
+    def test_reader_partial(self):
+        reader = Reader()
+        self.assertEqual(reader.feed("(+ 1 2) (abc"), [['+', 1, 2]])
+        self.assertTrue(reader.is_reading())
+        self.assertEqual(reader.feed("def)"), [['abcdef']])
+        self.assertFalse(reader.is_reading())
+        self.assertEqual(reader.feed("10"), [])
+        self.assertEqual(reader.close(), [10])
+
+        # a string on the last line doesn't hold back the tokens after it
+        self.assertEqual(reader.feed('"s" (a) (b'), ['"s"', ['a']])
+        self.assertEqual(reader.feed(' "c d'), [])
+        self.assertEqual(reader.feed(' e'), [])
+        self.assertEqual(reader.feed('" f)'), [['b', '"c d e"', 'f']])
+        # a quote left open at the end of a line starts no string
+        self.assertEqual(reader.feed('"g'), [])
+        self.assertEqual(reader.feed('\n'), parse_all('"g\n'))
+
+        with self.assertRaises(ValueError):
+            Reader().feed(")")
+        reader = Reader()
+        reader.feed("(a b")
+        with self.assertRaises(ValueError):
+            reader.close()
+
+    def test_parse_all(self):
+        code = "(define a 1)\n  'b \"c\" (f (g a))"
+        self.assertEqual(list(iter_forms(code)),
+                         [(0, ['define', 'a', 1]), (15, ['quote', 'b']),
+                          (18, '"c"'), (22, ['f', ['g', 'a']])])
+        self.assertEqual(parse_all(''), [])
+        self.assertEqual(len(parse_all("(a b) " * 20000)), 20000)
+        with self.assertRaises(ValueError):
+            parse_all("(a) (b")
+
+    def test_deep_nesting(self):
+        depth = 10000
+        exp = parse("(" * depth + "a" + ")" * depth)
+        for _ in range(depth):
+            self.assertEqual(len(exp), 1)
+            exp = exp[0]
+        self.assertEqual(exp, 'a')
+
+        exp = parse("'" * depth + "a")
+        for _ in range(depth):
+            self.assertEqual(exp[0], 'quote')
+            exp = exp[1]
+        self.assertEqual(exp, 'a')
+
+        self.assertEqual(parse("'. a"), ['quote', ['dot', 'a']])
+
+    def test_symbols(self):
+        define, name, string = parse('(define a "a")')
+        self.assertIs(type(define), Symbol)
+        self.assertIs(define, Symbol('define'))
+        self.assertIs(name, parse("'a")[1])
+        self.assertIs(parse("'a")[0], Symbol('quote'))
+        self.assertIsNot(type(string), Symbol)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertIs(pickle.loads(pickle.dumps(define, protocol)), define)
+        # symbols nothing refers to leave the table
+        size = len(Symbol.table)
+        symbols = [Symbol('unused-%d' % i) for i in range(100)]
+        self.assertEqual(len(Symbol.table), size + 100)
+        del symbols
+        gc.collect()
+        self.assertEqual(len(Symbol.table), size)
+
+    def test_parse_cache(self):
+        cache = ParseCache(maxsize=2)
+        exp = cache.parse("(a (b) c)")
+        exp[1].append('mutated')
+        self.assertEqual(cache.parse("(a (b) c)"), ['a', ['b'], 'c'])
+        self.assertEqual(cache.parse_all("1 2"), [1, 2])
+        self.assertEqual(cache.parse("(d)"), ['d'])
+        self.assertEqual(tuple(cache.info()), (1, 3, 1, 2, 2))
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'cache.pickle')
+            cache.save(path)
+            warm = ParseCache()
+            warm.load(path)
+        exp = warm.parse("(d)")
+        self.assertEqual(exp, ['d'])
+        self.assertIs(exp[0], Symbol('d'))
+        self.assertEqual(warm.info().hits, 1)
+
+    def test_parse_tree(self):
+        code = "(define (f x) '(x . y) ())\n42"
+        tree = parse_tree(code, spans=True)
+        define, quoted = tree.forms[0], tree.forms[0][2]
+        self.assertEqual(tree.forms,
+                         (('define', ('f', 'x'),
+                           ('quote', ('x', ('dot', 'y'))), ()), 42))
+        self.assertEqual(tree.offsets, [(0, 26), (27, 29)])
+        self.assertEqual(tree.span(define), (0, 26))
+        self.assertEqual(code[slice(*tree.span(quoted))], "'(x . y)")
+        self.assertEqual(code[slice(*tree.span(quoted[1][1]))], ". y")
+        hash(tree.forms)
+
+        tree = pickle.loads(pickle.dumps(tree))
+        self.assertEqual(tree.span(tree.forms[0][1]), (8, 13))
+        self.assertEqual(tree.span(tree.forms[0][2]), (14, 22))
+        self.assertIsNone(tree.span(tree.forms[0][3]))
+        # spans are only recorded on demand
+        self.assertIsNone(parse_tree(code).span(define))
+
+        cache = ParseCache()
+        self.assertIs(cache.parse_tree(code), cache.parse_tree(code))
+
 unittest.main()
@@ -0,0 +1,87 @@
+""" Running one controller on many register sets
+
+    program = Program(['a', 'b', 't'], [('rem', operator.mod), ...], parse(code))
+    results = run_batch(program, [{'a': 206, 'b': 40}, ...], outputs=['a'])
+    results = run_batch(program, inputs, workers=4)   # in 4 processes
+
+The controller is assembled once per Program, and each run starts from
+a reset machine, as a new Machine would. A Program pickles as its
+parsed controller, so worker processes get it once, when they start,
+and assemble it without parsing. Its operations must be picklable for
+that: functions of a module, like those of operator, not lambdas.
+"""
+__all__ = ['Program', 'run_batch']
+
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+from SICP.register_machine_simulator.rms import Machine
+from SICP.register_machine_simulator.codegen import CompiledMachine
+
+
+class Program:
+    def __init__(self, register_names, ops, controller_text, optimize=False,
+                 compiled=False, stack=None):
+        self.register_names = list(register_names)
+        self.ops = list(ops)
+        self.controller_text = controller_text
+        self.optimize = optimize
+        self.compiled = compiled
+        machine_class = CompiledMachine if compiled else Machine
+        self.machine = machine_class(self.register_names, self.ops,
+                                     controller_text, optimize, stack)
+
+    def __getstate__(self):
+        return (self.register_names, self.ops, self.controller_text,
+                self.optimize, self.compiled, self.machine.stack)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def run(self, registers, outputs=None):
+        """Values of the outputs registers, all of them by default,
+        after running from the registers given in a dict
+        """
+        machine = self.machine
+        machine.reset()
+        for name, value in registers.items():
+            machine.get_register(name).value = value
+        machine.start()
+        if outputs is None:
+            outputs = self.register_names
+        return {name: machine.get_register(name).value for name in outputs}
+
+    def run_many(self, inputs, outputs=None):
+        return [self.run(registers, outputs) for registers in inputs]
+
+
+# the Program of a worker process
+worker_program = None
+
+
+def install(program):
+    global worker_program
+    worker_program = program
+
+
+def run_chunk(inputs, outputs):
+    return worker_program.run_many(inputs, outputs)
+
+
+def run_batch(program, inputs, outputs=None, workers=0, chunksize=None):
+    """program.run() of each register set of inputs, in their order.
+    With workers, the inputs are run by that many processes, in chunks
+    of chunksize, four per worker by default.
+    """
+    if not workers:
+        return program.run_many(inputs, outputs)
+    inputs = list(inputs)
+    if chunksize is None:
+        chunksize = max(1, math.ceil(len(inputs) / (workers * 4)))
+    chunks = [inputs[i:i + chunksize] for i in range(0, len(inputs), chunksize)]
+    results = []
+    with ProcessPoolExecutor(workers, initializer=install,
+                             initargs=(program,)) as pool:
+        for chunk_results in pool.map(run_chunk, chunks, [outputs] * len(chunks)):
+            results.extend(chunk_results)
+    return results
@@ -0,0 +1,412 @@
+""" Benchmarks for the register machine simulator
+
+    python -m SICP.register_machine_simulator.bench
+"""
+import operator
+import os
+import random
+import time
+import tracemalloc
+
+from SICP.lisp_parser.lp import parse
+from SICP.register_machine_simulator.rms import Machine, Stack, ArrayStack, \
+    StackOverflow, extract_labels, entry_points
+from SICP.register_machine_simulator import peephole
+from SICP.register_machine_simulator.codegen import CompiledMachine
+from SICP.register_machine_simulator.batch import Program, run_batch
+from SICP.register_machine_simulator.regfile import RegisterFileMachine
+
+
+GCD_CONTROLLER = """
+(test-b
+  (test (op =) (reg b) (const 0))
+  (branch (label gcd-done))
+  (assign t (op rem) (reg a) (reg b))
+  (assign a (reg b))
+  (assign b (reg t))
+  (goto (label test-b))
+gcd-done)
+"""
+
+FIB_CONTROLLER = """
+(fib-start
+  (assign continue (label fib-done))
+fib-loop
+  (test (op <) (reg n) (const 2))
+  (branch (label immediate-answer))
+  (save continue)
+  (assign continue (label afterfib-n-1))
+  (save n)
+  (assign n (op -) (reg n) (const 1))
+  (goto (label fib-loop))
+afterfib-n-1
+  (restore n)
+  (restore continue)
+  (assign n (op -) (reg n) (const 2))
+  (save continue)
+  (assign continue (label afterfib-n-2))
+  (save val)
+  (goto (label fib-loop))
+afterfib-n-2
+  (assign n (reg val))
+  (restore val)
+  (restore continue)
+  (assign val (op +) (reg val) (reg n))
+  (goto (reg continue))
+immediate-answer
+  (assign val (reg n))
+  (goto (reg continue))
+fib-done)
+"""
+
+
+def countdown_controller(padding):
+    """A 4-instruction loop followed by `padding` instructions
+    that are never executed, so only the controller length varies.
+    """
+    pad = "\n".join("(assign x (const 0))" for _ in range(padding))
+    return """
+    (loop
+      (assign n (op -) (reg n) (const 1))
+      (test (op =) (reg n) (const 0))
+      (branch (label done))
+      (goto (label loop))
+      %s
+    done)
+    """ % pad
+
+
+def bench_step_cost(lengths=(10, 100, 1000, 10000), iterations=50000):
+    "Per-step cost must not depend on the controller length"
+    results = []
+    for padding in lengths:
+        m = Machine(['n', 'x'],
+                    [('-', lambda a, b: a - b), ('=', lambda a, b: a == b)],
+                    parse(countdown_controller(padding)))
+        m.get_register('n').value = iterations
+        start = time.perf_counter()
+        m.start()
+        elapsed = time.perf_counter() - start
+        steps = iterations * 4 - 1
+        results.append((padding + 4, elapsed / steps * 1e9))
+    return results
+
+
+def labelled_controller(blocks):
+    """`blocks` labelled blocks of 4 instructions each,
+    every block jumping forward to the next one
+    """
+    ast = []
+    for i in range(blocks):
+        ast.append('block-%d' % i)
+        ast.append(['assign', 'n', ['op', '-'], ['reg', 'n'], ['const', 1]])
+        ast.append(['test', ['op', '='], ['reg', 'n'], ['const', 0]])
+        ast.append(['branch', ['label', 'done']])
+        ast.append(['goto', ['label', 'block-%d' % (i + 1)]])
+    ast.append('block-%d' % blocks)
+    ast.append('done')
+    return ast
+
+
+def bench_assembly(sizes=(2500, 5000, 10000, 20000)):
+    "Assembly time on synthetic controllers of 10k+ instructions"
+    ops = [('-', lambda a, b: a - b), ('=', lambda a, b: a == b)]
+    results = []
+    for blocks in sizes:
+        ast = labelled_controller(blocks)
+        start = time.perf_counter()
+        extract_labels(ast)
+        labels_time = time.perf_counter() - start
+        start = time.perf_counter()
+        Machine(['n'], ops, ast)
+        machine_time = time.perf_counter() - start
+        results.append((blocks * 4, blocks + 2, labels_time, machine_time))
+    return results
+
+
+def bench_monitoring(iterations=200000, repeat=3):
+    "ns/step of the countdown loop unmonitored, counted and traced"
+    results = []
+    for mode in ('off', 'counted', 'traced', 'off again'):
+        m = Machine(['n', 'x'],
+                    [('-', lambda a, b: a - b), ('=', lambda a, b: a == b)],
+                    parse(countdown_controller(0)))
+        if mode == 'counted':
+            m.monitor()
+        elif mode == 'traced':
+            m.monitor(trace=1000)
+        elif mode == 'off again':
+            m.monitor()
+            m.unmonitor()
+        best = float('inf')
+        for _ in range(repeat):
+            m.get_register('n').value = iterations
+            m.pc.value = 0
+            start = time.perf_counter()
+            m.start()
+            best = min(best, time.perf_counter() - start)
+        results.append((mode, best / (iterations * 4 - 1) * 1e9))
+    return results
+
+
+def gcd_machine(optimize, machine_class=Machine):
+    m = machine_class(['a', 'b', 't'],
+                [('rem', lambda x, y: x % y), ('=', lambda x, y: x == y)],
+                parse(GCD_CONTROLLER), optimize)
+
+    def run():
+        for _ in range(500):
+            m.get_register('a').value = 2880067194370816120
+            m.get_register('b').value = 1779979416004714189
+            m.pc.value = 0
+            m.start()
+    return m, run
+
+
+def fib_machine(optimize, machine_class=Machine):
+    m = machine_class(['n', 'val', 'continue'],
+                [('<', lambda a, b: a < b), ('-', lambda a, b: a - b),
+                 ('+', lambda a, b: a + b)],
+                parse(FIB_CONTROLLER), optimize)
+
+    def run():
+        m.get_register('n').value = 20
+        m.pc.value = 0
+        m.start()
+    return m, run
+
+
+def eceval_machine(optimize, machine_class=Machine):
+    from SICP.eceval.eceval import make_machine, eval_exp, setup_environment
+    m = make_machine(optimize, machine_class)
+    env = setup_environment()
+    eval_exp(m, parse("""
+    (define (fib n)
+      (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))"""), env)
+    exp = parse("(fib 16)")
+    return m, lambda: eval_exp(m, exp, env)
+
+
+def bench_fusion(repeat=3):
+    """Time and dispatched procedures of each machine,
+    without and with optimize
+    """
+    results = []
+    for name, make in (('gcd', gcd_machine), ('fib', fib_machine),
+                       ('eceval fib', eceval_machine)):
+        row = [name]
+        for optimize in (False, True):
+            m, run = make(optimize)
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                best = min(best, time.perf_counter() - start)
+            m.monitor()
+            run()
+            m.unmonitor()
+            row += [best, m.instruction_count]
+        results.append(row)
+    return results
+
+
+def bench_compiled(repeat=3):
+    """Instructions per second of each machine run by Machine.start,
+    and compiled, with the controller as written and optimized
+    """
+    results = []
+    for name, make in (('gcd', gcd_machine), ('fib', fib_machine),
+                       ('eceval fib', eceval_machine)):
+        m, run = make(False)
+        m.monitor()
+        run()
+        m.unmonitor()
+        instructions = m.instruction_count
+        row = [name]
+        for machine_class, optimize in ((Machine, False), (CompiledMachine, False),
+                                        (CompiledMachine, True)):
+            m, run = make(optimize, machine_class)
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                best = min(best, time.perf_counter() - start)
+            row.append(instructions / best)
+        results.append(row)
+    return results
+
+
+def bench_register_file(repeat=3):
+    "Instructions per second of each machine, with Registers and a register file"
+    results = []
+    for name, make in (('gcd', gcd_machine), ('fib', fib_machine),
+                       ('eceval fib', eceval_machine)):
+        m, run = make(False)
+        m.monitor()
+        run()
+        m.unmonitor()
+        instructions = m.instruction_count
+        row = [name]
+        for machine_class in (Machine, RegisterFileMachine):
+            m, run = make(False, machine_class)
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                best = min(best, time.perf_counter() - start)
+            row.append(instructions / best)
+        results.append(row)
+    return results
+
+
+def bench_batch(n=20000, seed=0):
+    """Runs/s of gcd over n random register sets: a new Machine for
+    each, a Program, and run_batch in processes, up to the cores there are
+    """
+    rng = random.Random(seed)
+    inputs = [{'a': rng.randrange(1, 1 << 30), 'b': rng.randrange(1, 1 << 30)}
+              for _ in range(n)]
+    ops = [('rem', operator.mod), ('=', operator.eq)]
+    controller = parse(GCD_CONTROLLER)
+
+    def new_machines():
+        results = []
+        for registers in inputs:
+            m = Machine(['a', 'b', 't'], ops, controller)
+            for name, value in registers.items():
+                m.get_register(name).value = value
+            m.start()
+            results.append({'a': m.get_register('a').value})
+        return results
+
+    program = Program(['a', 'b', 't'], ops, controller)
+    compiled = Program(['a', 'b', 't'], ops, controller, compiled=True)
+    runs = [('new Machine each', new_machines),
+            ('Program', lambda: run_batch(program, inputs, ['a'])),
+            ('compiled Program', lambda: run_batch(compiled, inputs, ['a']))]
+    workers = 1
+    while workers <= max(2, os.cpu_count()):
+        runs.append(('%d processes' % workers,
+                     lambda workers=workers: run_batch(compiled, inputs, ['a'],
+                                                       workers=workers)))
+        workers *= 2
+
+    results = []
+    expected = None
+    for name, run in runs:
+        start = time.perf_counter()
+        outputs = run()
+        elapsed = time.perf_counter() - start
+        assert expected is None or outputs == expected
+        expected = outputs
+        results.append((name, n / elapsed))
+    return results
+
+
+DEEP_CONTROLLER = """
+(start
+  (assign m (reg n))
+down
+  (test (op =) (reg n) (const 0))
+  (branch (label up))
+  (save n)
+  (assign n (op -) (reg n) (const 1))
+  (goto (label down))
+up
+  (test (op =) (reg m) (const 0))
+  (branch (label done))
+  (restore n)
+  (assign m (op -) (reg m) (const 1))
+  (goto (label up))
+done)
+"""
+
+
+def bench_stack_memory(depth=200000):
+    """Best time of recursing depth deep and back on the same machine
+    with each kind of stack, tracemalloc peak of another run, and the
+    same for a runaway recursion stopped by a limit
+    """
+    ops = [('=', lambda a, b: a == b), ('-', lambda a, b: a - b)]
+
+    def measure(m, n):
+        def run():
+            m.reset()
+            m.get_register('n').value = n
+            try:
+                m.start()
+            except StackOverflow as error:
+                return str(error)
+        best = float('inf')
+        for _ in range(2):
+            start = time.perf_counter()
+            message = run()
+            best = min(best, time.perf_counter() - start)
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return best, peak, message
+
+    results = []
+    for name, stack in (('Stack', Stack()),
+                        ('Stack, limit', Stack(limit=depth)),
+                        ('ArrayStack', ArrayStack(depth))):
+        m = Machine(['n', 'm'], ops, parse(DEEP_CONTROLLER), stack=stack)
+        results.append((name,) + measure(m, depth)[:2])
+    m = Machine(['n', 'm'], ops, parse(DEEP_CONTROLLER), stack=Stack(limit=depth))
+    elapsed, peak, message = measure(m, 10 ** 9)
+    results.append(('runaway, ' + message, elapsed, peak))
+    return results
+
+
+def eceval_sizes():
+    "Instructions of the eceval controller, after peephole, and its blocks"
+    from SICP.eceval.eceval import eval_code
+    ast = parse(eval_code)
+    insts, labels = extract_labels(peephole.optimize(ast))
+    return len(extract_labels(ast)[0]), len(insts), len(entry_points(insts, labels))
+
+
+if __name__ == '__main__':
+    print("controller length  ns/step")
+    for length, ns in bench_step_cost():
+        print("%17d  %7.1f" % (length, ns))
+
+    print()
+    print("instructions  labels  extract_labels(ms)  Machine(ms)")
+    for insts, labels, t1, t2 in bench_assembly():
+        print("%12d  %6d  %18.1f  %11.1f" % (insts, labels, t1 * 1e3, t2 * 1e3))
+
+    print()
+    print("monitoring  ns/step")
+    for mode, ns in bench_monitoring():
+        print("%-10s  %7.1f" % (mode, ns))
+
+    print()
+    print("eceval controller: %d instructions, %d after peephole, %d blocks"
+          % eceval_sizes())
+    print("machine       time  dispatched  optimized  dispatched  speedup")
+    for name, t1, n1, t2, n2 in bench_fusion():
+        print("%-10s %7.4fs %11d %9.4fs %11d %7.2fx" % (name, t1, n1, t2, n2, t1 / t2))
+
+    print()
+    print("instructions/s     Machine    compiled  +optimize")
+    for name, *rates in bench_compiled():
+        print("%-10s  %11.0f %11.0f %10.0f" % (name, *rates))
+
+    print()
+    print("gcd batch (%d cores)  runs/s" % os.cpu_count())
+    for name, rate in bench_batch():
+        print("%-19s %8.0f" % (name, rate))
+
+    print()
+    print("instructions/s  Registers  register file")
+    for name, before, after in bench_register_file():
+        print("%-10s  %11.0f  %13.0f  %5.2fx" % (name, before, after, after / before))
+
+    print()
+    print("recursion 200000 deep, then back")
+    print("stack            time      peak")
+    for name, elapsed, peak in bench_stack_memory():
+        print("%-14s %6.3fs %7.0fKB" % (name, elapsed, peak / 1024))
@@ -0,0 +1,276 @@
+""" Compiler from controller texts to Python
+
+CompiledMachine runs its controller as one generated Python function:
+registers are locals, loaded from the Register objects when it starts
+and stored back when it stops, operations and constants are locals
+too, and each basic block is straight-line code. Labels are the same
+integer offsets as in Machine, so they can be kept in registers and
+jumped to with (goto (reg ...)).
+
+The blocks are found by a tree of comparisons on pc, a binary search
+among the offsets control can enter at. When pc is anywhere else, the
+function returns and start() runs instructions with the interpreting
+procedures until pc is back at one of them, so a CompiledMachine goes
+through the same states as a Machine.
+
+The values of an unbounded Stack are pushed and popped as a local
+list, other stacks are used through their methods. The stack given to
+the machine, and its limit, are the ones it is compiled for.
+
+Each instruction is one line of the function, or starts one, and a
+table maps those lines back to offsets. When an instruction raises, pc
+is left at it, as Machine leaves it, and a StackOverflow tells where
+it happened.
+
+Monitoring runs the interpreting procedures.
+"""
+__all__ = ['CompiledMachine', 'to_python']
+
+import math
+
+from SICP.register_machine_simulator.rms import Machine, Stack, StackOverflow, \
+    entry_points, lookup_label, is_operation_exp
+
+
+class CompiledMachine(Machine):
+    def __init__(self, register_names, ops, controller_text, optimize=False,
+                 stack=None):
+        super().__init__(register_names, ops, controller_text, optimize, stack)
+        self.entries = set(entry_points(self.insts, self.labels))
+        self.run = compile_controller(self)
+
+    def start(self):
+        insts = self.insts
+        pc = self.pc
+        end = len(insts)
+        entries = self.entries
+        run = self.run
+        while pc.value < end:
+            if pc.value in entries:
+                run()
+            else:
+                insts[pc.value].proc()
+
+
+class Generator:
+    "Python source of the function running a machine's controller"
+    def __init__(self, machine):
+        self.machine = machine
+        self.labels = machine.labels
+        self.end = len(machine.insts)
+        # register name => local variable, pc and flag keep their names
+        self.locals = {}
+        for name in machine.register_table:
+            if name not in ('pc', 'flag'):
+                self.locals[name] = 'r%d' % len(self.locals)
+        self.locals['pc'] = 'pc'
+        self.locals['flag'] = 'flag'
+        # objects the function uses, by variable name
+        self.globals = {'stack': machine.stack, 'StackOverflow': StackOverflow,
+                        'insts': machine.insts}
+        # whether the stack is a list that never overflows
+        self.list_stack = type(machine.stack) is Stack and machine.stack.limit is None
+        # those of them bound as default arguments, to be locals
+        self.bound = []
+        # index of a line in the body => offset of its instruction
+        self.line_offsets = {}
+        self.op_names = {}
+        self.constants = 0
+
+    def register(self, name):
+        try:
+            return self.locals[name]
+        except KeyError:
+            raise KeyError(name)
+
+    def op(self, name):
+        if name not in self.op_names:
+            self.op_names[name] = var = 'op%d' % len(self.op_names)
+            self.globals[var] = self.machine.ops[name]
+            self.bound.append(var)
+        return self.op_names[name]
+
+    def constant(self, value):
+        # inf and nan have no literal
+        if (type(value) in (int, bool) or value is None
+                or (type(value) is float and math.isfinite(value))):
+            return repr(value)
+        var = 'c%d' % self.constants
+        self.constants += 1
+        self.globals[var] = value
+        self.bound.append(var)
+        return var
+
+    def primitive(self, exp, offset):
+        tag, val = exp
+        if tag == 'const':
+            return self.constant(val)
+        elif tag == 'label':
+            return str(lookup_label(self.labels, val))
+        elif tag == 'reg':
+            if val == 'pc':
+                # the offset of the instruction being executed
+                return str(offset)
+            return self.register(val)
+        else:
+            raise ValueError('Unknown expression type %s' % (exp,))
+
+    def value(self, exp, offset):
+        if is_operation_exp(exp):
+            (_, op_name), *args = exp
+            return '%s(%s)' % (self.op(op_name), ', '.join(
+                self.primitive(arg, offset) for arg in args))
+        return self.primitive(exp[0], offset)
+
+    def store(self, name, value, lines, indent):
+        "Assignment of a register, a jump for pc"
+        if name == 'pc':
+            lines.append(indent + 'pc = %s + 1' % value)
+            lines.append(indent + 'continue')
+        else:
+            lines.append(indent + '%s = %s' % (self.register(name), value))
+
+    def block(self, start, end, lines, indent):
+        "Code of the instructions start to end, ending with a jump"
+        for offset in range(start, end):
+            first = len(lines)
+            self.instruction(offset, lines, indent)
+            for line in range(first, len(lines)):
+                self.line_offsets[line] = offset
+            if self.machine.insts[offset].text[0] == 'goto':
+                return
+        lines.append(indent + 'pc = %d' % end)
+        lines.append(indent + 'continue')
+
+    def instruction(self, offset, lines, indent):
+        "Code of the instruction at offset"
+        inst = self.machine.insts[offset].text
+        cmd = inst[0]
+        if cmd == 'assign':
+            _, reg, *val = inst
+            self.store(reg, self.value(val, offset), lines, indent)
+        elif cmd == 'test':
+            _, *cond = inst
+            if not is_operation_exp(cond):
+                raise ValueError("Bad Test expression: %s" % (cond,))
+            lines.append(indent + 'flag = %s' % self.value(cond, offset))
+        elif cmd == 'branch':
+            _, (tag, dest) = inst
+            if tag != 'label':
+                raise ValueError("Bad BRANCH instruction: %s" % (inst,))
+            lines.append(indent + 'if flag:')
+            lines.append(indent + '    pc = %d' % lookup_label(self.labels, dest))
+            lines.append(indent + '    continue')
+        elif cmd == 'goto':
+            _, (tag, val) = inst
+            if tag == 'label':
+                lines.append(indent + 'pc = %d' % lookup_label(self.labels, val))
+            elif tag == 'reg':
+                lines.append(indent + 'pc = %s' % self.primitive(inst[1], offset))
+            else:
+                raise ValueError("Bad Goto instruction: %s" % (inst,))
+            lines.append(indent + 'continue')
+        elif cmd == 'save':
+            lines.append(indent + 'push(%s)' % self.primitive(['reg', inst[1]], offset))
+        elif cmd == 'restore':
+            self.store(inst[1], 'pop()', lines, indent)
+        elif cmd == 'perform':
+            _, *action = inst
+            if not is_operation_exp(action):
+                raise ValueError("Bad PERFROM instruction %s" % (inst,))
+            lines.append(indent + self.value(action, offset))
+        else:
+            raise ValueError("Unknown command: %s" % (cmd,))
+
+    def dispatch(self, entries, ends, lines, indent):
+        "Binary search of pc among entries, leaving the loop when it isn't one"
+        if len(entries) == 1:
+            lines.append(indent + 'if pc == %d:' % entries[0])
+            self.block(entries[0], ends[entries[0]], lines, indent + '    ')
+            lines.append(indent + 'break')
+            return
+        middle = len(entries) // 2
+        lines.append(indent + 'if pc < %d:' % entries[middle])
+        self.dispatch(entries[:middle], ends, lines, indent + '    ')
+        lines.append(indent + 'else:')
+        self.dispatch(entries[middle:], ends, lines, indent + '    ')
+
+    def function(self):
+        insts = self.machine.insts
+        entries = entry_points(insts, self.labels)
+        entry_set = set(entries)
+        # a block ends at the next entry or after a goto
+        ends = {}
+        for start in entries:
+            end = start + 1
+            while (end < len(insts) and end not in entry_set
+                   and insts[end - 1].text[0] != 'goto'):
+                end += 1
+            ends[start] = end
+
+        registers = [name for name in self.locals if name not in ('pc', 'flag')]
+        self.globals['registers'] = [self.machine.get_register(name)
+                                     for name in registers]
+        self.globals['pc_register'] = self.machine.pc
+        self.globals['flag_register'] = self.machine.flag
+        body = []
+        if entries:
+            self.dispatch(entries, ends, body, ' ' * 12)
+        else:
+            body.append(' ' * 12 + 'break')
+
+        lines = ['def run(%s):' % ', '.join('%s=%s' % (var, var) for var in self.bound)]
+        for name in registers:
+            lines.append('    # %s: %s' % (self.locals[name], name))
+        variables = ', '.join(self.locals[name] for name in registers)
+        if len(registers) == 1:
+            variables += ','
+        if registers:
+            lines.append('    %s = [r.value for r in registers]' % variables)
+        lines.append('    pc = pc_register.value')
+        lines.append('    flag = flag_register.value')
+        if self.list_stack:
+            lines.append('    values = stack.values')
+            lines.append('    push = values.append')
+            lines.append('    pop = values.pop')
+        else:
+            lines.append('    push = stack.push')
+            lines.append('    pop = stack.pop')
+        lines.append('    try:')
+        lines.append('        while pc < %d:' % self.end)
+        # line numbers count from 1
+        first = len(lines) + 1
+        self.globals['offsets'] = {first + line: offset
+                                   for line, offset in self.line_offsets.items()}
+        lines.extend(body)
+        lines.append('    except BaseException as error:')
+        lines.append('        # left at the instruction that raised it')
+        lines.append('        pc = offsets.get(error.__traceback__.tb_lineno, pc)')
+        if not self.list_stack:
+            lines.append('        if isinstance(error, StackOverflow):')
+            lines.append('            error.locate(insts[pc].label, insts[pc].text)')
+        lines.append('        raise')
+        lines.append('    finally:')
+        if registers:
+            lines.append('        for r, value in zip(registers, (%s)):' % variables)
+            lines.append('            r.value = value')
+        lines.append('        pc_register.value = pc')
+        lines.append('        flag_register.value = flag')
+        return '\n'.join(lines) + '\n'
+
+
+def to_python(machine):
+    "Python source of a machine's controller, for reading"
+    return Generator(machine).function()
+
+
+def compile_controller(machine):
+    "The function running a machine's controller, with its source"
+    generator = Generator(machine)
+    source = generator.function()
+    code = compile(source, '<controller>', 'exec')
+    namespace = generator.globals
+    exec(code, namespace)
+    run = namespace['run']
+    run.source = source
+    return run
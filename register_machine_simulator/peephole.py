@@ -0,0 +1,90 @@
+""" Peephole optimization of controller texts
+
+optimize(ast) returns an equivalent controller, with
+  - (save r) (restore r) dropped, and (save r) (restore s)
+    turned into (assign s (reg r)),
+  - goto and branch to a label whose first instruction is a
+    (goto (label ...)) sent to the final destination,
+  - goto to the instruction that follows dropped.
+
+Registers end up with the same values, label constants are left alone
+since they are values too. The stack statistics are those of the
+optimized controller.
+"""
+
+
+def is_label(x):
+    return isinstance(x, str)
+
+
+def drop_redundant_pairs(ast):
+    out = []
+    for x in ast:
+        if (not is_label(x) and x[0] == 'restore'
+                and out and not is_label(out[-1]) and out[-1][0] == 'save'):
+            saved = out.pop()[1]
+            if saved != x[1]:
+                out.append(['assign', x[1], ['reg', saved]])
+            continue
+        out.append(x)
+    return out
+
+
+def jump_label(inst):
+    "Label of a (goto (label x)), None for any other instruction"
+    if inst[0] == 'goto' and inst[1][0] == 'label':
+        return inst[1][1]
+    return None
+
+
+def jump_targets(ast):
+    "Label => the label it finally jumps to, for labels of a goto"
+    targets = {}
+    pending = []
+    for x in ast:
+        if is_label(x):
+            pending.append(x)
+            continue
+        dest = jump_label(x)
+        if dest is not None:
+            for label in pending:
+                targets[label] = dest
+        pending = []
+
+    def final(label):
+        seen = {label}
+        while label in targets and targets[label] not in seen:
+            label = targets[label]
+            seen.add(label)
+        return label
+    return {label: final(label) for label in targets}
+
+
+def thread_jumps(ast):
+    targets = jump_targets(ast)
+    out = []
+    for x in ast:
+        if not is_label(x) and x[0] in ('goto', 'branch') and x[1][0] == 'label':
+            dest = targets.get(x[1][1], x[1][1])
+            if dest != x[1][1]:
+                x = [x[0], ['label', dest]]
+        out.append(x)
+    return out
+
+
+def drop_fallthrough_gotos(ast):
+    "(goto (label x)) right before x:"
+    out = []
+    for i, x in enumerate(ast):
+        if not is_label(x) and jump_label(x) is not None:
+            j = i + 1
+            while j < len(ast) and is_label(ast[j]) and ast[j] != jump_label(x):
+                j += 1
+            if j < len(ast) and is_label(ast[j]):
+                continue
+        out.append(x)
+    return out
+
+
+def optimize(ast):
+    return drop_fallthrough_gotos(thread_jumps(drop_redundant_pairs(ast)))
@@ -0,0 +1,226 @@
+""" Register machine keeping its registers in one list
+
+A RegisterFileMachine holds the values of pc, flag and its registers
+in self.file, and its instructions read and write them at indices
+resolved when assembling, instead of through Register objects.
+Operations get their arguments straight from the file too, instead
+of calling a procedure for each. get_register() returns a view of a
+slot, so get_register(name).value works as with Machine.
+
+With optimize, the controller is rewritten by peephole.optimize, but
+its blocks aren't fused.
+"""
+__all__ = ['RegisterFileMachine']
+
+from operator import itemgetter
+
+from SICP.register_machine_simulator import peephole
+from SICP.register_machine_simulator.rms import Machine, StackOverflow, \
+    extract_labels, lookup_label, is_operation_exp
+
+PC = 0
+FLAG = 1
+
+
+class RegisterView:
+    "A slot of a register file, as a Register"
+    __slots__ = ('file', 'index')
+
+    def __init__(self, file, index):
+        self.file = file
+        self.index = index
+
+    @property
+    def value(self):
+        return self.file[self.index]
+
+    @value.setter
+    def value(self, value):
+        self.file[self.index] = value
+
+
+class RegisterFileMachine(Machine):
+    def __init__(self, register_names, ops, controller_text, optimize=False,
+                 stack=None):
+        self.file = []
+        super().__init__(register_names, ops, controller_text, optimize, stack)
+
+    def make_register(self, value=False):
+        self.file.append(value)
+        return RegisterView(self.file, len(self.file) - 1)
+
+    def assemble(self, controller_text, optimize):
+        return assemble(controller_text, self, optimize)
+
+    def index(self, name):
+        return self.get_register(name).index
+
+    def start(self):
+        insts = self.insts
+        file = self.file
+        end = len(insts)
+        while file[PC] < end:
+            insts[file[PC]].proc()
+
+
+def assemble(ast, machine, optimize=False):
+    if optimize:
+        ast = peephole.optimize(ast)
+    insts, labels = extract_labels(ast)
+    for inst in insts:
+        inst.proc = inst.step = make_exec_proc(inst.text, labels, machine,
+                                               machine.file, machine.stack,
+                                               machine.ops, inst.label)
+    return insts, labels
+
+
+def make_exec_proc(inst, labels, machine, file, stack, ops, label=None):
+    if inst[0] == 'assign':
+        return make_assign(inst, machine, labels, file, ops)
+    if inst[0] == 'test':
+        return make_test(inst, machine, labels, file, ops)
+    if inst[0] == 'branch':
+        return make_branch(inst, labels, file)
+    if inst[0] == 'goto':
+        return make_goto(inst, machine, labels, file)
+    if inst[0] == 'save':
+        return make_save(inst, machine, file, stack, label)
+    if inst[0] == 'restore':
+        return make_restore(inst, machine, file, stack)
+    if inst[0] == 'perform':
+        return make_perform(inst, machine, labels, file, ops)
+    raise ValueError("Unknown command: %s" % (inst[0],))
+
+
+def make_assign(inst, machine, labels, file, ops):
+    _, reg, *val = inst
+    target = machine.index(reg)
+    if is_operation_exp(val):
+        value_proc = make_operation_exp(val, machine, labels, file, ops)
+        def thunk():
+            file[target] = value_proc()
+            file[PC] += 1
+        return thunk
+    source, value = operand(val[0], machine, labels)
+    if source is None:
+        def thunk():
+            file[target] = value
+            file[PC] += 1
+    else:
+        def thunk():
+            file[target] = file[source]
+            file[PC] += 1
+    return thunk
+
+
+def make_test(inst, machine, labels, file, ops):
+    _, *cond = inst
+    if is_operation_exp(cond):
+        cond_proc = make_operation_exp(cond, machine, labels, file, ops)
+        def thunk():
+            file[FLAG] = cond_proc()
+            file[PC] += 1
+        return thunk
+    else:
+        raise ValueError("Bad Test expression: %s" % (cond,))
+
+
+def make_branch(inst, labels, file):
+    _, (tag, dest) = inst
+    if tag == 'label':
+        offset = lookup_label(labels, dest)
+        def thunk():
+            if file[FLAG]:
+                file[PC] = offset
+            else:
+                file[PC] += 1
+        return thunk
+    else:
+        raise ValueError("Bad BRANCH instruction: %s" % (inst,))
+
+
+def make_goto(inst, machine, labels, file):
+    _, (tag, val) = inst
+    if tag == 'label':
+        offset = lookup_label(labels, val)
+        def thunk(): file[PC] = offset
+        return thunk
+
+    elif tag == 'reg':
+        source = machine.index(val)
+        def thunk(): file[PC] = file[source]
+        return thunk
+
+    else:
+        raise ValueError("Bad Goto instruction: %s" % (inst,))
+
+
+def make_save(inst, machine, file, stack, label=None):
+    source = machine.index(inst[1])
+    def thunk():
+        try:
+            stack.push(file[source])
+        except StackOverflow as error:
+            error.locate(label, inst)
+            raise
+        file[PC] += 1
+    return thunk
+
+
+def make_restore(inst, machine, file, stack):
+    target = machine.index(inst[1])
+    def thunk():
+        file[target] = stack.pop()
+        file[PC] += 1
+    return thunk
+
+
+def make_perform(inst, machine, labels, file, ops):
+    _, *action = inst
+    if is_operation_exp(action):
+        action_proc = make_operation_exp(action, machine, labels, file, ops)
+        def thunk():
+            action_proc()
+            file[PC] += 1
+        return thunk
+    else:
+        raise ValueError("Bad PERFROM instruction %s" % (inst,))
+
+
+def operand(exp, machine, labels):
+    "(index, None) for a register, (None, value) for a constant or a label"
+    tag, val = exp
+    if tag == 'const':
+        return None, val
+    elif tag == 'label':
+        return None, lookup_label(labels, val)
+    elif tag == 'reg':
+        return machine.index(val), None
+    else:
+        raise ValueError('Unknown expression type %s' % (exp,))
+
+
+def make_operation_exp(exp, machine, labels, file, ops):
+    (_, op_name), *args = exp
+    op = ops[op_name]
+    operands = [operand(arg, machine, labels) for arg in args]
+    if not operands:
+        return op
+    if len(operands) == 1:
+        (i, a), = operands
+        if i is None:
+            return lambda: op(a)
+        return lambda: op(file[i])
+    if len(operands) == 2:
+        (i, a), (j, b) = operands
+        if i is None and j is None:
+            return lambda: op(a, b)
+        if i is None:
+            return lambda: op(a, file[j])
+        if j is None:
+            return lambda: op(file[i], b)
+        return lambda: op(file[i], file[j])
+    if all(i is not None for i, _ in operands):
+        fetch = itemgetter(*[i for i, _ in operands])
+        return lambda: op(*fetch(file))
+    return lambda: op(*[a if i is None else file[i] for i, a in operands])
@@ -1,40 +1,275 @@
+from collections import Counter, deque
+
+from SICP.register_machine_simulator import peephole
+
+
 class Machine:
-    def __init__(self, register_names, ops, controller_text):
-        self.pc = Register()
-        self.flag = Register()
-        self.stack = Stack()
-        self.ops = {'initialize': (lambda : self.stack.__init__())}
+    """Register machine running a controller. With optimize, an error
+    raised in a fused block leaves pc at the block's first instruction,
+    not at the failing one, unless the machine is monitored, which runs
+    the instructions one at a time.
+    """
+    def __init__(self, register_names, ops, controller_text, optimize=False,
+                 stack=None):
+        # pc holds an index into self.insts, labels are resolved to offsets
+        self.pc = self.make_register(0)
+        self.flag = self.make_register()
+        self.stack = Stack() if stack is None else stack
+        self.ops = {'initialize': (lambda : self.stack.initialize()),
+                    'initialize-stack': (lambda : self.stack.initialize()),
+                    'print-stack-statistics':
+                        (lambda : self.stack.print_statistics())}
         self.register_table = {'pc': self.pc, 'flag': self.flag}
 
         for name in register_names:
             self.allocate_register(name)
         for op_name, op_fn in ops:
             self.ops[op_name] = op_fn
-        self.pc.value = assemble(controller_text, self)
+        self.insts, self.labels = self.assemble(controller_text, optimize)
+        self.inst_counts = [0] * len(self.insts)
+        self.trace = deque(maxlen=0)
+
+    def make_register(self, value=False):
+        return Register(value)
+
+    def assemble(self, controller_text, optimize):
+        return assemble(controller_text, self, optimize)
 
     def allocate_register(self, name):
         if name in self.register_table:
             raise NameError('Regiser already exists')
-        self.register_table[name] = Register()
+        self.register_table[name] = self.make_register()
 
     def get_register(self, name):
         return self.register_table[name]
 
+    def reset(self):
+        "Registers as allocated, pc at the first instruction, an empty stack"
+        for register in self.register_table.values():
+            register.value = False
+        self.pc.value = 0
+        self.stack.initialize()
+
     def start(self):
-        while True:
-            insts = self.pc.value
-            if not insts: return
-            insts[0].proc()
+        insts = self.insts
+        pc = self.pc
+        end = len(insts)
+        while pc.value < end:
+            insts[pc.value].proc()
+
+    def monitor(self, trace=0):
+        """Counts executed instructions and stack pushes from now on,
+        and keeps the offsets of the last `trace` instructions executed.
+
+        The counting loop and push replace start and stack.push on the
+        instances, so an unmonitored machine runs exactly as before.
+        The loop runs one instruction at a time, the fused blocks of an
+        optimized machine too, so every instruction is counted.
+        """
+        self.inst_counts = [0] * len(self.insts)
+        self.trace = deque(maxlen=trace)
+        self.start = self.run_traced if trace else self.run_counted
+        self.stack.monitor()
+
+    def unmonitor(self):
+        self.__dict__.pop('start', None)
+        self.stack.unmonitor()
+
+    def run_counted(self):
+        insts = self.insts
+        counts = self.inst_counts
+        pc = self.pc
+        end = len(insts)
+        while pc.value < end:
+            offset = pc.value
+            counts[offset] += 1
+            insts[offset].step()
+
+    def run_traced(self):
+        insts = self.insts
+        counts = self.inst_counts
+        record = self.trace.append
+        pc = self.pc
+        end = len(insts)
+        while pc.value < end:
+            offset = pc.value
+            counts[offset] += 1
+            record(offset)
+            insts[offset].step()
+
+    @property
+    def instruction_count(self):
+        return sum(self.inst_counts)
+
+    def inst_histogram(self):
+        "Counter of executed instructions by their text"
+        histogram = Counter()
+        for inst, count in zip(self.insts, self.inst_counts):
+            if count:
+                histogram[inst_text(inst.text)] += count
+        return histogram
+
+    def label_histogram(self):
+        "Counter of executed instructions by the label they follow"
+        histogram = Counter()
+        for inst, count in zip(self.insts, self.inst_counts):
+            if count:
+                histogram[inst.label] += count
+        return histogram
+
+    def traced(self):
+        "(label, instruction text) of the traced instructions, oldest first"
+        return [(self.insts[offset].label, inst_text(self.insts[offset].text))
+                for offset in self.trace]
+
+    def statistics(self):
+        return dict(self.stack.statistics(),
+                    instructions=self.instruction_count)
+
+
+class StackOverflow(RuntimeError):
+    "A save on a stack holding its limit of values"
+    def __init__(self, limit, label=None, inst=None):
+        super().__init__(limit, label, inst)
+        self.limit = limit
+        self.label = label
+        self.inst = inst
+
+    def locate(self, label, inst):
+        self.label = label
+        self.inst = inst
+
+    def __str__(self):
+        message = 'Stack overflow: limit of %d values' % self.limit
+        if self.inst is not None:
+            message += ' reached by %s' % inst_text(self.inst)
+            if self.label is not None:
+                message += ' after %s' % self.label
+        return message
 
 
 class Stack:
-    def __init__(self):
+    """Values pushed and popped, at most limit of them, any number
+    when it is None
+    """
+    monitoring = False
+
+    def __init__(self, limit=None):
         self.values = []
+        self.limit = limit
+        self.pushes = 0
+        self.max_depth = 0
+        if limit is not None:
+            self.push = self.bounded_push
+
     def push(self, value):
         self.values.append(value)
+
+    def bounded_push(self, value):
+        if len(self.values) >= self.limit:
+            raise StackOverflow(self.limit)
+        self.values.append(value)
+
     def pop(self):
         return self.values.pop()
 
+    def counting_push(self, value):
+        if self.limit is None:
+            self.values.append(value)
+        else:
+            self.bounded_push(value)
+        self.pushes += 1
+        if len(self.values) > self.max_depth:
+            self.max_depth = len(self.values)
+
+    def monitor(self):
+        self.push = self.counting_push
+        self.monitoring = True
+
+    def unmonitor(self):
+        self.__dict__.pop('push', None)
+        self.monitoring = False
+        if self.limit is not None:
+            self.push = self.bounded_push
+
+    def initialize(self):
+        "Empties the stack, keeping its list, and resets the statistics"
+        self.values.clear()
+        self.pushes = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return len(self.values)
+
+    def statistics(self):
+        """Pushes and maximum depth since the last initialize, counted
+        only while monitoring
+        """
+        return {'pushes': self.pushes, 'max_depth': self.max_depth,
+                'depth': self.depth}
+
+    def print_statistics(self):
+        if not self.monitoring:
+            print('(stack statistics are counted only while monitoring)')
+            return
+        print('(total-pushes = %d maximum-depth = %d)'
+              % (self.pushes, self.max_depth))
+
+
+class ArrayStack(Stack):
+    """Stack of at most limit values, kept in a list allocated once,
+    so a machine running again and again doesn't grow and shrink it
+    """
+    def __init__(self, limit):
+        self.slots = [None] * limit
+        self.top = 0
+        self.limit = limit
+        self.pushes = 0
+        self.max_depth = 0
+
+    def push(self, value):
+        top = self.top
+        if top == self.limit:
+            raise StackOverflow(self.limit)
+        self.slots[top] = value
+        self.top = top + 1
+
+    bounded_push = push
+
+    def pop(self):
+        top = self.top - 1
+        if top < 0:
+            raise IndexError('pop from empty stack')
+        value = self.slots[top]
+        # popped values aren't kept alive
+        self.slots[top] = None
+        self.top = top
+        return value
+
+    def counting_push(self, value):
+        ArrayStack.push(self, value)
+        self.pushes += 1
+        if self.top > self.max_depth:
+            self.max_depth = self.top
+
+    def initialize(self):
+        slots = self.slots
+        for i in range(self.top):
+            slots[i] = None
+        self.top = 0
+        self.pushes = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return self.top
+
+    @property
+    def values(self):
+        "The values on the stack, bottom first, as a new list"
+        return self.slots[:self.top]
+
 
 class Register:
     def __init__(self, value=False):
@@ -42,36 +277,247 @@ class Register:
 
 
 class Inst:
-    "Instruction"
-    def __init__(self, text, proc=False):
+    """Instruction, and the label it follows. proc runs it, or the
+    block it starts once fused, step runs just the instruction.
+    """
+    def __init__(self, text, proc=False, label=None):
         self.text = text
-        self.proc = proc
+        self.proc = self.step = proc
+        self.label = label
 
 
-def extract_labels(ast):
-    def remove_labels(xs):
-        return [x for x in xs if not isinstance(x, str)]
+def inst_text(text):
+    "Instruction text as in the controller"
+    if isinstance(text, (list, tuple)):
+        return '(%s)' % ' '.join(inst_text(x) for x in text)
+    return str(text)
 
-    insts = [(x if isinstance(x, str) else Inst(x)) for x in ast]
-    labels = {}
-    for i, inst in enumerate(insts):
-        if isinstance(inst, str):
-            labels[inst] = remove_labels(insts[i + 1:])
-    return remove_labels(insts), labels
 
-
-def assemble(ast, machine):
+def extract_labels(ast):
+    """Returns instructions and a table mapping each label
+    to the offset of the instruction that follows it
+    """
+    insts = []
+    labels = {}
+    label = None
+    for x in ast:
+        if isinstance(x, str):
+            if x in labels:
+                raise ValueError("Duplicate label: %s" % (x,))
+            labels[x] = len(insts)
+            label = x
+        else:
+            insts.append(Inst(x, label=label))
+    return insts, labels
+
+
+def lookup_label(labels, name):
+    try:
+        return labels[name]
+    except KeyError:
+        raise ValueError("Undefined label: %s" % (name,))
+
+
+def assemble(ast, machine, optimize=False):
+    """Instructions and label table of a controller. With optimize,
+    the controller is rewritten by peephole.optimize, and the
+    instructions control can enter at run their whole basic block.
+    """
+    if optimize:
+        ast = peephole.optimize(ast)
     insts, labels = extract_labels(ast)
     pc = machine.get_register("pc")
     flag = machine.get_register("flag")
     stack = machine.stack
     ops = machine.ops
     for inst in insts:
-        inst.proc = make_exec_proc(inst.text, labels, machine, pc, flag, stack, ops)
-    return insts
+        inst.proc = inst.step = make_exec_proc(inst.text, labels, machine, pc, flag,
+                                               stack, ops, inst.label)
+    if optimize:
+        fuse_blocks(insts, labels, machine, pc, flag, stack, ops)
+    return insts, labels
+
+
+def fuse_blocks(insts, labels, machine, pc, flag, stack, ops):
+    """Gives the first instruction, and those following a label or a
+    goto, a procedure running the instructions up to the next of them.
+    The others keep their own, though control only reaches them
+    while monitoring, which runs each instruction's step.
+    """
+    labelled = set(labels.values())
+    for start in entry_points(insts, labels):
+        end = start + 1
+        while (end < len(insts) and end not in labelled
+               and insts[end - 1].text[0] != 'goto'):
+            end += 1
+        texts = [inst.text for inst in insts[start:end]]
+        insts[start].proc = make_block(texts, end, labels, machine, pc, flag, stack, ops,
+                                       insts[start].label)
+
+
+def entry_points(insts, labels):
+    "Sorted offsets of the instructions control can enter at"
+    entries = {0} | set(labels.values()) | {i + 1 for i, inst in enumerate(insts)
+                                            if inst.text[0] == 'goto'}
+    return sorted(i for i in entries if i < len(insts))
+
+
+def make_block(texts, after, labels, machine, pc, flag, stack, ops, label=None):
+    """One procedure for the instructions of a basic block: the actions
+    before its first jump, then the jump, which runs the rest of the
+    block when it isn't taken. A test followed by a branch, an assign
+    followed by a goto, and runs of saves and restores are fused.
+    All of them follow label.
+    """
+    actions = []
+    i = 0
+    while i < len(texts):
+        cmd = texts[i][0]
+        following = texts[i + 1][0] if i + 1 < len(texts) else None
+        if cmd in ('test', 'branch'):
+            if cmd == 'test' and following != 'branch':
+                actions.append(make_action(texts[i], labels, machine, ops, flag))
+                i += 1
+                continue
+            if cmd == 'test':
+                cond_proc = test_condition(texts[i], machine, labels, ops)
+                i += 1
+            else:
+                cond_proc = None
+            offset = branch_offset(texts[i], labels)
+            rest = make_block(texts[i + 1:], after, labels, machine, pc,
+                              flag, stack, ops, label)
+            return make_sequence(actions, make_branch_exit(cond_proc, offset,
+                                                           rest, flag, pc))
+        if cmd == 'assign' and following == 'goto':
+            return make_sequence(actions, make_assign_goto(
+                texts[i], texts[i + 1], labels, machine, ops, pc))
+        if cmd == 'goto':
+            return make_sequence(actions, make_goto(texts[i], machine, labels, pc))
+        if cmd in ('save', 'restore'):
+            j = i
+            while j < len(texts) and texts[j][0] in ('save', 'restore'):
+                j += 1
+            actions.append(make_stack_action(texts[i:j], machine, stack, label))
+            i = j
+        else:
+            actions.append(make_action(texts[i], labels, machine, ops, flag))
+            i += 1
+
+    def fall_through():
+        pc.value = after
+    return make_sequence(actions, fall_through)
+
+
+def make_sequence(actions, exit):
+    if not actions:
+        return exit
+    if len(actions) == 1:
+        first, = actions
+        def thunk():
+            first()
+            exit()
+    elif len(actions) == 2:
+        first, second = actions
+        def thunk():
+            first()
+            second()
+            exit()
+    else:
+        def thunk():
+            for action in actions:
+                action()
+            exit()
+    return thunk
+
+
+def make_action(inst, labels, machine, ops, flag):
+    "An assign, test or perform, leaving pc alone"
+    if inst[0] == 'assign':
+        target, value_proc = assign_parts(inst, machine, labels, ops)
+        def action():
+            target.value = value_proc()
+        return action
+    if inst[0] == 'test':
+        cond_proc = test_condition(inst, machine, labels, ops)
+        def action():
+            flag.value = cond_proc()
+        return action
+    if inst[0] == 'perform':
+        return perform_action(inst, machine, labels, ops)
+    raise ValueError("Unknown command: %s" % (inst[0],))
+
+
+def make_branch_exit(cond_proc, offset, rest, flag, pc):
+    "A branch, preceded by its test unless cond_proc is None"
+    if cond_proc is None:
+        def thunk():
+            if flag.value:
+                pc.value = offset
+            else:
+                rest()
+    else:
+        def thunk():
+            flag.value = cond = cond_proc()
+            if cond:
+                pc.value = offset
+            else:
+                rest()
+    return thunk
 
 
-def make_exec_proc(inst, labels, machine, pc, flag, stack, ops):
+def make_assign_goto(assign, goto, labels, machine, ops, pc):
+    target, value_proc = assign_parts(assign, machine, labels, ops)
+    _, (tag, val) = goto
+    if tag == 'label':
+        offset = lookup_label(labels, val)
+        def thunk():
+            target.value = value_proc()
+            pc.value = offset
+        return thunk
+    elif tag == 'reg':
+        reg = machine.get_register(val)
+        def thunk():
+            target.value = value_proc()
+            pc.value = reg.value
+        return thunk
+    else:
+        raise ValueError("Bad Goto instruction: %s" % (goto,))
+
+
+def make_stack_action(insts, machine, stack, label=None):
+    "A run of saves and restores"
+    regs = [machine.get_register(inst[1]) for inst in insts]
+    if all(inst[0] == 'save' for inst in insts):
+        def action():
+            push = stack.push
+            for inst, reg in zip(insts, regs):
+                try:
+                    push(reg.value)
+                except StackOverflow as error:
+                    error.locate(label, inst)
+                    raise
+    elif all(inst[0] == 'restore' for inst in insts):
+        def action():
+            pop = stack.pop
+            for reg in regs:
+                reg.value = pop()
+    else:
+        saves = [inst[0] == 'save' for inst in insts]
+        def action():
+            for save, inst, reg in zip(saves, insts, regs):
+                if save:
+                    try:
+                        stack.push(reg.value)
+                    except StackOverflow as error:
+                        error.locate(label, inst)
+                        raise
+                else:
+                    reg.value = stack.pop()
+    return action
+
+
+def make_exec_proc(inst, labels, machine, pc, flag, stack, ops, label=None):
     if inst[0] == 'assign':
         return make_assign(inst, machine, labels, ops, pc)
     if inst[0] == 'test':
@@ -81,57 +527,71 @@ def make_exec_proc(inst, labels, machine, pc, flag, stack, ops):
     if inst[0] == 'goto':
         return make_goto(inst, machine, labels, pc)
     if inst[0] == 'save':
-        return make_save(inst, machine, stack, pc)
+        return make_save(inst, machine, stack, pc, label)
     if inst[0] == 'restore':
         return make_restore(inst, machine, stack, pc)
     if inst[0] == 'perform':
         return make_perform(inst, machine, labels, ops, pc)
-    raise ValueError("Unknown command: %s" % (command,))
+    raise ValueError("Unknown command: %s" % (inst[0],))
 
 
-def make_assign(inst, machine, labels, ops, pc):
+def assign_parts(inst, machine, labels, ops):
+    "Target register and value procedure of an assign"
     _, reg, *val = inst
     target = machine.get_register(reg)
     value_proc = make_operation_exp(val, machine, labels, ops) \
                  if is_operation_exp(val) \
                     else make_primitive_exp(val[0], machine, labels)
+    return target, value_proc
+
+
+def make_assign(inst, machine, labels, ops, pc):
+    target, value_proc = assign_parts(inst, machine, labels, ops)
     def thunk():
         target.value = value_proc()
-        pc.value = pc.value[1:]
+        pc.value += 1
     return thunk
 
 
-def make_test(inst, machine, labels, ops, flag, pc):
+def test_condition(inst, machine, labels, ops):
     _, *cond = inst
     if is_operation_exp(cond):
-        cond_proc = make_operation_exp(cond, machine, labels, ops)
-        def thunk():
-            flag.value = cond_proc()
-            pc.value = pc.value[1:]
-        return thunk
+        return make_operation_exp(cond, machine, labels, ops)
     else:
         raise ValueError("Bad Test expression: %s" % (cond,))
 
 
-def make_branch(inst, machine, labels, flag, pc):
+def make_test(inst, machine, labels, ops, flag, pc):
+    cond_proc = test_condition(inst, machine, labels, ops)
+    def thunk():
+        flag.value = cond_proc()
+        pc.value += 1
+    return thunk
+
+
+def branch_offset(inst, labels):
     _, (tag, dest) = inst
     if tag == 'label':
-        insts = labels[dest]
-        def thunk():
-            if flag.value:
-                pc.value = insts
-            else:
-                pc.value = pc.value[1:]
-        return thunk
+        return lookup_label(labels, dest)
     else:
         raise ValueError("Bad BRANCH instruction: %s" % (inst,))
 
 
+def make_branch(inst, machine, labels, flag, pc):
+    offset = branch_offset(inst, labels)
+    def thunk():
+        if flag.value:
+            pc.value = offset
+        else:
+            pc.value += 1
+    return thunk
+
+
 def make_goto(inst, machine, labels, pc):
     _, (tag, val) = inst
     if tag == 'label':
-        insts = labels[val]
-        def thunk(): pc.value = insts
+        offset = lookup_label(labels, val)
+        def thunk(): pc.value = offset
         return thunk
 
     elif tag == 'reg':
@@ -143,11 +603,15 @@ def make_goto(inst, machine, labels, pc):
         raise ValueError("Bad Goto instruction: %s" % (inst,))
 
 
-def make_save(inst, machine, stack, pc):
+def make_save(inst, machine, stack, pc, label=None):
     reg = machine.get_register(inst[1])
     def thunk():
-        stack.push(reg.value)
-        pc.value = pc.value[1:]
+        try:
+            stack.push(reg.value)
+        except StackOverflow as error:
+            error.locate(label, inst)
+            raise
+        pc.value += 1
     return thunk
 
 
@@ -155,29 +619,33 @@ def make_restore(inst, machine, stack, pc):
     reg = machine.get_register(inst[1])
     def thunk():
         reg.value = stack.pop()
-        pc.value = pc.value[1:]
+        pc.value += 1
     return thunk
 
 
-def make_perform(inst, machine, lables, ops, pc):
+def perform_action(inst, machine, labels, ops):
     _, *action = inst
     if is_operation_exp(action):
-        action_proc = make_operation_exp(action, machine, labels, ops)
-        def thunk():
-            action_proc()
-            pc.value = pc.value[1:]
-        return thunk
+        return make_operation_exp(action, machine, labels, ops)
     else:
         raise ValueError("Bad PERFROM instruction %s" % (inst,))
 
 
+def make_perform(inst, machine, labels, ops, pc):
+    action_proc = perform_action(inst, machine, labels, ops)
+    def thunk():
+        action_proc()
+        pc.value += 1
+    return thunk
+
+
 def make_primitive_exp(exp, machine, labels):
     tag, val = exp
     if tag == 'const':
         return lambda: val
     elif tag == 'label':
-        insts = labels[val]
-        return lambda: insts
+        offset = lookup_label(labels, val)
+        return lambda: offset
     elif tag == 'reg':
         reg = machine.get_register(val)
         return lambda: reg.value
@@ -1,9 +1,60 @@
+import io
+import math
+import operator
+import pickle
 import unittest
-from SICP.lisp_parser.lp import parse
+from contextlib import redirect_stdout
+from SICP.lisp_parser.lp import parse, parse_tree
 from SICP.register_machine_simulator.rms import *
+from SICP.register_machine_simulator.peephole import optimize
+from SICP.register_machine_simulator.codegen import CompiledMachine, to_python
+from SICP.register_machine_simulator.batch import Program, run_batch
+from SICP.register_machine_simulator.regfile import RegisterFileMachine
+
+
+FIB_CODE = """
+(fib-start
+  (assign continue (label fib-done))
+fib-loop
+  (test (op <) (reg n) (const 2))
+  (branch (label immediate-answer))
+  (save continue)
+  (assign continue (label afterfib-n-1))
+  (save n)
+  (assign n (op -) (reg n) (const 1))
+  (goto (label fib-loop))
+afterfib-n-1
+  (restore n)
+  (restore continue)
+  (assign n (op -) (reg n) (const 2))
+  (save continue)
+  (assign continue (label afterfib-n-2))
+  (save val)
+  (goto (label fib-loop))
+afterfib-n-2
+  (assign n (reg val))
+  (restore val)
+  (restore continue)
+  (assign val (op +) (reg val) (reg n))
+  (goto (reg continue))
+immediate-answer
+  (assign val (reg n))
+  (goto (reg continue))
+fib-done)
+"""
+
+
+def fib_machine(optimize=False, machine_class=Machine, stack=None):
+    return machine_class(['n', 'val', 'continue'],
+                         [('<', lambda a, b: a < b),
+                          ('-', lambda a, b: a - b),
+                          ('+', lambda a, b: a + b)],
+                         parse(FIB_CODE), optimize, stack)
 
 
 class RMSTest(unittest.TestCase):
+    Machine = Machine
+
     def test_gcd(self):
         code = """
         (test-b
@@ -15,10 +66,10 @@ class RMSTest(unittest.TestCase):
           (goto (label test-b))
         gcd-done)
         """
-        m = Machine(["a", "b", "t"],
-                    [("rem", lambda x, y: x % y),
-                     ("=", lambda x, y: x == y)],
-                    parse(code))
+        m = self.Machine(["a", "b", "t"],
+                         [("rem", lambda x, y: x % y),
+                          ("=", lambda x, y: x == y)],
+                         parse(code))
         m.get_register('a').value = 206
         m.get_register('b').value = 40
         m.start()
@@ -56,15 +107,482 @@ class RMSTest(unittest.TestCase):
           (goto (reg continue))
         fib-done)
         """
-        m = Machine(['n', 'val', 'continue'],
-                    [('<', lambda a, b: a < b),
-                     ('-', lambda a, b: a - b),
-                     ('+', lambda a, b: a + b)],
-                    parse(code))
+        m = self.Machine(['n', 'val', 'continue'],
+                         [('<', lambda a, b: a < b),
+                          ('-', lambda a, b: a - b),
+                          ('+', lambda a, b: a + b)],
+                         parse(code))
+        m.get_register('n').value = 10
+        m.start()
+        self.assertEqual(m.get_register('val').value, 55)
+
+    def test_label_offsets(self):
+        code = """
+        (start
+          (assign continue (label here))
+          (goto (reg continue))
+          (assign x (const 1))
+        here
+          (assign y (const 2)))
+        """
+        m = self.Machine(['x', 'y', 'continue'], [], parse(code))
+        m.start()
+        self.assertEqual(m.get_register('continue').value, 3)
+        self.assertEqual(m.get_register('x').value, False)
+        self.assertEqual(m.get_register('y').value, 2)
+        self.assertEqual(m.pc.value, len(m.insts))
+
+    def test_tuple_controller(self):
+        code = """
+        (test-b
+          (test (op =) (reg b) (const 0))
+          (branch (label gcd-done))
+          (assign t (op rem) (reg a) (reg b))
+          (assign a (reg b))
+          (assign b (reg t))
+          (goto (label test-b))
+        gcd-done)
+        """
+        m = self.Machine(["a", "b", "t"],
+                         [("rem", lambda x, y: x % y),
+                          ("=", lambda x, y: x == y)],
+                         parse_tree(code).forms[0])
+        m.get_register('a').value = 206
+        m.get_register('b').value = 40
+        m.start()
+        self.assertEqual(m.get_register('a').value, 2)
+
+    def test_float_constants(self):
+        code = parse("(start (assign x (const 1e999)) (assign y (const 0)))")
+        # the reader has no nan, it is put in the controller text
+        code[2][2][1] = float('nan')
+        m = self.Machine(['x', 'y'], [], code)
+        m.start()
+        self.assertEqual(m.get_register('x').value, math.inf)
+        self.assertTrue(math.isnan(m.get_register('y').value))
+
+    def test_statistics(self):
+        m = fib_machine(machine_class=self.Machine)
+        m.get_register('n').value = 10
+        m.monitor()
+        m.start()
+        self.assertEqual(m.get_register('val').value, 55)
+        # 4 saves and 19 instructions for each of the 88 calls with n >= 2,
+        # 4 instructions for each of the 89 others, 2 saves per level
+        self.assertEqual(m.statistics(),
+                         {'pushes': 352, 'max_depth': 18, 'depth': 0,
+                          'instructions': 1 + 88 * 19 + 89 * 4})
+        labels = m.label_histogram()
+        self.assertEqual(labels['fib-start'], 1)
+        self.assertEqual(labels['immediate-answer'], 89 * 2)
+        self.assertEqual(sum(labels.values()), m.instruction_count)
+        self.assertEqual(m.inst_histogram()['(save continue)'], 88 * 2)
+
+        m.stack.initialize()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            m.stack.print_statistics()
+        self.assertEqual(out.getvalue(), '(total-pushes = 0 maximum-depth = 0)\n')
+
+    def test_unmonitored(self):
+        m = fib_machine(machine_class=self.Machine)
+        m.get_register('n').value = 10
+        m.monitor()
+        m.unmonitor()
+        m.start()
+        self.assertEqual(m.get_register('val').value, 55)
+        self.assertEqual(m.instruction_count, 0)
+        self.assertEqual(m.stack.pushes, 0)
+        self.assertEqual(m.start.__func__, self.Machine.start)
+
+        m = fib_machine(machine_class=self.Machine)
+        m.get_register('n').value = 10
+        m.start()
+        self.assertEqual(m.statistics(),
+                         {'pushes': 0, 'max_depth': 0, 'depth': 0,
+                          'instructions': 0})
+        self.assertEqual(m.inst_histogram(), {})
+        self.assertEqual(m.label_histogram(), {})
+        self.assertEqual(m.traced(), [])
+        out = io.StringIO()
+        with redirect_stdout(out):
+            m.stack.print_statistics()
+        self.assertEqual(out.getvalue(),
+                         '(stack statistics are counted only while monitoring)\n')
+
+    def test_trace(self):
+        m = fib_machine(machine_class=self.Machine)
+        m.get_register('n').value = 10
+        m.monitor(trace=3)
+        m.start()
+        self.assertEqual(m.traced(), [
+            ('afterfib-n-2', '(restore continue)'),
+            ('afterfib-n-2', '(assign val (op +) (reg val) (reg n))'),
+            ('afterfib-n-2', '(goto (reg continue))')])
+
+    def test_stack_ops(self):
+        code = """
+        (start
+          (perform (op initialize-stack))
+          (save x)
+          (save x)
+          (restore x)
+          (perform (op print-stack-statistics)))
+        """
+        m = self.Machine(['x'], [], parse(code))
+        m.monitor()
+        out = io.StringIO()
+        with redirect_stdout(out):
+            m.start()
+        self.assertEqual(out.getvalue(), '(total-pushes = 2 maximum-depth = 2)\n')
+        self.assertEqual(m.stack.depth, 1)
+
+    def test_enter_anywhere(self):
+        code = """
+        (start
+          (assign y (op +) (reg x) (reg pc))
+          (test (op >) (reg y) (const 2))
+          (branch (label done))
+          (assign y (op +) (reg x) (reg pc))
+          (goto (reg continue))
+        done)
+        """
+        m = self.Machine(['x', 'y', 'continue'],
+                         [('+', lambda a, b: a + b), ('>', lambda a, b: a > b)],
+                         parse(code))
+        m.get_register('x').value = 0
+        m.get_register('continue').value = 1
+        m.start()
+        self.assertEqual(m.get_register('y').value, 3)
+        self.assertEqual(m.pc.value, 5)
+        m.get_register('x').value = 5
+        m.pc.value = 3
+        m.start()
+        self.assertEqual(m.get_register('y').value, 8)
+        self.assertEqual(m.pc.value, 5)
+
+    def test_error(self):
+        code = """
+        (start
+          (assign x (const 1))
+          (save x)
+          (assign y (op /) (reg x) (reg z)))
+        """
+        m = self.Machine(['x', 'y', 'z'], [('/', lambda a, b: a / b)],
+                         parse(code))
+        m.get_register('z').value = 0
+        with self.assertRaises(ZeroDivisionError):
+            m.start()
+        self.assertEqual(m.get_register('x').value, 1)
+        self.assertEqual(m.stack.values, [1])
+        # pc is left at the failing instruction, starting again resumes there
+        self.assertEqual(m.pc.value, 2)
+        m.get_register('z').value = 2
+        m.start()
+        self.assertEqual(m.get_register('y').value, 0.5)
+        self.assertEqual(m.stack.values, [1])
+        self.assertEqual(m.pc.value, 3)
+
+    def test_stack_limit(self):
+        for optimize in (False, True):
+            for stack in (Stack(limit=10), ArrayStack(10)):
+                m = fib_machine(optimize, self.Machine, stack)
+                m.get_register('n').value = 5
+                m.start()
+                self.assertEqual(m.get_register('val').value, 5)
+                self.assertEqual(m.stack.depth, 0)
+
+                m.reset()
+                m.get_register('n').value = 10
+                with self.assertRaises(StackOverflow) as raised:
+                    m.start()
+                error = raised.exception
+                self.assertEqual((error.limit, error.label), (10, 'fib-loop'))
+                # 2 saves per level, n is 5 when the 11th value is saved
+                self.assertEqual(inst_text(error.inst), '(save continue)')
+                self.assertEqual(m.get_register('n').value, 5)
+                self.assertEqual(str(error), 'Stack overflow: limit of 10 values'
+                                 ' reached by (save continue) after fib-loop')
+                self.assertEqual(m.stack.depth, 10)
+                if optimize and self.Machine is Machine:
+                    # the fused block after fib-loop
+                    self.assertEqual(m.pc.value, m.labels['fib-loop'])
+                else:
+                    self.assertEqual(m.insts[m.pc.value].text, error.inst)
+
+    def test_bad_labels(self):
+        with self.assertRaisesRegex(ValueError, "Duplicate label: a"):
+            self.Machine([], [], parse("(a (goto (label a)) a)"))
+        with self.assertRaisesRegex(ValueError, "Undefined label: b"):
+            self.Machine([], [], parse("(a (goto (label b)))"))
+
+
+class OptimizeTest(unittest.TestCase):
+    def test_redundant_pairs(self):
+        self.assertEqual(optimize(parse("""
+        (start
+          (save a) (save b) (restore b) (restore a)
+          (save a) (restore b)
+          (save a)
+        here
+          (restore a))
+        """)), parse("""
+        (start
+          (assign b (reg a))
+          (save a)
+        here
+          (restore a))
+        """))
+
+    def test_thread_jumps(self):
+        self.assertEqual(optimize(parse("""
+        (start
+          (branch (label a))
+          (goto (label b))
+          (assign x (const 1))
+        a
+        b
+          (goto (label c))
+        c
+          (goto (label done))
+          (assign x (const 2))
+        done)
+        """)), parse("""
+        (start
+          (branch (label done))
+          (goto (label done))
+          (assign x (const 1))
+        a
+        b
+          (goto (label done))
+        c
+          (goto (label done))
+          (assign x (const 2))
+        done)
+        """))
+
+    def test_goto_cycle(self):
+        code = parse("(a (goto (label b)) b (goto (label a)))")
+        self.assertEqual(optimize(code),
+                         parse("(a (goto (label a)) b (goto (label b)))"))
+
+    def test_fib(self):
+        m = fib_machine(optimize=True)
+        m.get_register('n').value = 10
+        m.monitor()
+        m.start()
+        self.assertEqual(m.get_register('val').value, 55)
+        self.assertEqual(m.stack.pushes, 352)
+        # monitoring runs the instructions of the fused blocks one by one
+        self.assertEqual(m.instruction_count, 1 + 88 * 19 + 89 * 4)
+        plain = fib_machine()
+        plain.get_register('n').value = 10
+        plain.monitor()
+        plain.start()
+        self.assertEqual(m.inst_histogram(), plain.inst_histogram())
+        m.unmonitor()
+        m.start()
+        self.assertEqual(m.get_register('val').value, 55)
+
+    def test_blocks(self):
+        code = """
+        (start
+          (assign x (const 0))
+        loop
+          (test (op =) (reg n) (const 0))
+          (branch (label done))
+          (save n)
+          (save x)
+          (restore t)
+          (restore n)
+          (perform (op log) (reg t))
+          (assign x (op +) (reg x) (const 1))
+          (assign n (op -) (reg n) (const 1))
+          (test (op =) (reg x) (const 2))
+          (branch (label twice))
+          (goto (label loop))
+        twice
+          (assign x (const 10))
+          (assign continue (label loop))
+          (goto (reg continue))
+        done)
+        """
+        results = []
+        for machine_class, optimize in ((Machine, False), (Machine, True),
+                                        (CompiledMachine, True)):
+            logged = []
+            m = machine_class(['x', 'n', 't', 'continue'],
+                              [('=', lambda a, b: a == b), ('+', lambda a, b: a + b),
+                               ('-', lambda a, b: a - b), ('log', logged.append)],
+                              parse(code), optimize)
+            m.get_register('n').value = 5
+            m.start()
+            self.assertEqual(m.pc.value, len(m.insts))
+            results.append((logged, m.get_register('x').value, m.flag.value,
+                            m.stack.values))
+        self.assertEqual(results[0], ([0, 1, 10, 11, 12], 13, True, []))
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+    def test_overflow_in_run(self):
+        code = "(start (save x) (save y) (save x))"
+        m = Machine(['x', 'y'], [], parse(code), True, Stack(limit=2))
+        with self.assertRaises(StackOverflow) as raised:
+            m.start()
+        # the second (save x) overflows, not the first
+        self.assertIs(raised.exception.inst, m.insts[2].text)
+        self.assertEqual(raised.exception.label, 'start')
+        self.assertEqual(m.pc.value, 0)
+
+        m.reset()
+        m.monitor()
+        with self.assertRaises(StackOverflow):
+            m.start()
+        self.assertEqual(m.pc.value, 2)
+
+
+class CompiledTest(RMSTest):
+    "The tests of RMSTest, run by compiled machines"
+    Machine = CompiledMachine
+
+    def test_registers_are_locals(self):
+        source = to_python(fib_machine())
+        self.assertIn('r1 = op2(r1, r0)', source)
+        self.assertIn('pc = r2', source)
+        self.assertNotIn('.value', source.split('try:')[1].split('finally:')[0])
+
+
+class RegisterFileTest(RMSTest):
+    "The tests of RMSTest, run with a register file"
+    Machine = RegisterFileMachine
+
+    def test_file(self):
+        m = fib_machine(machine_class=self.Machine)
+        self.assertEqual(m.file, [0, False, False, False, False])
         m.get_register('n').value = 10
         m.start()
+        self.assertEqual(m.file, [22, True, 21, 55, 22])
         self.assertEqual(m.get_register('val').value, 55)
 
+    def test_operands(self):
+        code = """
+        (start
+          (assign x (op list))
+          (assign x (op list) (const 1))
+          (assign y (op list) (reg x) (label done) (reg x))
+          (assign z (op list) (reg x) (reg y) (reg pc))
+        done)
+        """
+        m = self.Machine(['x', 'y', 'z'], [('list', lambda *args: list(args))],
+                         parse(code))
+        m.start()
+        self.assertEqual(m.get_register('y').value, [[1], 4, [1]])
+        self.assertEqual(m.get_register('z').value, [[1], [[1], 4, [1]], 3])
+
+
+class StackTest(unittest.TestCase):
+    def check(self, stack):
+        for i in range(3):
+            stack.push(i)
+        self.assertEqual(stack.values, [0, 1, 2])
+        with self.assertRaisesRegex(StackOverflow, 'limit of 3 values$'):
+            stack.push(3)
+        self.assertEqual(stack.pop(), 2)
+        stack.monitor()
+        stack.push(5)
+        with self.assertRaises(StackOverflow):
+            stack.push(6)
+        stack.unmonitor()
+        with self.assertRaises(StackOverflow):
+            stack.push(6)
+        self.assertEqual(stack.statistics(), {'pushes': 1, 'max_depth': 3, 'depth': 3})
+        stack.initialize()
+        self.assertEqual((stack.values, stack.depth, stack.pushes), ([], 0, 0))
+        with self.assertRaises(IndexError):
+            stack.pop()
+
+    def test_stack(self):
+        stack = Stack(limit=3)
+        values = stack.values
+        self.check(stack)
+        # initialize empties the list in place
+        self.assertIs(stack.values, values)
+
+    def test_array_stack(self):
+        stack = ArrayStack(3)
+        slots = stack.slots
+        self.check(stack)
+        self.assertIs(stack.slots, slots)
+        self.assertEqual(slots, [None] * 3)
+
+    def test_initialize_in_place(self):
+        m = fib_machine()
+        values = m.stack.values
+        m.ops['initialize']()
+        m.ops['initialize-stack']()
+        m.reset()
+        self.assertIs(m.stack.values, values)
+
+
+GCD_CODE = """
+(test-b
+  (test (op =) (reg b) (const 0))
+  (branch (label gcd-done))
+  (assign t (op rem) (reg a) (reg b))
+  (assign a (reg b))
+  (assign b (reg t))
+  (goto (label test-b))
+gcd-done)
+"""
+
+
+def gcd_program(**options):
+    return Program(['a', 'b', 't'], [('rem', operator.mod), ('=', operator.eq)],
+                   parse(GCD_CODE), **options)
+
+
+class BatchTest(unittest.TestCase):
+    inputs = [{'a': a, 'b': b} for a in range(1, 30) for b in range(1, 30)]
+    expected = [{'a': math.gcd(a, b)} for a in range(1, 30) for b in range(1, 30)]
+
+    def test_run(self):
+        program = gcd_program()
+        self.assertEqual(program.run({'a': 206, 'b': 40}), {'a': 2, 'b': 0, 't': 0})
+        # registers left by a run don't leak into the next one
+        self.assertEqual(program.run({'a': 5, 'b': 0}), {'a': 5, 'b': 0, 't': False})
+
+    def test_serial(self):
+        for options in ({}, {'optimize': True}, {'compiled': True}):
+            results = run_batch(gcd_program(**options), self.inputs, ['a'])
+            self.assertEqual(results, self.expected)
+
+    def test_pickle(self):
+        program = pickle.loads(pickle.dumps(gcd_program(compiled=True)))
+        self.assertIsInstance(program.machine, CompiledMachine)
+        self.assertEqual(program.run({'a': 206, 'b': 40}, ['a']), {'a': 2})
+
+    def test_processes(self):
+        results = run_batch(gcd_program(), self.inputs, ['a'], workers=2,
+                            chunksize=100)
+        self.assertEqual(results, self.expected)
+
+    def test_array_stack(self):
+        program = Program(['n', 'val', 'continue'],
+                          [('<', operator.lt), ('-', operator.sub), ('+', operator.add)],
+                          parse(FIB_CODE), compiled=True, stack=ArrayStack(100))
+        program = pickle.loads(pickle.dumps(program))
+        self.assertEqual(program.run_many([{'n': 10}, {'n': 5}], ['val']),
+                         [{'val': 55}, {'val': 5}])
+        self.assertIsInstance(program.machine.stack, ArrayStack)
+
+    def test_stack_reset(self):
+        program = Program(['n', 'val', 'continue'],
+                          [('<', operator.lt), ('-', operator.sub), ('+', operator.add)],
+                          parse(FIB_CODE))
+        self.assertEqual(program.run_many([{'n': 10}, {'n': 5}], ['val']),
+                         [{'val': 55}, {'val': 5}])
+        self.assertEqual(program.machine.stack.values, [])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,276 @@
+""" Analyzing evaluator, SICP 4.1.7
+
+analyze(exp) turns an expression into a Python closure taking an
+environment, so the syntactic dispatch of vseval is done only once.
+Variables bound by lambdas are resolved at analysis time to lexical
+addresses, (depth, index) pairs into array-backed frames (SICP 5.5.6).
+Free variables are looked up by name in the dict-backed top Env.
+"""
+__all__ = ['analyze', 'aeval', 'Procedure']
+
+from SICP.vanilla_scheme.vseval import vseval, compound_procedure, \
+    is_self_evaluating, text_of_quotation, desugar, DERIVED, \
+    Frame, extend_frame, LispException, UnboundVar, UNASSIGNED, GLOBAL_ENV, \
+    BINARY, \
+    Symbol, QUOTE, SET, DEFINE, IF, LAMBDA, BEGIN, FALSE
+
+
+class Procedure:
+    "Compound procedure whose body has been analyzed"
+    __slots__ = ('params', 'body', 'env', 'execute', 'layout', 'padding')
+
+    def __init__(self, params, body, env, execute, layout, padding):
+        self.params = params
+        self.body = body
+        self.env = env
+        self.execute = execute
+        # variable names by frame index, and slots for internal defines
+        self.layout = layout
+        self.padding = padding
+
+    def make_frame(self, args):
+        if len(args) != len(self.params):
+            raise LispException("Wrong number of arguments: %s" % (args,))
+        if self.padding:
+            args = args + self.padding
+        return Frame(self.layout, args, self.env)
+
+    def __call__(self, *args):
+        # so that vseval and primitives can call it like a primitive,
+        # frames hold their values in a list
+        return apply_procedure(self, list(args))
+
+
+class TailCall:
+    "Returned by an application in tail position instead of calling"
+    __slots__ = ('proc', 'args')
+
+    def __init__(self, proc, args):
+        self.proc = proc
+        self.args = args
+
+
+def aeval(exp, env):
+    return analyze(exp)(env)
+
+
+def analyze(exp):
+    """Returns an execution procedure of one argument, an environment
+    """
+    return analyze_exp(exp, False, ())
+
+
+def apply_procedure(proc, args):
+    # properly tail recursive, tail calls bounce back here
+    while True:
+        if type(proc) is Procedure:
+            result = proc.execute(proc.make_frame(args))
+            if type(result) is TailCall:
+                proc, args = result.proc, result.args
+                continue
+            return result
+        if isinstance(proc, compound_procedure):
+            return vseval(proc.body, extend_frame(proc.layout, args, proc.env))
+        return proc(*args)
+
+
+def analyze_exp(exp, tail, cenv):
+    """tail is true when the value of exp is the value of
+    the procedure body it belongs to. cenv is the compile-time
+    environment, the layouts of the enclosing frames, innermost first.
+    """
+    if is_self_evaluating(exp):
+        return lambda env: exp
+    if type(exp) is Symbol:
+        return analyze_variable(exp, cenv)
+
+    cmd = exp[0]
+    if cmd is QUOTE:
+        return analyze_quoted(exp)
+    if cmd is SET:
+        return analyze_assignment(exp, cenv)
+    if cmd is DEFINE:
+        return analyze_definition(exp, cenv)
+    if cmd is IF:
+        return analyze_if(exp, tail, cenv)
+    if cmd is LAMBDA:
+        return analyze_lambda(exp, cenv)
+    if cmd is BEGIN:
+        return analyze_sequence(exp[1:], tail, cenv)
+    if type(cmd) is Symbol and cmd in DERIVED:
+        return analyze_exp(desugar(exp), tail, cenv)
+    return analyze_application(exp, tail, cenv)
+
+
+def lexical_address(var, cenv):
+    "(depth, index) of var, or None when var is free"
+    for depth, layout in enumerate(cenv):
+        if var in layout:
+            return depth, layout[var]
+    return None
+
+
+def frame_getter(depth):
+    "Returns a procedure fetching the frame depth levels up from env"
+    if depth == 0:
+        return lambda env: env
+    if depth == 1:
+        return lambda env: env.upper
+    if depth == 2:
+        return lambda env: env.upper.upper
+
+    def frame(env):
+        for _ in range(depth):
+            env = env.upper
+        return env
+    return frame
+
+
+def analyze_variable(var, cenv):
+    address = lexical_address(var, cenv)
+    if address is None:
+        return lambda env: env.top.lookup(var)
+
+    depth, i = address
+    if depth == 0:
+        def execute(env):
+            val = env.values[i]
+            if val is UNASSIGNED:
+                raise UnboundVar(var)
+            return val
+    elif depth == 1:
+        def execute(env):
+            val = env.upper.values[i]
+            if val is UNASSIGNED:
+                raise UnboundVar(var)
+            return val
+    else:
+        frame = frame_getter(depth)
+
+        def execute(env):
+            val = frame(env).values[i]
+            if val is UNASSIGNED:
+                raise UnboundVar(var)
+            return val
+    return execute
+
+
+def analyze_quoted(exp):
+    # cons cells are immutable, the quoted value can be built only once
+    value = text_of_quotation(exp, GLOBAL_ENV)
+    return lambda env: value
+
+
+def analyze_assignment(exp, cenv):
+    _, var, valexp = exp
+    vproc = analyze_exp(valexp, False, cenv)
+    address = lexical_address(var, cenv)
+    if address is None:
+        return lambda env: env.top.set_variable_value(var, vproc(env))
+
+    depth, i = address
+    frame = frame_getter(depth)
+
+    def execute(env):
+        frame(env).values[i] = vproc(env)
+    return execute
+
+
+def analyze_definition(exp, cenv):
+    _, var, valexp = desugar(exp)
+    vproc = analyze_exp(valexp, False, cenv)
+    if not cenv:
+        return lambda env: env.define_variable(var, vproc(env))
+
+    # scanned out by make_layout, so it has a slot in this frame
+    i = cenv[0][var]
+
+    def execute(env):
+        env.values[i] = vproc(env)
+    return execute
+
+
+def analyze_if(exp, tail, cenv):
+    _, test, yes, no = exp
+    tproc = analyze_exp(test, False, cenv)
+    yproc = analyze_exp(yes, tail, cenv)
+    nproc = analyze_exp(no, tail, cenv)
+
+    def execute(env):
+        if tproc(env) is not FALSE:
+            return yproc(env)
+        return nproc(env)
+    return execute
+
+
+def analyze_lambda(exp, cenv):
+    params, body, layout = desugar(exp)
+    padding = [UNASSIGNED] * (len(layout) - len(params))
+    bproc = analyze_exp(body, True, (layout,) + cenv)
+    return lambda env: Procedure(params, body, env, bproc, layout, padding)
+
+
+def analyze_sequence(exps, tail, cenv):
+    actions = [analyze_exp(e, False, cenv) for e in exps[:-1]]
+    last = analyze_exp(exps[-1], tail, cenv)
+    if not actions:
+        return last
+
+    def execute(env):
+        for act in actions:
+            act(env)
+        return last(env)
+    return execute
+
+
+def global_binary(op, cenv):
+    """(primitive, two-argument form) when op names a global
+    variadic primitive not shadowed by a lexical variable
+    """
+    if type(op) is not Symbol or lexical_address(op, cenv) is not None:
+        return None
+    prim = GLOBAL_ENV.frame.get(op)
+    entry = BINARY.get(id(prim))
+    if entry is not None and entry[0] is prim:
+        return entry
+    return None
+
+
+def analyze_application(exp, tail, cenv):
+    fproc = analyze_exp(exp[0], False, cenv)
+    aprocs = [analyze_exp(arg, False, cenv) for arg in exp[1:]]
+
+    binary = global_binary(exp[0], cenv) if len(aprocs) == 2 else None
+    if binary is not None:
+        return analyze_binary(fproc, aprocs, binary, tail)
+
+    if tail:
+        def execute(env):
+            proc = fproc(env)
+            args = [a(env) for a in aprocs]
+            if type(proc) is Procedure:
+                return TailCall(proc, args)
+            return apply_procedure(proc, args)
+    else:
+        def execute(env):
+            return apply_procedure(fproc(env), [a(env) for a in aprocs])
+    return execute
+
+
+def analyze_binary(fproc, aprocs, binary, tail):
+    """Call of a global primitive with two arguments. The operator is
+    still looked up, and the primitive is called through its two-argument
+    form only while it is the one bound, so redefining it stays correct.
+    """
+    prim, fast = binary
+    a, b = aprocs
+
+    def execute(env):
+        proc = fproc(env)
+        if proc is prim:
+            return fast(a(env), b(env))
+        args = [a(env), b(env)]
+        if tail and type(proc) is Procedure:
+            return TailCall(proc, args)
+        return apply_procedure(proc, args)
+    return execute
@@ -0,0 +1,319 @@
+""" Benchmarks for the vanilla scheme evaluators
+
+    python -m SICP.vanilla_scheme.bench
+"""
+import time
+import tracemalloc
+from collections import namedtuple
+
+from SICP.lisp_parser.lp import parse, parse_all
+from SICP.vanilla_scheme.vseval import vseval, Env, GLOBAL_ENV, \
+    extend_frame, make_layout, BINARY
+from SICP.vanilla_scheme.analyze import aeval
+from SICP.vanilla_scheme.compiler import ceval
+from SICP.vanilla_scheme.profiler import Profiler
+from SICP.vanilla_scheme import lists, vectors
+
+
+PROGRAMS = {
+    'fib': ("""
+    (define (fib n)
+      (if (< n 2)
+          n
+          (+ (fib (- n 1)) (fib (- n 2)))))
+    """, "(fib 20)"),
+
+    'loop': ("""
+    (define (loop n acc)
+      (if (= n 0)
+          acc
+          (loop (- n 1) (+ acc 1))))
+    """, "(loop 100000 0)"),
+
+    'build-list': ("""
+    (define (build n acc)
+      (if (= n 0)
+          acc
+          (build (- n 1) (cons n acc))))
+    """, "(build 100000 '())"),
+
+    'dispatch': ("""
+    (define (dispatch n acc)
+      (if (= n 0)
+          acc
+          (begin
+            (set! acc (cons 'x acc))
+            (dispatch (- n 1) (if true acc '())))))
+    """, "(dispatch 50000 '())"),
+
+    'closures': ("""
+    (define (closures n acc)
+      (define (add x) (+ x n))
+      (if (= n 0)
+          acc
+          (closures (- n 1) ((lambda (y) (set! y (add y)) (+ acc y)) 1))))
+    """, "(closures 50000 0)"),
+}
+
+
+EVALUATORS = {
+    'vseval': vseval,
+    'analyze': aeval,
+    'compiled': ceval,
+}
+
+
+def fresh_env():
+    env = Env()
+    env.upper = GLOBAL_ENV
+    return env
+
+
+def bench_program(evaluator, name, repeat=3):
+    "Best wall time of running one program, definitions excluded"
+    defs, call = PROGRAMS[name]
+    env = fresh_env()
+    evaluator(parse(defs), env)
+    exp = parse(call)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        evaluator(exp, env)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+MEMORY_PROGRAMS = {
+    # program, call, number of compound procedure calls
+    'fib 25': ('fib', "(fib 25)", 242785),
+    'loop 1M': ('loop', "(loop 1000000 0)", 1000001),
+}
+
+
+def frame_cost(params, n=10000):
+    "Bytes and allocated blocks per call frame, argument list included"
+    layout = make_layout(params, [])
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    frames = [extend_frame(layout, list(range(len(params))), GLOBAL_ENV)
+              for _ in range(n)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    size = sum(s.size_diff for s in stats)
+    blocks = sum(s.count_diff for s in stats)
+    del frames
+    return size / n, blocks / n
+
+
+def bench_memory(evaluator, name):
+    "tracemalloc peak while running one of MEMORY_PROGRAMS"
+    program, call, _ = MEMORY_PROGRAMS[name]
+    defs, _ = PROGRAMS[program]
+    env = fresh_env()
+    evaluator(parse(defs), env)
+    exp = parse(call)
+    tracemalloc.start()
+    evaluator(exp, env)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+class legacy_cons(namedtuple('cons', 'car, cdr')):
+    "The cons cell before Pair, with its printer"
+    __slots__ = ()
+
+    def __str__(self):
+        elts = [str(self.car)]
+        cdr = self.cdr
+
+        while isinstance(cdr, legacy_cons):
+            elts.append(str(cdr.car))
+            cdr = cdr.cdr
+        if cdr != []:
+            elts.append('.')
+            elts.append(str(cdr))
+        return '(' + ' '.join(elts) + ')'
+
+
+def bench_cons(n=1000000):
+    "Time to build and to print a list of n numbers, legacy cons and Pair"
+    results = []
+    for name, cons in [('legacy', legacy_cons), ('Pair', lists.Pair)]:
+        start = time.perf_counter()
+        xs = []
+        for i in range(n):
+            xs = cons(i, xs)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        str(xs)
+        results.append((name, build, time.perf_counter() - start))
+    return results
+
+
+SCHEME_LISTS = """
+(define (my-length xs)
+  (define (iter xs n)
+    (if (null? xs) n (iter (cdr xs) (+ n 1))))
+  (iter xs 0))
+(define (my-reverse xs)
+  (define (iter xs acc)
+    (if (null? xs) acc (iter (cdr xs) (cons (car xs) acc))))
+  (iter xs '()))
+(define (my-map fn xs)
+  (my-reverse
+    (begin
+      (define (iter xs acc)
+        (if (null? xs) acc (iter (cdr xs) (cons (fn (car xs)) acc))))
+      (iter xs '()))))
+"""
+
+
+def bench_list_primitives(evaluator, n=100000):
+    "length, reverse and map on an n element list, in Scheme and native"
+    env = fresh_env()
+    env.define_variable('xs', lists.from_iterable(range(n)))
+    env.define_variable('map', GLOBAL_ENV.lookup('map'))
+    for exp in parse_all(SCHEME_LISTS):
+        evaluator(exp, env)
+    results = []
+    for call in ["(%slength xs)", "(%sreverse xs)",
+                 "(%smap (lambda (x) (+ x 1)) xs)"]:
+        times = []
+        for prefix in ('my-', ''):
+            exp = parse(call % prefix)
+            start = time.perf_counter()
+            evaluator(exp, env)
+            times.append(time.perf_counter() - start)
+        results.append((call % '', *times))
+    return results
+
+
+NUMERIC_DEFINITIONS = """
+(define (list-sum xs acc)
+  (if (null? xs) acc (list-sum (cdr xs) (+ acc (car xs)))))
+(define (cube x) (* x x x))
+"""
+
+NUMERIC_PROGRAMS = {
+    # cons list version, vector version
+    'sum': ("(list-sum xs 0)", "(vector-sum v)"),
+    'add': ("(map + xs xs)", "(v+ v v)"),
+    'scale': ("(map (lambda (x) (* x 2.5)) xs)", "(v* v 2.5)"),
+    # integral of cube from 0 to 1, rectangle rule
+    'integral': ("(* h (list-sum (map cube xs) 0))",
+                 "(* h (vector-sum (v* (v* v v) v)))"),
+}
+
+
+def bench_vectors(n=100000):
+    "NUMERIC_PROGRAMS over n floats from 0 to 1, in a cons list and a vector"
+    h = 1 / n
+    points = [i * h for i in range(n)]
+    env = fresh_env()
+    env.define_variable('h', h)
+    env.define_variable('xs', lists.from_iterable(points))
+    env.define_variable('v', vectors.vector(*points))
+    env.define_variable('map', GLOBAL_ENV.lookup('map'))
+    for exp in parse_all(NUMERIC_DEFINITIONS):
+        vseval(exp, env)
+    results = []
+    for name, calls in NUMERIC_PROGRAMS.items():
+        times = []
+        for call in calls:
+            exp = parse(call)
+            start = time.perf_counter()
+            vseval(exp, env)
+            times.append(time.perf_counter() - start)
+        results.append((name, *times))
+    return results
+
+
+PRIMITIVE_CALLS = {
+    'fib 25': ('fib', "(fib 25)"),
+    'loop 200k': ('loop', "(loop 200000 0)"),
+}
+
+
+def bench_binary_primitives(evaluator, name):
+    """Time of one of PRIMITIVE_CALLS through the variadic primitives
+    and through their two-argument forms
+    """
+    program, call = PRIMITIVE_CALLS[name]
+    defs, _ = PROGRAMS[program]
+    saved = dict(BINARY)
+    times = []
+    try:
+        for table in ({}, saved):
+            BINARY.clear()
+            BINARY.update(table)
+            # analyze looks the table up when analyzing
+            env = fresh_env()
+            evaluator(parse(defs), env)
+            start = time.perf_counter()
+            evaluator(parse(call), env)
+            times.append(time.perf_counter() - start)
+    finally:
+        BINARY.update(saved)
+    return times
+
+
+def bench_profiler(name='fib'):
+    "Time of a program with vseval, and with vseval under a Profiler"
+    defs, call = PROGRAMS[name]
+    env = fresh_env()
+    vseval(parse(defs), env)
+    exp = parse(call)
+    start = time.perf_counter()
+    vseval(exp, env)
+    plain = time.perf_counter() - start
+    profiler = Profiler()
+    start = time.perf_counter()
+    with profiler:
+        profiler.vseval(exp, env)
+    return plain, time.perf_counter() - start, profiler
+
+
+if __name__ == '__main__':
+    print("%-12s" % 'program' + ''.join("%12s" % e for e in EVALUATORS))
+    for name in PROGRAMS:
+        times = [bench_program(ev, name) for ev in EVALUATORS.values()]
+        print("%-12s" % name + ''.join("%11.3fs" % t for t in times))
+
+    print()
+    for name in PRIMITIVE_CALLS:
+        for ev_name in ['vseval', 'analyze']:
+            evaluator = EVALUATORS[ev_name]
+            variadic, binary = bench_binary_primitives(evaluator, name)
+            print("%-8s %-8s variadic %.3fs, two-argument %.3fs"
+                  % (name, ev_name, variadic, binary))
+
+    print()
+    plain, profiled, profiler = bench_profiler()
+    print("fib 20 with vseval %.3fs, profiled %.3fs" % (plain, profiled))
+    print(profiler.report(5))
+
+    print()
+    size, blocks = frame_cost(['n', 'acc'])
+    print("call frame: %.0f bytes, %.1f blocks" % (size, blocks))
+    print("%-12s" % 'peak memory' + ''.join("%12s" % e for e in EVALUATORS)
+          + "  frame allocations")
+    for name, (_, _, calls) in MEMORY_PROGRAMS.items():
+        peaks = [bench_memory(ev, name) for ev in EVALUATORS.values()]
+        print("%-12s" % name + ''.join("%10.1fKB" % (p / 1024) for p in peaks)
+              + "  %d" % (calls * blocks))
+
+    print()
+    for name, build, printing in bench_cons():
+        print("1M %-6s cons: build %.3fs, print %.3fs" % (name, build, printing))
+    for name, evaluator in EVALUATORS.items():
+        for call, scheme, native in bench_list_primitives(evaluator):
+            print("%-8s %-28s scheme %.3fs, native %.3fs"
+                  % (name, call, scheme, native))
+
+    print()
+    backend = 'numpy' if vectors.numpy is not None else 'array.array'
+    print("100k floats  cons list  vector (%s)" % backend)
+    for name, list_time, vector_time in bench_vectors():
+        print("%-10s %10.4fs %10.4fs" % (name, list_time, vector_time))
@@ -0,0 +1,596 @@
+""" Compiler from Scheme to Python, SICP 5.5 with Python as the target
+
+compile_program(exps, env) translates expressions into the source of
+a Python function and compile()s it. Procedures become Python
+functions whose lexical variables are Python locals, so closures and
+set! are handled by Python itself. Free variables are looked up in
+env at run time, so compiled and interpreted code share definitions
+and call each other.
+
+A tail call of a procedure to itself jumps back to the top of a while
+loop, for a global procedure as long as its variable is still bound to
+it. Other tail calls return a TailCall, run by the trampoline of the
+procedure's public entry. Calls of the global arithmetic, comparison
+and list primitives are open-coded (SICP 5.5.5), when the primitive is
+the one bound at compile time and the program itself doesn't define
+or set! it, so redefining + later doesn't change procedures compiled
+before.
+"""
+__all__ = ['ceval', 'compile_exp', 'compile_program', 'compile_procedure',
+           'to_python']
+
+import math
+import re
+
+from SICP.vanilla_scheme.vseval import apply, desugar, \
+    text_of_quotation, Env, LispException, GLOBAL_ENV, DERIVED, COMPOUND, \
+    Symbol, QUOTE, SET, DEFINE, IF, LAMBDA, BEGIN, TRUE, FALSE
+from SICP.vanilla_scheme.analyze import TailCall
+from SICP.vanilla_scheme.lists import Pair
+
+
+def bounce(result):
+    "Runs tail calls until a value comes back"
+    while type(result) is TailCall:
+        proc = result.proc
+        raw = getattr(proc, 'raw', None)
+        if raw is not None:
+            result = raw(*result.args)
+        else:
+            result = apply(proc, result.args)
+    return result
+
+
+def trampolined(raw):
+    "Public entry of a compiled procedure whose body returns TailCalls"
+    def proc(*args):
+        return bounce(raw(*args))
+    proc.raw = raw
+    return proc
+
+
+def arithmetic(op):
+    return lambda xs: '(%s)' % (' %s ' % op).join(xs) if len(xs) >= 2 else None
+
+
+def comparison(op):
+    return lambda xs: '(%s %s %s)' % (xs[0], op, xs[1]) if len(xs) == 2 else None
+
+
+def is_literal(code):
+    "Whether code is a number written out, which is never false"
+    return code.lstrip('-')[:1].isdigit()
+
+
+def unary(template):
+    return lambda xs: template % xs[0] if len(xs) == 1 else None
+
+
+def binary(template):
+    return lambda xs: template % tuple(xs) if len(xs) == 2 else None
+
+
+def negation(xs):
+    "not, folded for a number since `is` with a literal is a SyntaxWarning"
+    if len(xs) != 1:
+        return None
+    return 'False' if is_literal(xs[0]) else '(%s is FALSE)' % xs[0]
+
+
+# open-coded primitives, name => code from the argument codes or None
+# when the number of arguments isn't supported. PREDICATES give a
+# Python bool, turned into true/false unless used as an if test.
+PREDICATES = {
+    '=': comparison('=='),
+    'equal?': comparison('=='),
+    '<': comparison('<'),
+    '>': comparison('>'),
+    '<=': comparison('<='),
+    '>=': comparison('>='),
+    'null?': unary('(%s == [])'),
+    'pair?': unary('(type(%s) is Pair)'),
+    'not': negation,
+}
+OPERATIONS = {
+    '+': arithmetic('+'),
+    '-': arithmetic('-'),
+    '*': arithmetic('*'),
+    '/': arithmetic('/'),
+    'rem': binary('(%s %% %s)'),
+    'car': unary('(%s).car'),
+    'cdr': unary('(%s).cdr'),
+    'cons': binary('Pair(%s, %s)'),
+}
+# the primitives the code above stands for
+PRIMITIVES = {name: GLOBAL_ENV.frame[name]
+              for name in list(PREDICATES) + list(OPERATIONS)}
+# every primitive by id, tail calls of them need no trampoline
+BUILTINS = {id(value): value for value in GLOBAL_ENV.frame.values()
+            if not hasattr(value, 'body')}
+
+
+def creates_closure(exp):
+    """Whether evaluating exp may create a procedure, other than
+    a lambda applied on the spot like the ones let expands into
+    """
+    # the last subexpression is followed in a loop, the alternatives of
+    # a long cond don't take a recursion level each
+    while isinstance(exp, COMPOUND) and exp:
+        cmd = exp[0]
+        if cmd is QUOTE:
+            return False
+        if cmd is LAMBDA:
+            return True
+        if type(cmd) is Symbol and cmd in DERIVED:
+            exp = desugar(exp)
+        elif cmd is DEFINE:
+            exp = desugar(exp)[2]
+        elif isinstance(cmd, COMPOUND) and cmd and cmd[0] is LAMBDA:
+            if any(creates_closure(x) for x in exp[1:]):
+                return True
+            _, exp, _ = desugar(cmd)
+        else:
+            if any(creates_closure(x) for x in exp[:-1]):
+                return True
+            exp = exp[-1]
+    return False
+
+
+def assigned_names(exps):
+    """Names the expressions define, and names they set!, anywhere in
+    them, without recursion
+    """
+    defined, assigned = set(), set()
+    stack = list(exps)
+    while stack:
+        exp = stack.pop()
+        if not isinstance(exp, COMPOUND) or not exp or exp[0] is QUOTE:
+            continue
+        if (exp[0] is DEFINE or exp[0] is SET) and len(exp) > 1:
+            var = exp[1]
+            if isinstance(var, COMPOUND) and var:
+                var = var[0]
+            if type(var) is Symbol:
+                (defined if exp[0] is DEFINE else assigned).add(var)
+        stack.extend(exp)
+    return defined, assigned
+
+
+def indent(lines):
+    return ['    ' + line for line in lines]
+
+
+def expand(exp):
+    "exp with its derived forms rewritten until it isn't one"
+    while (isinstance(exp, COMPOUND) and exp and type(exp[0]) is Symbol
+           and exp[0] in DERIVED):
+        exp = desugar(exp)
+    return exp
+
+
+def is_if(exp):
+    return isinstance(exp, COMPOUND) and len(exp) > 0 and exp[0] is IF
+
+
+class Function:
+    "A Python def being generated"
+
+    def __init__(self, name, params, self_ref, can_loop):
+        self.name = name
+        self.params = params
+        # binding of the procedure's own name, see Compiler.ref
+        self.self_ref = self_ref
+        # loops must not be used when closures could capture the params
+        self.can_loop = can_loop
+        self.loops = False
+        self.tail_calls = False
+        # name of the public entry, when the body refers to it
+        self.entry = None
+        self.nonlocals = set()
+
+
+class Scope:
+    "Scheme names bound by a lambda, mapped to Python locals of fn"
+
+    def __init__(self, names, fn, upper):
+        self.names = names
+        self.fn = fn
+        self.upper = upper
+
+    def resolve(self, var):
+        "(Python name, owner Function), or None when var is free"
+        scope = self
+        while scope is not None:
+            name = scope.names.get(var)
+            if name is not None:
+                return name, scope.fn
+            scope = scope.upper
+        return None
+
+
+class Compiler:
+    "Translates expressions to be run on top of env"
+
+    def __init__(self, env):
+        self.env = env
+        self.count = 0
+        # names the program being compiled defines, and names it set!s
+        self.defined = set()
+        self.assigned = set()
+        self.globals = {
+            'TRUE': TRUE, 'FALSE': FALSE, 'Pair': Pair, 'TailCall': TailCall,
+            'trampolined': trampolined, 'G': getattr(env, 'frame', None),
+            'lookup': env.lookup, 'define': env.define_variable,
+            'assign': env.set_variable_value,
+        }
+
+    def fresh(self, hint):
+        "A new Python name, unique in the generated source"
+        self.count += 1
+        name = '%s_%d' % (re.sub(r'\W', '_', hint), self.count)
+        return name if name.isidentifier() else 'v' + name
+
+    def constant(self, value):
+        if type(value) is int or (type(value) is float and math.isfinite(value)):
+            return repr(value)
+        name = self.fresh('k')
+        self.globals[name] = value
+        return name
+
+    def program(self, exps, self_name=None):
+        """Source of a function of no arguments, named program, evaluating
+        exps in order. When self_name is given the last one is a lambda
+        called through the variable self_name.
+        """
+        # a primitive the program redefines isn't open-coded
+        self.defined, self.assigned = assigned_names(exps)
+        fn = Function('program', [], None, False)
+        scope = Scope({}, fn, None)
+        lines = []
+        for exp in exps[:-1]:
+            self.effect(exp, scope, lines)
+        if self_name is None:
+            last = self.value(exps[-1], scope, lines)
+        else:
+            last = self.function(exps[-1], scope, lines,
+                                 ('free', self_name), self_name)
+        lines.append('return ' + last)
+        return '\n'.join(['def program():'] + indent(lines)) + '\n'
+
+    def ref(self, var, scope):
+        "What var is bound to: a Python local, or a free variable"
+        resolved = scope.resolve(var)
+        return ('local', resolved[0]) if resolved else ('free', var)
+
+    def primitive(self, op, scope, table):
+        "Code generator of op when it is an unshadowed open-coded primitive"
+        if (type(op) is not Symbol or op not in table or scope.resolve(op)
+                or op in self.defined or op in self.assigned):
+            return None
+        try:
+            bound = self.env.lookup(op)
+        except LispException:
+            return None
+        return table[op] if bound is PRIMITIVES[op] else None
+
+    # expressions
+
+    def value(self, exp, scope, block):
+        """Python expression for the value of exp, statements it needs
+        to be run first are appended to block
+        """
+        if type(exp) is Symbol:
+            if exp is TRUE or exp is FALSE:
+                return str(exp).upper()
+            return self.variable(exp, scope)
+        if not isinstance(exp, COMPOUND):
+            return self.constant(exp)
+
+        cmd = exp[0]
+        if cmd is QUOTE:
+            return self.constant(text_of_quotation(exp, GLOBAL_ENV))
+        if cmd is SET:
+            self.assignment(exp, scope, block)
+            return 'None'
+        if cmd is DEFINE:
+            self.definition(exp, scope, block)
+            return 'None'
+        if cmd is IF:
+            return self.conditional(exp, scope, block)
+        if cmd is LAMBDA:
+            return self.function(exp, scope, block)
+        if cmd is BEGIN:
+            for e in exp[1:-1]:
+                self.effect(e, scope, block)
+            return self.value(exp[-1], scope, block)
+        if type(cmd) is Symbol and cmd in DERIVED:
+            return self.value(desugar(exp), scope, block)
+        if isinstance(cmd, COMPOUND) and cmd and cmd[0] is LAMBDA:
+            return self.value(*self.let(exp, scope, block), block)
+
+        predicate = self.primitive(cmd, scope, PREDICATES)
+        operation = self.primitive(cmd, scope, OPERATIONS)
+        if predicate or operation:
+            args = self.values(exp[1:], scope, block)
+            code = predicate(args) if predicate else operation(args)
+            if code is not None:
+                return '(TRUE if %s else FALSE)' % code if predicate else code
+            return '%s(%s)' % (self.variable(cmd, scope), ', '.join(args))
+        proc, *args = self.values(exp, scope, block)
+        return '%s(%s)' % (proc, ', '.join(args))
+
+    def test(self, exp, scope, block):
+        "Python bool telling if the value of exp is not false"
+        if exp is TRUE or exp is FALSE:
+            return str(exp is TRUE)
+        if isinstance(exp, COMPOUND) and exp:
+            predicate = self.primitive(exp[0], scope, PREDICATES)
+            if predicate:
+                args = self.values(exp[1:], scope, block)
+                code = predicate(args)
+                if code is not None:
+                    return code
+                return '(%s(%s) is not FALSE)' % (
+                    self.variable(exp[0], scope), ', '.join(args))
+        code = self.value(exp, scope, block)
+        if is_literal(code):
+            return 'True'
+        return '(%s is not FALSE)' % code
+
+    def effect(self, exp, scope, block):
+        "Statements evaluating exp for its side effects"
+        code = self.value(exp, scope, block)
+        if not (code.isidentifier() or is_literal(code)):
+            block.append(code)
+
+    def values(self, exps, scope, block):
+        """Codes of exps, evaluated from left to right: when the code
+        of one needs statements, the ones before it are saved first
+        """
+        codes = []
+        for exp in exps:
+            statements = []
+            code = self.value(exp, scope, statements)
+            if statements:
+                for i, previous in enumerate(codes):
+                    if not previous.isidentifier():
+                        temp = self.fresh('t')
+                        block.append('%s = %s' % (temp, previous))
+                        codes[i] = temp
+                block.extend(statements)
+            codes.append(code)
+        return codes
+
+    def variable(self, var, scope):
+        resolved = scope.resolve(var)
+        if resolved:
+            return resolved[0]
+        key = repr(str(var))
+        if isinstance(self.env, Env):
+            return '(G[%s] if %s in G else lookup(%s))' % (key, key, key)
+        return 'lookup(%s)' % key
+
+    def assignment(self, exp, scope, block):
+        _, var, valexp = exp
+        val = self.value(valexp, scope, block)
+        resolved = scope.resolve(var)
+        if resolved is None:
+            block.append('assign(%r, %s)' % (str(var), val))
+            return
+        name, owner = resolved
+        if owner is not scope.fn:
+            scope.fn.nonlocals.add(name)
+        block.append('%s = %s' % (name, val))
+
+    def definition(self, exp, scope, block):
+        _, var, valexp = desugar(exp)
+        if scope.upper is None:
+            val = self.named_value(valexp, var, ('free', var), scope, block)
+            block.append('define(%r, %s)' % (str(var), val))
+            return
+        name = scope.names.get(var)
+        if name is None:
+            raise LispException("Definition not scanned out: %s" % (exp,))
+        val = self.named_value(valexp, var, ('local', name), scope, block)
+        block.append('%s = %s' % (name, val))
+
+    def named_value(self, valexp, var, self_ref, scope, block):
+        if isinstance(valexp, COMPOUND) and valexp and valexp[0] is LAMBDA:
+            return self.function(valexp, scope, block, self_ref, var)
+        return self.value(valexp, scope, block)
+
+    def conditional(self, exp, scope, block):
+        _, test, yes, no = exp
+        t = self.test(test, scope, block)
+        if not is_if(expand(no)):
+            yes_block, no_block = [], []
+            y = self.value(yes, scope, yes_block)
+            n = self.value(no, scope, no_block)
+            if not yes_block and not no_block:
+                return '(%s if %s else %s)' % (y, t, n)
+        temp = self.fresh('if')
+
+        def branch(exp, block):
+            block.append('%s = %s' % (temp, self.value(exp, scope, block)))
+        self.chain(t, yes, no, scope, block, branch)
+        return temp
+
+    def chain(self, t, yes, no, scope, block, branch):
+        """if statement choosing between yes and no when the code t is
+        true, branch(exp, block) appends the statements of a branch.
+        The ifs in the alternative become elif clauses, a cond doesn't
+        nest one block per clause.
+        """
+        keyword = 'if'
+        while True:
+            block.append('%s %s:' % (keyword, t))
+            yes_block = []
+            branch(yes, yes_block)
+            block.extend(indent(yes_block))
+            no = expand(no)
+            if not is_if(no):
+                break
+            _, test, yes, no = no
+            statements = []
+            t = self.test(test, scope, statements)
+            if statements:
+                # they must run in the else clause, before its own if
+                self.chain(t, yes, no, scope, statements, branch)
+                block.append('else:')
+                block.extend(indent(statements))
+                return
+            keyword = 'elif'
+        no_block = []
+        branch(no, no_block)
+        block.append('else:')
+        block.extend(indent(no_block))
+
+    def let(self, exp, scope, block):
+        """((lambda (v ...) body) e ...) binds fresh locals of the
+        current function, returns body and the scope to compile it in
+        """
+        params, body, layout = desugar(exp[0])
+        if len(params) != len(exp) - 1:
+            raise LispException("Wrong number of arguments: %s" % (exp,))
+        args = self.values(exp[1:], scope, block)
+        names = {var: self.fresh(var) for var in layout}
+        for param, arg in zip(params, args):
+            block.append('%s = %s' % (names[param], arg))
+        return body, Scope(names, scope.fn, scope)
+
+    def function(self, exp, scope, block, self_ref=None, hint='lambda'):
+        "Appends the def of a lambda to block, returns its public entry"
+        params, body, layout = desugar(exp)
+        names = {var: self.fresh(var) for var in layout}
+        fn = Function(self.fresh(hint), [names[p] for p in params],
+                      self_ref, not creates_closure(body))
+        lines = []
+        self.tail(body, Scope(names, fn, scope), lines)
+        if fn.loops:
+            lines = ['while True:'] + indent(lines)
+        if fn.nonlocals:
+            lines.insert(0, 'nonlocal ' + ', '.join(sorted(fn.nonlocals)))
+        block.append('def %s(%s):' % (fn.name, ', '.join(fn.params)))
+        block.extend(indent(lines))
+        if fn.entry is not None:
+            # tail_calls is set along with it
+            block.append('%s = trampolined(%s)' % (fn.entry, fn.name))
+            return fn.entry
+        if fn.tail_calls:
+            return 'trampolined(%s)' % fn.name
+        return fn.name
+
+    # tail position
+
+    def tail(self, exp, scope, block):
+        "Statements returning the value of exp from the current function"
+        if isinstance(exp, COMPOUND) and exp:
+            cmd = exp[0]
+            if cmd is IF:
+                _, test, yes, no = exp
+                t = self.test(test, scope, block)
+                self.chain(t, yes, no, scope, block,
+                           lambda exp, block: self.tail(exp, scope, block))
+                return
+            if cmd is BEGIN:
+                for e in exp[1:-1]:
+                    self.effect(e, scope, block)
+                return self.tail(exp[-1], scope, block)
+            if type(cmd) is Symbol and cmd in DERIVED:
+                return self.tail(desugar(exp), scope, block)
+            if isinstance(cmd, COMPOUND) and cmd and cmd[0] is LAMBDA:
+                return self.tail(*self.let(exp, scope, block), block)
+            if not (type(cmd) is Symbol and cmd in (QUOTE, SET, DEFINE, LAMBDA)) \
+                    and not self.primitive(cmd, scope, PREDICATES) \
+                    and not self.primitive(cmd, scope, OPERATIONS):
+                return self.tail_call(exp, scope, block)
+        block.append('return ' + self.value(exp, scope, block))
+
+    def tail_call(self, exp, scope, block):
+        fn = scope.fn
+        if (type(exp[0]) is Symbol and fn.can_loop and fn.self_ref is not None
+                and self.ref(exp[0], scope) == fn.self_ref
+                and len(exp) - 1 == len(fn.params)):
+            # call to itself, the params are rebound and the loop goes on
+            if fn.self_ref[0] == 'local' and exp[0] not in self.assigned:
+                args = self.values(exp[1:], scope, block)
+                self.loop(fn, args, block)
+                return
+            # a global variable, or a local the program set!s, may have
+            # been bound to another procedure since, the loop goes on
+            # while it is bound to fn's entry
+            if fn.entry is None:
+                fn.entry = self.fresh('entry')
+            proc = self.fresh('proc')
+            block.append('%s = %s' % (proc, self.variable(exp[0], scope)))
+            args = self.values(exp[1:], scope, block)
+            block.append('if %s is %s:' % (proc, fn.entry))
+            loop = []
+            self.loop(fn, args, loop)
+            block.extend(indent(loop))
+            fn.tail_calls = True
+            block.append('return TailCall(%s, (%s))'
+                         % (proc, ''.join(arg + ', ' for arg in args)))
+            return
+        proc, *args = self.values(exp, scope, block)
+        cmd = exp[0]
+        if type(cmd) is Symbol and not scope.resolve(cmd) \
+                and self.is_primitive(cmd):
+            # nothing to bounce back from
+            block.append('return %s(%s)' % (proc, ', '.join(args)))
+            return
+        fn.tail_calls = True
+        block.append('return TailCall(%s, (%s))'
+                     % (proc, ''.join(arg + ', ' for arg in args)))
+
+    def loop(self, fn, args, block):
+        "Jump back to the top of fn with args as its arguments"
+        if args:
+            block.append('%s = %s' % (', '.join(fn.params), ', '.join(args)))
+        block.append('continue')
+        fn.loops = True
+
+    def is_primitive(self, var):
+        "Whether var is bound to one of the primitives of GLOBAL_ENV"
+        try:
+            bound = self.env.lookup(var)
+        except LispException:
+            return False
+        return BUILTINS.get(id(bound)) is bound
+
+
+def to_python(exps, env=GLOBAL_ENV):
+    "Python source of a program, for reading"
+    return Compiler(env).program(list(exps))
+
+
+def compile_program(exps, env=GLOBAL_ENV, self_name=None):
+    """Compiles expressions into a Python function of no arguments
+    evaluating them in env, and returning the value of the last one
+    """
+    compiler = Compiler(env)
+    source = compiler.program(list(exps), self_name)
+    code = compile(source, '<scheme>', 'exec')
+    namespace = compiler.globals
+    exec(code, namespace)
+    program = namespace['program']
+    program.source = source
+    return program
+
+
+def compile_exp(exp, env=GLOBAL_ENV):
+    return compile_program([exp], env)
+
+
+def ceval(exp, env=GLOBAL_ENV):
+    "Compiles exp and runs it"
+    return compile_exp(exp, env)()
+
+
+def compile_procedure(proc, name=None):
+    """Compiled version of a compound procedure of vseval or analyze.
+    name is the variable the procedure is called through for its tail
+    calls to itself to become a loop.
+    """
+    exp = [LAMBDA, proc.params, proc.body]
+    return compile_program([exp], proc.env, name)()
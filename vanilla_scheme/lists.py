@@ -0,0 +1,178 @@
+""" Pairs and the list primitives of the global environment
+
+The empty list is the Python [], a list is a chain of Pairs ending
+with it. The primitives walk the chains in plain loops, so they work
+on lists of any length without recursion.
+"""
+__all__ = ['Pair', 'lisp_list', 'length', 'append', 'reverse', 'list_ref',
+           'list_to_vector', 'vector_to_list', 'write', 'display']
+
+import sys
+
+from SICP.vanilla_scheme.vectors import Vector, make_data
+
+
+class Pair:
+    "cons cell"
+    __slots__ = ('car', 'cdr')
+
+    def __init__(self, car, cdr):
+        self.car = car
+        self.cdr = cdr
+
+    def __iter__(self):
+        pair = self
+        while isinstance(pair, Pair):
+            yield pair.car
+            pair = pair.cdr
+
+    def __eq__(self, other):
+        if not isinstance(other, Pair):
+            return NotImplemented
+        a, b = self, other
+        while isinstance(a, Pair) and isinstance(b, Pair):
+            if a is b:
+                return True
+            if a.car != b.car:
+                return False
+            a, b = a.cdr, b.cdr
+        if isinstance(a, Pair) or isinstance(b, Pair):
+            return False
+        return a == b
+
+    __hash__ = None
+
+    def __str__(self):
+        return ''.join(write(self))
+
+    __repr__ = __str__
+
+
+def is_null(x):
+    return type(x) is list and not x
+
+
+def from_iterable(items, tail=None):
+    "List of items, ending with tail instead of () when given"
+    result = [] if tail is None else tail
+    for x in reversed(items):
+        result = Pair(x, result)
+    return result
+
+
+def lisp_list(*args):
+    return from_iterable(args)
+
+
+def length(xs):
+    n = 0
+    while isinstance(xs, Pair):
+        n += 1
+        xs = xs.cdr
+    if not is_null(xs):
+        raise ValueError("length: improper list")
+    return n
+
+
+def append(*lists):
+    "Copies every list but the last one, which is shared"
+    if not lists:
+        return []
+    *heads, result = lists
+    for xs in reversed(heads):
+        result = from_iterable(list(xs), result)
+    return result
+
+
+def reverse(xs):
+    result = []
+    while isinstance(xs, Pair):
+        result = Pair(xs.car, result)
+        xs = xs.cdr
+    return result
+
+
+def list_ref(xs, k):
+    for _ in range(k):
+        xs = xs.cdr
+    return xs.car
+
+
+def list_to_vector(xs):
+    return Vector(make_data(xs if isinstance(xs, Pair) else ()))
+
+
+def vector_to_list(v):
+    return from_iterable(list(v))
+
+
+def lisp_map(apply, fn, *lists):
+    """Maps fn over the lists, up to the shortest one.
+    apply(fn, args) calls a procedure of the evaluator.
+    """
+    if len(lists) == 1:
+        items = [apply(fn, [x]) for x in lists[0]]
+    else:
+        items = [apply(fn, list(args)) for args in zip(*lists)]
+    return from_iterable(items)
+
+
+def for_each(apply, fn, *lists):
+    for args in zip(*lists):
+        apply(fn, list(args))
+
+
+# marks the dotted tail of an improper list while printing
+DOT = object()
+END = object()
+
+
+def elements(pair):
+    while isinstance(pair, Pair):
+        yield pair.car
+        pair = pair.cdr
+    if not is_null(pair):
+        yield DOT
+        yield pair
+
+
+def write(value):
+    """Pieces of the printed form of value. Nested lists and vectors
+    are walked with a stack of iterators instead of recursion, and no
+    string is built for a list as a whole.
+    """
+    stack = []
+    sep = ''
+    while True:
+        if isinstance(value, Pair):
+            yield sep + '('
+            stack.append(elements(value))
+            sep = ''
+        elif isinstance(value, Vector):
+            yield sep + '#('
+            stack.append(iter(value))
+            sep = ''
+        elif value is DOT:
+            yield ' .'
+        elif type(value) is list and not value:
+            yield sep + '()'
+            sep = ' '
+        else:
+            yield sep + str(value)
+            sep = ' '
+
+        while stack:
+            value = next(stack[-1], END)
+            if value is not END:
+                break
+            stack.pop()
+            yield ')'
+            sep = ' '
+        else:
+            return
+
+
+def display(value, out=None):
+    out = sys.stdout if out is None else out
+    out.writelines(write(value))
+    out.write('\n')
@@ -0,0 +1,168 @@
+""" Call statistics for vseval
+
+    profiler = Profiler()
+    with profiler:
+        profiler.vseval(exp, env)
+    print(profiler.report())
+    profiler.write_folded('out.folded')   # for flamegraph.pl
+
+Profiling uses its own copy of the vseval loop, which times every
+application of a compound procedure or a primitive. While a Profiler
+is active, it is also swapped in as vseval.vseval, so evaluations
+started by primitives and environments are profiled as well. vseval
+itself is left without any instrumentation.
+
+Procedures are named after the operator they are called through,
+(lambda) when it isn't a variable. A tail call ends the caller's
+activation, since its frame is gone as well.
+"""
+__all__ = ['Profiler']
+
+import time
+from collections import Counter
+
+from SICP.vanilla_scheme import vseval as vseval_module
+from SICP.vanilla_scheme.vseval import compound_procedure, desugar, \
+    text_of_quotation, extend_frame, Symbol, BINARY, DERIVED, COMPOUND, \
+    QUOTE, SET, DEFINE, IF, LAMBDA, BEGIN, TRUE, FALSE
+
+
+class Stats:
+    __slots__ = ('calls', 'self_time', 'cumulative', 'active')
+
+    def __init__(self):
+        self.calls = 0
+        self.self_time = 0.0
+        self.cumulative = 0.0
+        # activations on the stack, recursive calls don't add
+        # to the cumulative time of the outermost one
+        self.active = 0
+
+
+class Profiler:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.stats = {}
+        # [name, start time, time spent in callees] per activation
+        self.stack = []
+        # self time by call stack, names joined with ';'
+        self.folded = Counter()
+        self.vseval = self.make_evaluator()
+        self.saved = None
+
+    def __enter__(self):
+        self.saved = vseval_module.vseval
+        vseval_module.vseval = self.vseval
+        return self
+
+    def __exit__(self, *exc):
+        vseval_module.vseval = self.saved
+        self.saved = None
+
+    def enter(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = Stats()
+        stats.calls += 1
+        stats.active += 1
+        self.stack.append([name, self.clock(), 0.0])
+
+    def leave(self):
+        now = self.clock()
+        stack = self.stack
+        name, start, callees = stack.pop()
+        elapsed = now - start
+        stats = self.stats[name]
+        stats.self_time += elapsed - callees
+        stats.active -= 1
+        if not stats.active:
+            stats.cumulative += elapsed
+        if stack:
+            stack[-1][2] += elapsed
+        path = ';'.join([frame[0] for frame in stack] + [name])
+        self.folded[path] += elapsed - callees
+
+    def make_evaluator(self):
+        "vseval, timing each application"
+        enter, leave = self.enter, self.leave
+
+        def vseval(exp, env):
+            # whether this call has an activation of a compound procedure
+            entered = False
+            try:
+                while True:
+                    if type(exp) is Symbol:
+                        if exp is TRUE or exp is FALSE:
+                            return exp
+                        return env.lookup(exp)
+                    if not isinstance(exp, COMPOUND):
+                        return exp
+
+                    cmd, *args = exp
+
+                    if cmd is QUOTE:
+                        return text_of_quotation(exp, env)
+                    if cmd is SET:
+                        return env.assign(exp)
+                    if cmd is DEFINE:
+                        return env.define(desugar(exp))
+                    if cmd is IF:
+                        test, yes, no = args
+                        exp = yes if vseval(test, env) is not FALSE else no
+                        continue
+                    if cmd is LAMBDA:
+                        params, body, layout = desugar(exp)
+                        return compound_procedure(params, body, env, layout)
+                    if cmd is BEGIN:
+                        *actions, exp = args
+                        for act in actions:
+                            vseval(act, env)
+                        continue
+                    if type(cmd) is Symbol and cmd in DERIVED:
+                        exp = desugar(exp)
+                        continue
+                    proc = vseval(cmd, env)
+                    args = [vseval(arg, env) for arg in args]
+                    name = cmd if type(cmd) is Symbol else '(lambda)'
+
+                    if isinstance(proc, compound_procedure):
+                        if entered:
+                            leave()
+                        enter(name)
+                        entered = True
+                        env = extend_frame(proc.layout, args, proc.env)
+                        exp = proc.body
+                        continue
+                    enter(name)
+                    try:
+                        if len(args) == 2:
+                            entry = BINARY.get(id(proc))
+                            if entry is not None and entry[0] is proc:
+                                return entry[1](args[0], args[1])
+                        return proc(*args)
+                    finally:
+                        leave()
+            finally:
+                if entered:
+                    leave()
+        return vseval
+
+    def top(self, n=10, key='self_time'):
+        "(name, Stats) of the n procedures with the largest key"
+        return sorted(self.stats.items(), key=lambda item: getattr(item[1], key),
+                      reverse=True)[:n]
+
+    def report(self, n=10, key='self_time'):
+        lines = ['%-24s %10s %12s %12s' % ('procedure', 'calls', 'self(s)', 'cumulative(s)')]
+        for name, stats in self.top(n, key):
+            lines.append('%-24s %10d %12.6f %12.6f'
+                         % (name, stats.calls, stats.self_time, stats.cumulative))
+        return '\n'.join(lines)
+
+    def write_folded(self, path):
+        """Folded stacks, one 'a;b;c microseconds' line per call stack,
+        the input of flamegraph.pl and speedscope
+        """
+        with open(path, 'w') as out:
+            for stack, seconds in sorted(self.folded.items()):
+                out.write('%s %d\n' % (stack, round(seconds * 1e6)))
@@ -2,7 +2,7 @@ import os
 import sys
 
 
-from SICP.lisp_parser.lp import parse
+from SICP.lisp_parser.lp import Reader
 from SICP.vanilla_scheme.vseval import *
 
 
@@ -15,28 +15,29 @@ print("""
 """)
 
 
-code_to_eval = []
+reader = Reader()
 while True:
-    if code_to_eval == []:
+    if not reader.is_reading():
         print(PROMPT, end='')
     try:
         code = input()
     except EOFError:
         print('Goodbye!!')
         break
-    else:
-        code_to_eval.append(code)
-        expr = parse(' '.join(code_to_eval))
-        # succeeds to parse
-        if expr != None:
-            try:
-                value = vseval(expr, GLOBAL_ENV)
-            except UnboundVar as e:
-                print('Unbound Variable: ', e)
-            except Exception as e:
-                print('Error: ', e)
-            else:
-                print("=> ", end='')
-                print(value)
-            finally:
-                code_to_eval = []
+    try:
+        exprs = reader.feed(code + '\n')
+    except ValueError as e:
+        print('Error: ', e)
+        reader = Reader()
+        continue
+    # each expression is evaluated as soon as it is complete
+    for expr in exprs:
+        try:
+            value = vseval(expr, GLOBAL_ENV)
+        except UnboundVar as e:
+            print('Unbound Variable: ', e)
+        except Exception as e:
+            print('Error: ', e)
+        else:
+            print("=> ", end='')
+            print(value)
@@ -1,106 +1,143 @@
+import io
+import math
 import os
 import sys
+import tempfile
+import warnings
+from functools import partial
 
-from SICP.lisp_parser.lp import parse
+from SICP.lisp_parser.lp import parse, parse_all, parse_tree
 from SICP.vanilla_scheme.vseval import *
+from SICP.vanilla_scheme.vseval import apply
+from SICP.vanilla_scheme.analyze import aeval
+from SICP.vanilla_scheme.compiler import ceval, compile_program, \
+    compile_procedure, to_python
+from SICP.vanilla_scheme.profiler import Profiler
+from SICP.vanilla_scheme import vseval as vseval_module
+from SICP.vanilla_scheme import lists, vectors
 import unittest
 
 
-def ev(exp, env=GLOBAL_ENV):
-    return vseval(parse(exp), env)
-
-
 class EVALTest(unittest.TestCase):
+    evaluator = staticmethod(vseval)
+
+    def ev(self, exp, env=GLOBAL_ENV):
+        return self.evaluator(parse(exp), env)
 
     def test_selfeval(self):
-        self.assertEqual(ev('30'), 30)
-        self.assertEqual(ev("32.3"), 32.3)
-        self.assertEqual(ev('  "Hello World!"  '), '"Hello World!"')
+        self.assertEqual(self.ev('30'), 30)
+        self.assertEqual(self.ev("32.3"), 32.3)
+        self.assertEqual(self.ev('  "Hello World!"  '), '"Hello World!"')
 
     def test_lookup_simple(self):
         env = Env({'a': 30})
 
-        self.assertEqual(ev('a', env), 30)
+        self.assertEqual(self.ev('a', env), 30)
         with self.assertRaises(UnboundVar):
-            ev('b', env)
+            self.ev('b', env)
 
         env.upper = Env({'b': 20})
-        self.assertEqual(ev('b', env), 20)
+        self.assertEqual(self.ev('b', env), 20)
 
     def test_quote(self):
-        self.assertEqual(ev("'abc"), 'abc')
-        self.assertEqual(ev("'(a ( b ) c)"), ev("(list 'a (list 'b) 'c)"))
+        self.assertEqual(self.ev("'abc"), 'abc')
+        self.assertEqual(self.ev("'(a ( b ) c)"), self.ev("(list 'a (list 'b) 'c)"))
 
     def test_define_simple(self):
         env = Env()
-        ev('(define a 20)', env)
-        self.assertEqual(ev('a', env), 20)
-        ev("(define b 'abc)", env)
-        self.assertEqual(ev('b', env), 'abc')
-        ev("(define a '30.3)", env)
-        self.assertEqual(ev('a', env), 30.3)
+        self.ev('(define a 20)', env)
+        self.assertEqual(self.ev('a', env), 20)
+        self.ev("(define b 'abc)", env)
+        self.assertEqual(self.ev('b', env), 'abc')
+        self.ev("(define a '30.3)", env)
+        self.assertEqual(self.ev('a', env), 30.3)
 
     def test_assignment_simple(self):
         env = Env()
-        ev('(define a 10)', env)
-        self.assertEqual(ev('a', env), 10)
-        ev('(set! a 30)', env)
-        self.assertEqual(ev('a', env), 30)
+        self.ev('(define a 10)', env)
+        self.assertEqual(self.ev('a', env), 10)
+        self.ev('(set! a 30)', env)
+        self.assertEqual(self.ev('a', env), 30)
         with self.assertRaises(UnboundVar):
-            ev('(set! b 10)', env)
+            self.ev('(set! b 10)', env)
 
     def test_if(self):
-        self.assertEqual(ev('(if true 10 20)'), 10)
-        self.assertEqual(ev('(if 1 10 20)'), 10)
-        self.assertEqual(ev('(if false 10 20)'), 20)
+        self.assertEqual(self.ev('(if true 10 20)'), 10)
+        self.assertEqual(self.ev('(if 1 10 20)'), 10)
+        self.assertEqual(self.ev('(if false 10 20)'), 20)
+
+    def test_string_literal(self):
+        self.assertEqual(self.ev('"false"'), '"false"')
+        self.assertEqual(self.ev('(if "false" 10 20)'), 10)
+        self.assertEqual(self.ev('(if (not false) 10 20)'), 10)
 
     def test_eval_sequence(self):
-        self.assertEqual(ev('(begin 10 20 false)'), 'false')
+        self.assertEqual(self.ev('(begin 10 20 false)'), 'false')
 
     def test_lambda(self):
-        proc = ev('(lambda (x y) (+ x y))')
+        proc = self.ev('(lambda (x y) (+ x y))')
         self.assertEqual(proc.params, ['x', 'y'])
         self.assertEqual(proc.body, ['+', 'x', 'y'])
 
     def test_builtins(self):
-        self.assertEqual(ev('(+ 10 20 30)'), 60)
-        self.assertEqual(ev('(- 10 20 30)'), -40)
-        self.assertEqual(ev('(* 10 20 30)'), 6000)
-        self.assertEqual(ev('(/ 10 20 30)'), 10 / 20 / 30)
-        self.assertEqual(ev('(+ 1 (- 20 3) (* 4 5))'), 38)
-        self.assertEqual(ev("(cons 1 (cons 2 (cons 3 '())))"),
-                         ev("(list 1 2 3)"))
+        self.assertEqual(self.ev('(+ 10 20 30)'), 60)
+        self.assertEqual(self.ev('(- 10 20 30)'), -40)
+        self.assertEqual(self.ev('(* 10 20 30)'), 6000)
+        self.assertEqual(self.ev('(/ 10 20 30)'), 10 / 20 / 30)
+        self.assertEqual(self.ev('(+ 1 (- 20 3) (* 4 5))'), 38)
+        self.assertEqual(self.ev("(cons 1 (cons 2 (cons 3 '())))"),
+                         self.ev("(list 1 2 3)"))
         env = GLOBAL_ENV
-        ev('(define x (cons 1 (cons 2 3)))', env)
-        self.assertEqual(ev('(car (cdr x))', env), 2)
-        self.assertEqual(ev('(cdr (cdr x))', env), 3)
+        self.ev('(define x (cons 1 (cons 2 3)))', env)
+        self.assertEqual(self.ev('(car (cdr x))', env), 2)
+        self.assertEqual(self.ev('(cdr (cdr x))', env), 3)
 
-        self.assertEqual(ev("(if (not (null? '())) true false)", env), 'false')
-        self.assertEqual(ev("(if (null? '()) true false)", env), 'true')
+        self.assertEqual(self.ev("(if (not (null? '())) true false)", env), 'false')
+        self.assertEqual(self.ev("(if (null? '()) true false)", env), 'true')
         print()
-        ev('(display (list 1 2 "Do you see one, two and this in a list?"))')
+        self.ev('(display (list 1 2 "Do you see one, two and this in a list?"))')
+
+        self.assertEqual(self.ev('(= 3 4)'), 'false')
+        self.assertEqual(self.ev('(equal? (list 1 2 3) (list 1 2 3))'), 'true')
 
-        self.assertEqual(ev('(= 3 4)'), 'false')
-        self.assertEqual(ev('(equal? (list 1 2 3) (list 1 2 3))'), 'true')
+        self.assertEqual(self.ev('(= 1 1 1 1)'), 'true')
+        self.assertEqual(self.ev('(= 1 1 1 2)'), 'false')
 
-        self.assertEqual(ev('(= 1 1 1 1)'), 'true')
-        self.assertEqual(ev('(= 1 1 1 2)'), 'false')
+        self.assertEqual(self.ev('(< 1 2 3 4)'), 'true')
+        self.assertEqual(self.ev('(> 4 3 2 1)'), 'true')
+        self.assertEqual(self.ev('(<= 1 2 2 3)'), 'true')
+        self.assertEqual(self.ev('(>= 3 3 2 1)'), 'true')
 
-        self.assertEqual(ev('(< 1 2 3 4)'), 'true')
-        self.assertEqual(ev('(> 4 3 2 1)'), 'true')
-        self.assertEqual(ev('(<= 1 2 2 3)'), 'true')
-        self.assertEqual(ev('(>= 3 3 2 1)'), 'true')
+    def test_redefined_primitive(self):
+        self.ev("(define (add2 a b) (+ a b))")
+        self.assertEqual(self.ev("(add2 1 2)"), 3)
+        self.assertEqual(self.ev("((lambda (+) (+ 2 5)) *)"), 10)
+        env = Env()
+        env.upper = GLOBAL_ENV
+        self.ev("(define (- a b) 'shadowed)", env)
+        self.assertEqual(self.ev("(- 5 3)", env), 'shadowed')
+        self.assertEqual(self.ev("(- 5 3)"), 2)
+        plus = GLOBAL_ENV.lookup('+')
+        try:
+            self.ev("(set! + (lambda (a b) (* a b)))")
+            self.assertEqual(self.ev("(add2 3 4)"), 12)
+        finally:
+            GLOBAL_ENV.define_variable('+', plus)
+        self.assertEqual(self.ev("(add2 3 4)"), 7)
+        self.assertEqual(self.ev("(< 1 2)"), 'true')
+        self.assertEqual(self.ev("(>= 1 2)"), 'false')
+        self.assertEqual(self.ev("(- 10 1 2)"), 7)
 
     def test_define(self):
 
-        ev("""
+        self.ev("""
         (define (fib n)
           (if (< n 2)
               n
               (+ (fib (- n 1)) (fib (- n 2)))))
         """)
 
-        ev("""
+        self.ev("""
         (define gcd
           (lambda (a b)
             (if (= b 0)
@@ -108,7 +145,7 @@ class EVALTest(unittest.TestCase):
                 (gcd b (rem a b)))))
         """)
 
-        ev("""
+        self.ev("""
         (define (sum n)
           (define (loop n result)
             (if (= n 0)
@@ -117,67 +154,489 @@ class EVALTest(unittest.TestCase):
           (loop n 0))
         """)
 
-        ev("""
+        self.ev("""
         (define (map fn xs)
           (if (null? xs)
               '()
               (cons (fn (car xs)) (map fn (cdr xs)))))
         """)
 
-        ev("""
+        self.ev("""
         (define (odd x) (= (rem x 2) 1))
         """)
-        ev("""
+        self.ev("""
         (define (even x) (not (odd x)))
         """)
 
-        self.assertEqual(ev('(gcd 216 48)'), 24)
+        self.assertEqual(self.ev('(gcd 216 48)'), 24)
         # properly tail recursive
-        self.assertEqual(ev("(sum 2000)"), 2001000)
-        self.assertEqual(ev("(map fib '(1 2 3 4 5 6 7 8))"),
-                         ev("'(1 1 2 3 5 8 13 21)"))
-        self.assertEqual(ev("(even 20)"), 'true')
-        self.assertEqual(ev("(even 17)"), 'false')
+        self.assertEqual(self.ev("(sum 2000)"), 2001000)
+        self.assertEqual(self.ev("(map fib '(1 2 3 4 5 6 7 8))"),
+                         self.ev("'(1 1 2 3 5 8 13 21)"))
+        self.assertEqual(self.ev("(even 20)"), 'true')
+        self.assertEqual(self.ev("(even 17)"), 'false')
 
     def test_sequence(self):
-        ev("""
+        self.ev("""
         (define (foo)
           (define a 10)
           (set! a (+ a 1))
           (+ a 1))
         """)
-        self.assertEqual(ev("(foo)"), 12)
+        self.assertEqual(self.ev("(foo)"), 12)
 
     def test_scope(self):
-        ev("(define x 10)")
-        ev("""
+        self.ev("(define x 10)")
+        self.ev("""
         (define (foo x)
           (set! x 20))
         """)
-        ev("(foo 30)")
-        self.assertEqual(ev("x"), 10)
-        ev("""
+        self.ev("(foo 30)")
+        self.assertEqual(self.ev("x"), 10)
+        self.ev("""
         (define (bar)
           (set! x 1000))
         """)
-        ev("(bar)")
-        self.assertEqual(ev("x"), 1000)
+        self.ev("(bar)")
+        self.assertEqual(self.ev("x"), 1000)
+
+    def test_rebound_self_call(self):
+        env = Env()
+        env.upper = GLOBAL_ENV
+        self.ev("(define (u n) (if (= n 0) 'done (u (- n 1))))", env)
+        self.ev("(define v u)", env)
+        self.assertEqual(self.ev("(v 3)", env), 'done')
+        self.ev("(set! u (lambda (n) 'replaced))", env)
+        self.assertEqual(self.ev("(v 3)", env), 'replaced')
+        self.ev("""
+        (define (outer n)
+          (define (loop k) (if (= k 0) 'done (loop (- k 1))))
+          (define saved loop)
+          (set! loop (lambda (k) 'replaced))
+          (saved n))
+        """, env)
+        self.assertEqual(self.ev("(outer 3)", env), 'replaced')
+        self.assertEqual(self.ev("(outer 0)", env), 'done')
 
     def test_define2(self):
-        ev("""
+        self.ev("""
         (define (even? x)
           (if (= x 0)
               true
               (odd (- x 1))))
         """)
-        ev("""
+        self.ev("""
         (define (odd? x)
           (if (= x 0)
               false
               (even (- x 1))))
         """)
-        self.assertEqual(ev('(odd 17)'), 'true')
-        self.assertEqual(ev('(odd 18)'), 'false')
-        self.assertEqual(ev('(even 100)'), 'true')
+        self.assertEqual(self.ev('(odd 17)'), 'true')
+        self.assertEqual(self.ev('(odd 18)'), 'false')
+        self.assertEqual(self.ev('(even 100)'), 'true')
+
+    def test_tuple_ast(self):
+        tree = parse_tree("""
+        (define (tuple-sum xs)
+          (define (loop xs acc)
+            (if (null? xs) acc (loop (cdr xs) (+ acc (car xs)))))
+          (loop xs 0))
+        (tuple-sum '(1 2 3 4))
+        """)
+        define, call = tree.forms
+        self.evaluator(define, GLOBAL_ENV)
+        self.assertEqual(self.evaluator(call, GLOBAL_ENV), 10)
+
+    def test_nested_scope(self):
+        self.ev("""
+        (define (make-counter start)
+          (lambda (step)
+            (lambda ()
+              (set! start (+ start step))
+              start)))
+        """)
+        self.ev("(define tick ((make-counter 10) 5))")
+        self.ev("(tick)")
+        self.assertEqual(self.ev("(tick)"), 20)
+
+    def test_let(self):
+        self.assertEqual(self.ev("(let ((x 1) (y 2)) (+ x y))"), 3)
+        self.ev("""
+        (define (shadow x)
+          (let ((x (* x 10)))
+            (define y 1)
+            (+ x y)))
+        """)
+        self.assertEqual(self.ev("(shadow 4)"), 41)
+
+    def test_cond(self):
+        self.ev("""
+        (define (sign n)
+          (cond ((< n 0) 'negative)
+                ((= n 0) 'zero)
+                (else (define s 'positive) s)))
+        """)
+        self.assertEqual(self.ev("(sign -3)"), 'negative')
+        self.assertEqual(self.ev("(sign 0)"), 'zero')
+        self.assertEqual(self.ev("(sign 7)"), 'positive')
+        self.assertEqual(self.ev("(cond ((rem 7 4)) (else 0))"), 3)
+        self.assertEqual(self.ev("(cond (false 1))"), 'false')
+
+    def test_long_cond(self):
+        clauses = ' '.join('((= n %d) %d)' % (i, i) for i in range(300))
+        self.ev("(define (pick n) (cond %s (else -1)))" % clauses)
+        self.ev("(define (pick+1 n) (+ (cond %s (else -1)) 1))" % clauses)
+        self.assertEqual(self.ev("(pick 119)"), 119)
+        self.assertEqual(self.ev("(pick 1000)"), -1)
+        self.assertEqual(self.ev("(pick+1 299)"), 300)
+
+    def test_and_or(self):
+        self.assertEqual(self.ev("(and)"), 'true')
+        self.assertEqual(self.ev("(and 1 2 3)"), 3)
+        self.assertEqual(self.ev("(and 1 false 3)"), 'false')
+        self.assertEqual(self.ev("(or)"), 'false')
+        self.assertEqual(self.ev("(or false 2 3)"), 2)
+        self.assertEqual(self.ev("(or false false)"), 'false')
+        env = Env()
+        env.upper = GLOBAL_ENV
+        self.ev("(define n 0)", env)
+        self.ev("(or (begin (set! n (+ n 1)) n) 0)", env)
+        self.assertEqual(self.ev("n", env), 1)
+
+    def test_desugar_once(self):
+        exp = parse("(define (f x) (+ x 1) x)")
+        self.assertIs(desugar(exp), desugar(exp))
+        params, body, layout = desugar(desugar(exp)[2])
+        self.assertEqual(body, ['begin', ['+', 'x', 1], 'x'])
+        exp = parse("(lambda (x) (let ((y x)) y))")
+        f = self.evaluator(exp, GLOBAL_ENV)
+        g = self.evaluator(exp, GLOBAL_ENV)
+        self.assertIs(f.body, g.body)
+        env = Env({'f': f})
+        env.upper = GLOBAL_ENV
+        self.assertEqual(self.ev("(f 5)", env), 5)
+
+    def test_desugar_bounded(self):
+        maxsize = vseval_module.DESUGARED_MAXSIZE
+        vseval_module.DESUGARED_MAXSIZE = 10
+        try:
+            for i in range(100):
+                f = self.evaluator(parse("(lambda (x) (let ((y x)) y))"), GLOBAL_ENV)
+                self.assertEqual(apply(f, [i]), i)
+            self.assertLessEqual(len(vseval_module.DESUGARED), 10)
+        finally:
+            vseval_module.DESUGARED_MAXSIZE = maxsize
+
+    def test_list_primitives(self):
+        self.assertEqual(self.ev("(length '(1 2 3))"), 3)
+        self.assertEqual(self.ev("(length '())"), 0)
+        self.assertEqual(self.ev("(append '(1) '() '(2 3) '(4))"),
+                         self.ev("'(1 2 3 4)"))
+        self.assertEqual(self.ev("(reverse '(1 2 3))"), self.ev("'(3 2 1)"))
+        self.assertEqual(self.ev("(list-ref '(a b c) 2)"), 'c')
+        self.assertEqual(self.ev("(list->vector '(1 2))"), self.ev("(vector 1 2)"))
+        self.assertEqual(self.ev("(vector->list (list->vector '(1 2)))"),
+                         self.ev("'(1 2)"))
+        self.assertEqual(self.ev("(pair? '(1))"), 'true')
+        self.assertEqual(self.ev("(pair? '())"), 'false')
+        self.assertEqual(str(self.ev("(cons 1 (cons '(2 3) 4))")), '(1 (2 3) . 4)')
+
+    def test_map(self):
+        # test_define replaces map in GLOBAL_ENV with a Scheme one
+        env = Env({'map': partial(lists.lisp_map, apply)})
+        env.upper = GLOBAL_ENV
+        self.assertEqual(self.ev("(map (lambda (x) (* x x)) '(1 2 3))", env),
+                         self.ev("'(1 4 9)"))
+        self.assertEqual(self.ev("(map + '(1 2 3) '(10 20))", env),
+                         self.ev("'(11 22)"))
+
+    def test_procedure_through_primitive(self):
+        # the primitives call the procedure with a tuple of arguments
+        self.assertEqual(self.ev("(map (lambda (x) (set! x (+ x 1)) x) (list 1 2))"),
+                         self.ev("'(2 3)"))
+        self.assertEqual(self.ev("""
+        (map (lambda (x) (define y (* x 10)) (+ x y)) (list 1 2))
+        """), self.ev("'(11 22)"))
+        self.assertEqual(list(self.ev("""
+        (vector-map (lambda (x) (define y x) (* y y)) (vector 1 2 3))
+        """)), [1, 4, 9])
+
+    def test_deep_env_chain(self):
+        env = Env({'deep': 1})
+        for _ in range(5000):
+            upper, env = env, Env()
+            env.upper = upper
+        self.assertEqual(self.ev('deep', env), 1)
+        self.ev('(set! deep 2)', env)
+        self.assertEqual(self.ev('deep', env), 2)
+
+
+class AnalyzeTest(EVALTest):
+    "The same suite on the analyzing evaluator"
+    evaluator = staticmethod(aeval)
+
+    def test_tail_call_in_analyzed_procedure(self):
+        self.ev("""
+        (define (count n)
+          (if (= n 0)
+              'done
+              (count (- n 1))))
+        """)
+        self.assertEqual(self.ev("(count 100000)"), 'done')
+
+
+class CompileTest(EVALTest):
+    "The same suite on code compiled to Python"
+    evaluator = staticmethod(ceval)
+
+    def test_lambda(self):
+        proc = self.ev('(lambda (x y) (+ x y))')
+        self.assertEqual(proc(1, 2), 3)
+
+    def test_desugar_once(self):
+        exp = parse("(lambda (x) (let ((y x)) y))")
+        self.assertEqual(self.evaluator(exp, GLOBAL_ENV)(5), 5)
+
+    def test_redefined_primitive(self):
+        # open-coded when compiled, like in SICP 5.5.5
+        self.assertEqual(self.ev("((lambda (+) (+ 2 5)) *)"), 10)
+        env = Env()
+        env.upper = GLOBAL_ENV
+        self.ev("(define (- a b) 'shadowed)", env)
+        self.assertEqual(self.ev("(- 5 3)", env), 'shadowed')
+        self.assertEqual(self.ev("(- 5 3)"), 2)
+        self.assertEqual(self.ev("(- 10 1 2)"), 7)
+        # redefined by the program being compiled, before or after a use
+        env = Env()
+        env.upper = GLOBAL_ENV
+        program = compile_program(parse_all("(define (+ a b) (- a b)) (+ 5 3)"), env)
+        self.assertEqual(program(), 2)
+        env = Env()
+        env.upper = GLOBAL_ENV
+        program = compile_program(parse_all("""
+        (define (add a b) (+ a b))
+        (define (+ a b) (* a b))
+        (add 5 3)
+        """), env)
+        self.assertEqual(program(), 15)
+
+    def test_loops(self):
+        defs = parse_all("""
+        (define (count-up n acc)
+          (if (= n 0) acc (count-up (- n 1) (+ acc 1))))
+        (define (thunks n acc)
+          (if (= n 0) acc (thunks (- n 1) (cons (lambda () n) acc))))
+        """)
+        self.assertIn('while True', to_python(defs[:1]))
+        self.assertNotIn('while True', to_python(defs[1:]))
+        for exp in defs:
+            self.evaluator(exp, GLOBAL_ENV)
+        self.assertEqual(self.ev("(count-up 100000 0)"), 100000)
+        self.assertEqual(self.ev("((car (thunks 3 '())))"), 1)
+
+    def test_literal_tests(self):
+        # folded, `is` with a literal would be a SyntaxWarning
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertEqual(self.ev("(if 1 'yes 'no)"), 'yes')
+            self.assertEqual(self.ev("(if '-2.5 'yes 'no)"), 'yes')
+            self.assertEqual(self.ev("(cond (0 'zero) (else 'other))"), 'zero')
+            self.assertEqual(self.ev("(not 0)"), 'false')
+            self.assertEqual(self.ev("(if (not 0) 'yes 'no)"), 'no')
+
+    def test_mutual_tail_calls(self):
+        self.ev("(define (ping n) (if (= n 0) 'ping (pong (- n 1))))")
+        self.ev("(define (pong n) (if (= n 0) 'pong (ping (- n 1))))")
+        self.assertEqual(self.ev("(ping 100001)"), 'pong')
+
+    def test_interpreted_interop(self):
+        env = Env()
+        env.upper = GLOBAL_ENV
+        vseval(parse("(define (twice f x) (f (f x)))"), env)
+        self.ev("(define (inc x) (+ x 1))", env)
+        self.assertEqual(self.ev("(twice inc 1)", env), 3)
+        self.assertEqual(vseval(parse("(twice inc 5)"), env), 7)
+        aeval(parse("(define (count n) (if (= n 0) 'done (count (- n 1))))"), env)
+        self.assertEqual(self.ev("(count 1000)", env), 'done')
+
+    def test_compile_procedure(self):
+        env = Env()
+        env.upper = GLOBAL_ENV
+        vseval(parse("""
+        (define (loop n acc)
+          (if (= n 0) acc (loop (- n 1) (+ acc n))))
+        """), env)
+        env.define_variable('loop', compile_procedure(env.lookup('loop'), 'loop'))
+        self.assertEqual(vseval(parse("(loop 100000 0)"), env), 5000050000)
+
+
+class ListsTest(unittest.TestCase):
+    "Pairs and list primitives, without an evaluator"
+
+    def test_long_lists(self):
+        n = 200000
+        xs = lists.from_iterable(range(n))
+        self.assertEqual(lists.length(xs), n)
+        self.assertEqual(xs, lists.reverse(lists.reverse(xs)))
+        self.assertEqual(len(str(xs)), len(' '.join(map(str, range(n)))) + 2)
+        nested = []
+        for _ in range(100000):
+            nested = lists.lisp_list(nested)
+        out = io.StringIO()
+        lists.display(nested, out)
+        self.assertEqual(out.getvalue(), '(' * 100000 + '()' + ')' * 100000 + '\n')
+
+
+class VectorTest(unittest.TestCase):
+    "Vector primitives, on NumPy arrays when NumPy is installed"
+
+    def ev(self, exp):
+        return vseval(parse(exp), GLOBAL_ENV)
+
+    def test_construction(self):
+        self.assertEqual(str(self.ev("(vector 1 2.5 'a)")), '#(1 2.5 a)')
+        self.assertEqual(str(self.ev("(make-vector 3 7)")), '#(7 7 7)')
+        self.assertEqual(str(self.ev("(vector-range 0 10 3)")), '#(0 3 6 9)')
+        self.assertEqual(self.ev("(vector-length (vector-range 0 1 0.25))"), 4)
+        self.assertEqual(str(self.ev("(list (vector))")), '(#())')
+        # ints and floats together keep their types
+        self.assertIs(type(self.ev("(vector-ref (vector 1 2.5) 0)")), int)
+        self.assertEqual(str(self.ev("(vector-range 0 2.5)")), '#(0 1 2)')
+        self.assertEqual(str(self.ev("(vector-range 0 1 0.5)")), '#(0.0 0.5)')
+
+    def test_ref_set_slice(self):
+        v = self.ev("(vector-range 0 10)")
+        self.assertEqual(vectors.vector_ref(v, 3), 3)
+        self.assertEqual(str(vectors.vector_slice(v, 2, 5)), '#(2 3 4)')
+        vectors.vector_set(v, 0, 0.5)
+        vectors.vector_set(v, 1, 'x')
+        vectors.vector_set(v, 2, 1 << 70)
+        self.assertEqual(list(v)[:3], [0.5, 'x', 1 << 70])
+        self.assertEqual(vectors.vector_ref(v, 9), 9)
+
+        v = self.ev("(make-vector 2 1.5)")
+        vectors.vector_set(v, 0, 1 << 96)
+        vectors.vector_set(v, 1, 2)
+        self.assertEqual(vectors.vector_ref(v, 0), 1 << 96)
+        self.assertIs(type(vectors.vector_ref(v, 1)), int)
+
+    def test_elementwise(self):
+        self.assertEqual(self.ev("(v+ (vector 1 2 3) (vector 10 20 30))"),
+                         self.ev("(vector 11 22 33)"))
+        self.assertEqual(self.ev("(v* (vector 1 2 3) 2)"), self.ev("(vector 2 4 6)"))
+        self.assertEqual(self.ev("(v+ 0.5 (vector 1 2))"), self.ev("(vector 1.5 2.5)"))
+        with self.assertRaises(ValueError):
+            self.ev("(v+ (vector 1) (vector 1 2))")
+
+    def test_map_reduce(self):
+        self.assertEqual(self.ev("(vector-sum (vector-range 0 101))"), 5050)
+        self.assertEqual(self.ev("(vector-reduce + 0 (vector 1 2 3))"), 6)
+        self.assertEqual(self.ev("(vector-reduce * 2 (vector 1 2 3))"), 12)
+        self.assertEqual(self.ev("(vector-reduce (lambda (a x) (- a x)) 10 (vector 1 2))"), 7)
+        self.assertEqual(self.ev("(vector-map (lambda (x) (* x x)) (vector 1 2 3))"),
+                         self.ev("(vector 1 4 9)"))
+        self.assertEqual(self.ev("(vector->list (vector-map (lambda (x) 'a) (vector 1)))"),
+                         self.ev("'(a)"))
+
+    def test_overflow(self):
+        # exact as Python integers, never wrapped around
+        self.assertEqual(self.ev("(vector-reduce * 1 (vector-range 1 30))"),
+                         math.factorial(29))
+        big = 1 << 62
+        self.assertEqual(self.ev("(vector-sum (make-vector 4 %d))" % big), 4 * big)
+        self.assertEqual(list(self.ev("(v* (vector 4000000000 1) 4000000000)")),
+                         [16 * 10 ** 18, 4000000000])
+        self.assertEqual(list(self.ev("(v+ (vector 1 2) 100000000000000000000)")),
+                         [10 ** 20 + 1, 10 ** 20 + 2])
+        self.assertEqual(list(self.ev("(v+ (vector %d) (vector %d))" % (big, big))),
+                         [2 * big])
+        self.assertEqual(list(self.ev("(make-vector 2 %d)" % (1 << 70))),
+                         [1 << 70] * 2)
+        self.assertEqual(list(self.ev("(vector-range %d %d)" % (1 << 70, (1 << 70) + 2))),
+                         [1 << 70, (1 << 70) + 1])
+
+
+class ArrayVectorTest(VectorTest):
+    "The same suite on the array.array fallback"
+
+    def setUp(self):
+        self.numpy, vectors.numpy = vectors.numpy, None
+
+    def tearDown(self):
+        vectors.numpy = self.numpy
+
+
+@unittest.skipUnless(vectors.numpy, 'NumPy is not installed')
+class NumpyVectorTest(unittest.TestCase):
+    "Integers stay in NumPy arrays only while their results fit"
+
+    def ev(self, exp):
+        return vseval(parse(exp), GLOBAL_ENV)
+
+    def test_backend(self):
+        v = self.ev("(v* (vector-range 0 1000) 3)")
+        self.assertTrue(vectors.is_ndarray(v.data))
+        self.assertEqual(vectors.vector_sum(v), 3 * 999 * 1000 // 2)
+        v = self.ev("(v* (vector 4000000000 1) 4000000000)")
+        self.assertIsInstance(v.data, list)
+        v = self.ev("(vector-range 1 30)")
+        self.assertEqual(vectors.vector_product(v), math.factorial(29))
+        self.assertEqual(vectors.vector_product(vectors.vector_slice(v, 0, 10)),
+                         math.factorial(10))
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.env = Env()
+        self.env.upper = GLOBAL_ENV
+        for exp in parse_all("""
+        (define (fib n)
+          (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+        (define (count n) (if (= n 0) 'done (count (- n 1))))
+        (define (squares xs) (for-each (lambda (x) (* x x)) xs))
+        """):
+            vseval(exp, self.env)
+
+    def test_call_counts(self):
+        profiler = Profiler()
+        with profiler:
+            self.assertEqual(profiler.vseval(parse("(fib 10)"), self.env), 55)
+        self.assertIs(vseval_module.vseval, vseval)
+        stats = profiler.stats
+        self.assertEqual(stats['fib'].calls, 177)
+        self.assertEqual(stats['+'].calls, 88)
+        self.assertEqual(stats['<'].calls, 177)
+        self.assertAlmostEqual(stats['fib'].cumulative,
+                               sum(s.self_time for s in stats.values()))
+        self.assertEqual(profiler.stack, [])
+        self.assertIn('fib', dict(profiler.top(3)))
+        self.assertIn('fib', profiler.report())
+
+    def test_tail_calls_and_callbacks(self):
+        profiler = Profiler()
+        depths = []
+        enter = profiler.enter
+        profiler.enter = lambda name: (enter(name), depths.append(len(profiler.stack)))
+        profiler.vseval = profiler.make_evaluator()
+        with profiler:
+            profiler.vseval(parse("(count 1000)"), self.env)
+            profiler.vseval(parse("(squares '(1 2 3))"), self.env)
+        self.assertLessEqual(max(depths), 3)
+        self.assertEqual(profiler.stats['count'].calls, 1001)
+        # the lambda is applied by a primitive, through vseval.apply
+        self.assertEqual(profiler.stats['*'].calls, 3)
+
+    def test_folded(self):
+        profiler = Profiler(clock=iter(range(10 ** 6)).__next__)
+        profiler.vseval(parse("(fib 3)"), self.env)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'fib.folded')
+            profiler.write_folded(path)
+            with open(path) as f:
+                lines = f.read().splitlines()
+        self.assertIn('fib;fib;fib;< 2000000', lines)
+        self.assertTrue(all(line.startswith('fib') for line in lines))
+
 
 unittest.main()
@@ -0,0 +1,242 @@
+""" Vectors and their bulk primitives
+
+A Vector of numbers keeps them in a NumPy array when NumPy is
+installed, and in an array.array otherwise, so that v+, v*,
+vector-sum and vector-reduce with + or * run without interpreting
+a Scheme procedure per element. Anything else is kept in a list,
+mixed integers and floats too, so that every element keeps its type.
+
+Integers are stored in 64 bits while they fit. Before bulk arithmetic
+on NumPy integers, a bound of the results is checked, and when they
+could leave 64 bits the result is computed with Python integers
+instead, so it is exact as with the array.array backend, which
+switches to a list.
+"""
+__all__ = ['Vector', 'make_data', 'vector', 'make_vector', 'vector_range',
+           'vector_ref', 'vector_set', 'vector_length', 'vector_slice',
+           'vector_map', 'vector_reduce', 'vector_sum', 'add', 'multiply']
+
+import operator
+from array import array
+from functools import reduce
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Vector:
+    "Fixed length sequence, data is a NumPy array, an array.array or a list"
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        if is_ndarray(self.data):
+            # Python numbers instead of NumPy scalars
+            return iter(self.data.tolist())
+        return iter(self.data)
+
+    def __eq__(self, other):
+        if not isinstance(other, Vector):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            x == y for x, y in zip(self, other))
+
+    __hash__ = None
+
+    def __str__(self):
+        from SICP.vanilla_scheme.lists import write
+        return ''.join(write(self))
+
+    __repr__ = __str__
+
+
+INT64_MAX = (1 << 63) - 1
+
+
+def is_ndarray(data):
+    return numpy is not None and isinstance(data, numpy.ndarray)
+
+
+def is_int64(x):
+    "Whether x is an integer that fits in 64 bits"
+    return type(x) is int and -INT64_MAX - 1 <= x <= INT64_MAX
+
+
+def magnitude(x):
+    "Largest absolute value of the NumPy integers x, or of the number x"
+    if is_ndarray(x):
+        return max(-int(x.min()), int(x.max())) if len(x) else 0
+    return abs(x)
+
+
+def may_overflow(op, xs, ys):
+    """Whether op on NumPy integers and integers xs and ys could leave
+    64 bits. op is + or *, for which op(|x|, |y|) bounds |op(x, y)|.
+    """
+    for x in (xs, ys):
+        if not (type(x) is int or is_ndarray(x) and x.dtype.kind == 'i'):
+            return False
+    return op(magnitude(xs), magnitude(ys)) > INT64_MAX
+
+
+def make_data(items):
+    "Storage for items, typed when they are all ints or all floats"
+    items = list(items)
+    kinds = set(map(type, items))
+    if kinds <= {int}:
+        typecode, dtype = 'q', 'int64'
+    elif kinds == {float}:
+        typecode, dtype = 'd', 'float64'
+    else:
+        return items
+    try:
+        if numpy is not None:
+            return numpy.array(items, dtype=dtype)
+        return array(typecode, items)
+    except OverflowError:
+        return items
+
+
+def scalar(x):
+    "NumPy scalars are returned to Scheme as Python numbers"
+    return x.item() if numpy is not None and isinstance(x, numpy.generic) else x
+
+
+def vector(*items):
+    return Vector(make_data(items))
+
+
+def make_vector(n, fill=0):
+    if numpy is not None and (type(fill) is float or is_int64(fill)):
+        return Vector(numpy.full(n, fill))
+    return Vector(make_data([fill] * n))
+
+
+def vector_range(start, end, step=1):
+    "start, start + step, ... up to but not including end"
+    if numpy is not None and all(type(x) is float or is_int64(x)
+                                 for x in (start, end, step)):
+        # the elements are ints when start and step are, whatever end is
+        ints = type(start) is int and type(step) is int
+        return Vector(numpy.arange(start, end, step,
+                                   dtype='int64' if ints else 'float64'))
+    if type(start) is int and type(end) is int and type(step) is int:
+        return Vector(make_data(range(start, end, step)))
+    n = max(0, -int((start - end) // step))
+    return Vector(make_data([start + i * step for i in range(n)]))
+
+
+def vector_ref(v, i):
+    return scalar(v.data[i])
+
+
+def fits(data, x):
+    "Whether x can be stored in data without a conversion"
+    if isinstance(data, list):
+        return True
+    floats = data.dtype.kind == 'f' if is_ndarray(data) else data.typecode == 'd'
+    return type(x) is (float if floats else int)
+
+
+def vector_set(v, i, x):
+    if fits(v.data, x):
+        try:
+            v.data[i] = x
+            return
+        except OverflowError:
+            pass
+    items = list(v)
+    items[i] = x
+    v.data = make_data(items)
+
+
+def vector_length(v):
+    return len(v.data)
+
+
+def vector_slice(v, start, end=None):
+    "A new vector of the elements from start up to end"
+    data = v.data[start:end]
+    return Vector(data.copy() if is_ndarray(data) else data)
+
+
+def elementwise(op):
+    """Primitive applying op to the elements of two vectors of the
+    same length, or of a vector and a number
+    """
+    def primitive(a, b):
+        xs = a.data if isinstance(a, Vector) else a
+        ys = b.data if isinstance(b, Vector) else b
+        if isinstance(a, Vector) and isinstance(b, Vector):
+            if len(xs) != len(ys):
+                raise ValueError("vectors of different lengths")
+            if (is_ndarray(xs) and is_ndarray(ys)
+                    and not may_overflow(op, xs, ys)):
+                return Vector(op(xs, ys))
+            return Vector(make_data(map(op, a, b)))
+        if (is_ndarray(xs) or is_ndarray(ys)) and not may_overflow(op, xs, ys):
+            return Vector(op(xs, ys))
+        # iterating the vector gives Python numbers
+        if isinstance(a, Vector):
+            return Vector(make_data([op(x, ys) for x in a]))
+        return Vector(make_data([op(xs, y) for y in b]))
+    return primitive
+
+
+add = elementwise(operator.add)
+multiply = elementwise(operator.mul)
+
+
+def vector_sum(v):
+    data = v.data
+    if is_ndarray(data):
+        if data.dtype.kind == 'i' and len(data) * magnitude(data) > INT64_MAX:
+            return sum(data.tolist())
+        return data.sum().item()
+    return sum(data)
+
+
+def vector_product(v):
+    data = v.data
+    if is_ndarray(data):
+        # |product| < 2 ** (len * bits of the largest |element|)
+        if (data.dtype.kind == 'i'
+                and len(data) * magnitude(data).bit_length() > 63):
+            return reduce(operator.mul, data.tolist(), 1)
+        return data.prod().item()
+    return reduce(operator.mul, data, 1)
+
+
+def sum_reducer(init, v):
+    return init + vector_sum(v)
+
+
+def product_reducer(init, v):
+    return init * vector_product(v)
+
+
+def vector_map(apply, fn, v):
+    return Vector(make_data([apply(fn, [x]) for x in v]))
+
+
+def vector_reduce(apply, bulk, fn, init, v):
+    """Folds v from the left with fn, starting from init.
+    bulk maps primitives to functions reducing a whole vector.
+    """
+    try:
+        reducer = bulk.get(fn)
+    except TypeError:
+        # fn isn't hashable
+        reducer = None
+    if reducer is not None:
+        return reducer(init, v)
+    for x in v:
+        init = apply(fn, [init, x])
+    return init
@@ -1,6 +1,8 @@
-__all__ = ['vseval', 'Env', 'UnboundVar', 'GLOBAL_ENV']
+__all__ = ['vseval', 'desugar', 'Env', 'UnboundVar', 'GLOBAL_ENV']
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+
+from SICP.lisp_parser.lp import Symbol
 
 
 class LispException(Exception):
@@ -9,180 +11,430 @@ class LispException(Exception):
 
 class UnboundVar(LispException):
     pass
-compound_procedure = namedtuple('compound_procedure', 'params, body, env')
+
+
+# keywords and booleans, Symbols are interned so they are compared with `is`
+QUOTE = Symbol('quote')
+SET = Symbol('set!')
+DEFINE = Symbol('define')
+IF = Symbol('if')
+LAMBDA = Symbol('lambda')
+BEGIN = Symbol('begin')
+LIST = Symbol('list')
+TRUE = Symbol('true')
+FALSE = Symbol('false')
+# derived forms, rewritten into the ones above by desugar
+LET = Symbol('let')
+COND = Symbol('cond')
+ELSE = Symbol('else')
+AND = Symbol('and')
+OR = Symbol('or')
+# the reader never produces a symbol with a space, so it can't be captured
+OR_VALUE = Symbol(' or')
+
+# compound expressions are lists, or tuples when read by parse_tree
+COMPOUND = (list, tuple)
+
+
+# id of a variadic primitive => (the primitive, its two-argument form),
+# the primitive is kept in the entry so that its id can't be reused
+BINARY = {}
+
+
+# layout maps params and internal definitions to frame indices
+class compound_procedure(namedtuple('compound_procedure', 'params, body, env, layout')):
+    __slots__ = ()
+
+    def __call__(self, *args):
+        # so that primitives and compiled code can call it
+        return apply(self, args)
 
 
 def vseval(exp, env):
     # properly tail recursive
     while True:
-        if is_self_evaluating(exp):
-            return exp
-        if isinstance(exp, str):
-            # exp must be a variable at this point
+        if type(exp) is Symbol:
+            if exp is TRUE or exp is FALSE:
+                return exp
             return env.lookup(exp)
+        if not isinstance(exp, COMPOUND):
+            # numbers and strings
+            return exp
 
         cmd, *args = exp
 
-        if cmd == 'quote':
+        if cmd is QUOTE:
             return text_of_quotation(exp, env)
-        if cmd == 'set!':
+        if cmd is SET:
             return env.assign(exp)
-        if cmd == 'define':
-            return env.define(to_lambda(exp))
-        if cmd == 'if':
+        if cmd is DEFINE:
+            return env.define(desugar(exp))
+        if cmd is IF:
             test, yes, no = args
-            exp = yes if vseval(test, env) != 'false' else no
+            exp = yes if vseval(test, env) is not FALSE else no
             continue
-        if cmd == 'lambda':
-            params, *body = args
-            # attach 'begin' if body contains multiple actions
-            body = body[0] if len(body) == 1 else ['begin'] + body
-            return compound_procedure(params, body, env)
-        if cmd == 'begin':
+        if cmd is LAMBDA:
+            params, body, layout = desugar(exp)
+            return compound_procedure(params, body, env, layout)
+        if cmd is BEGIN:
             *actions, exp = args
             for act in actions:
                 vseval(act, env)
             continue
+        if type(cmd) is Symbol and cmd in DERIVED:
+            exp = desugar(exp)
+            continue
         # And it's a procedure application
         proc = vseval(cmd, env)
         args = [vseval(arg, env) for arg in args]
 
         if isinstance(proc, compound_procedure):
-            env = proc.env.extend(proc.params, args)
+            env = extend_frame(proc.layout, args, proc.env)
             exp = proc.body
             continue
+        if len(args) == 2:
+            entry = BINARY.get(id(proc))
+            if entry is not None and entry[0] is proc:
+                return entry[1](args[0], args[1])
         return proc(*args)
 
 
 def is_self_evaluating(exp):
     """number, string, booleans
     """
-    return \
-        isinstance(exp, int) or isinstance(exp, float) \
-        or (isinstance(exp, str) and len(exp) >= 2 and exp[0] == '"' and exp[-1] == '"') \
-        or exp == 'true' or exp == 'false'
+    if type(exp) is Symbol:
+        return exp is TRUE or exp is FALSE
+    return not isinstance(exp, COMPOUND)
 
 
 def text_of_quotation(exp, env):
     """ '(1 a) => (list '1 'a) and evaluate
     """
     _, text = exp
-    if isinstance(text, list):
-        return vseval(["list"] + [['quote', x] for x in text], env)
+    if isinstance(text, COMPOUND):
+        return vseval([LIST] + [[QUOTE, x] for x in text], env)
     return text
 
 
 def to_lambda(exp):
     "(define (foo x) ...) => (define foo (lambda (x) ...))"
     _, var, *body = exp
-    if isinstance(var, list):
+    if isinstance(var, COMPOUND):
         name, *params = var
-        return ['define', name, ['lambda', params] + body]
+        return [DEFINE, name, [LAMBDA, params] + body]
     return exp
 
 
-class Env:
-
-    def __init__(self, frame={}):
-        self.frame = frame
-        # Upper Env, not upper frame
-        self.upper = None
-
-    def lookup(self, var):
-        try:
-            return self.frame[var]
-        except KeyError:
-            upper_env = self.upper
-            if upper_env == None:
-                raise UnboundVar(var)
-            return upper_env.lookup(var)
+def desugar_lambda(exp):
+    "(lambda params body...) => params, body, layout"
+    _, params, *body = exp
+    # attach 'begin' if body contains multiple actions
+    body = body[0] if len(body) == 1 else [BEGIN] + body
+    return params, body, make_layout(params, body)
+
+
+def let_to_combination(exp):
+    "(let ((v e) ...) body...) => ((lambda (v ...) body...) e ...)"
+    _, bindings, *body = exp
+    params = [var for var, _ in bindings]
+    return [[LAMBDA, params] + body] + [val for _, val in bindings]
+
+
+def cond_to_if(exp):
+    "(cond (p e...) ... (else e...)) => (if p (begin e...) (cond ...))"
+    _, *clauses = exp
+    if not clauses:
+        return FALSE
+    (test, *actions), *rest = clauses
+    if test is ELSE:
+        if rest:
+            raise LispException("else clause isn't last: %s" % (exp,))
+        return sequence_exp(actions)
+    if not actions:
+        # (cond (p) ...) is the value of p when it is true
+        return [OR, test, [COND] + rest]
+    return [IF, test, sequence_exp(actions), [COND] + rest]
+
+
+def and_to_if(exp):
+    "(and p q...) => (if p (and q...) false)"
+    _, *exps = exp
+    if not exps:
+        return TRUE
+    if len(exps) == 1:
+        return exps[0]
+    return [IF, exps[0], [AND] + exps[1:], FALSE]
+
+
+def or_to_if(exp):
+    "(or p q...) => ((lambda (v) (if v v (or q...))) p), p evaluated once"
+    _, *exps = exp
+    if not exps:
+        return FALSE
+    if len(exps) == 1:
+        return exps[0]
+    return [[LAMBDA, [OR_VALUE], [IF, OR_VALUE, OR_VALUE, [OR] + exps[1:]]],
+            exps[0]]
+
+
+def sequence_exp(exps):
+    return exps[0] if len(exps) == 1 else [BEGIN] + exps
+
+
+DERIVED = {LET: let_to_combination, COND: cond_to_if,
+           AND: and_to_if, OR: or_to_if}
+REWRITES = dict(DERIVED, **{DEFINE: to_lambda, LAMBDA: desugar_lambda})
+
+# rewritten expressions by id of the source node, the node is kept in
+# the entry so that its id can't be reused by another object. Source
+# nodes are lists and tuples, which can't be weakly referenced, so the
+# table is bounded instead: the least recently used entries are dropped,
+# and their nodes rewritten again if they are evaluated later.
+DESUGARED = OrderedDict()
+DESUGARED_MAXSIZE = 4096
+
+
+def desugar(exp):
+    """Rewrites a define, lambda or derived expression once per source
+    node, evaluating the same node again reuses the cached result.
+    """
+    key = id(exp)
+    entry = DESUGARED.get(key)
+    if entry is not None and entry[0] is exp:
+        DESUGARED.move_to_end(key)
+        return entry[1]
+    result = REWRITES[exp[0]](exp)
+    DESUGARED[key] = (exp, result)
+    while len(DESUGARED) > DESUGARED_MAXSIZE:
+        DESUGARED.popitem(last=False)
+    return result
+
+
+class BaseEnv:
+    "Operations shared by Env and Frame"
+    __slots__ = ()
 
     def assign(self, exp):
         _, var, valexp = exp
         # evaluate the value expression first before the assignment
-        val = vseval(valexp, self)
-
-        def env_loop(env):
-            try:
-                env.frame[var]
-            except KeyError:
-                upper_env = env.upper
-                if upper_env == None:
-                    raise UnboundVar(var)
-                env_loop(upper_env)
-            # var exists at this point
-            else:
-                env.frame[var] = val
-        env_loop(self)
+        self.set_variable_value(var, vseval(valexp, self))
 
     def define(self, exp):
         _, var, val = exp
-        self.frame[var] = vseval(val, self)
+        self.define_variable(var, vseval(val, self))
 
     def extend(self, params, args):
-        newframe = {}
-        for p, a in zip(params, args):
-            newframe[p] = a
-        newenv = Env(newframe)
-        newenv.upper = self
-        return newenv
+        layout = {p: i for i, p in enumerate(params)}
+        return extend_frame(layout, list(args), self)
+
+
+class Env(BaseEnv):
+    "Dict-backed environment, the global one and its children"
+    __slots__ = ('frame', 'upper', 'top')
+
+    def __init__(self, frame=None):
+        # a default {} would be shared by every Env(), GLOBAL_ENV included
+        self.frame = {} if frame is None else frame
+        # Upper Env, not upper frame
+        self.upper = None
+        # Frames built on top of this Env look up free variables here
+        self.top = self
+
+    def lookup(self, var):
+        env = self
+        while isinstance(env, Env):
+            frame = env.frame
+            if var in frame:
+                return frame[var]
+            env = env.upper
+        if env is None:
+            raise UnboundVar(var)
+        return env.lookup(var)
+
+    def set_variable_value(self, var, val):
+        env = self
+        while isinstance(env, Env):
+            frame = env.frame
+            if var in frame:
+                frame[var] = val
+                return
+            env = env.upper
+        if env is None:
+            raise UnboundVar(var)
+        env.set_variable_value(var, val)
+
+    def define_variable(self, var, val):
+        self.frame[var] = val
+
+
+# value of internal definitions not evaluated yet
+UNASSIGNED = object()
+
+
+class Frame(BaseEnv):
+    """Array-backed frame of a procedure call.
+
+    Variables are addressed by index, the names are kept in a layout
+    shared by every call of the same procedure. Free variables are
+    looked up in top, the dict-backed Env the frames are built on.
+    """
+    __slots__ = ('layout', 'values', 'upper', 'top')
+
+    def __init__(self, layout, values, upper):
+        self.layout = layout
+        self.values = values
+        self.upper = upper
+        self.top = upper.top
+
+    def lookup(self, var):
+        env = self
+        while isinstance(env, Frame):
+            i = env.layout.get(var)
+            if i is not None:
+                val = env.values[i]
+                if val is UNASSIGNED:
+                    raise UnboundVar(var)
+                return val
+            env = env.upper
+        return env.lookup(var)
+
+    def set_variable_value(self, var, val):
+        env = self
+        while isinstance(env, Frame):
+            i = env.layout.get(var)
+            if i is not None:
+                env.values[i] = val
+                return
+            env = env.upper
+        env.set_variable_value(var, val)
+
+    def define_variable(self, var, val):
+        i = self.layout.get(var)
+        if i is None:
+            # not scanned out by make_layout, the layout is shared
+            # by other calls so this frame gets its own copy
+            self.layout = dict(self.layout)
+            self.layout[var] = len(self.values)
+            self.values.append(val)
+        else:
+            self.values[i] = val
+
+
+def extend_frame(layout, args, env):
+    """Frame binding args in order, the rest of the slots in layout
+    are internal definitions not evaluated yet
+    """
+    missing = len(layout) - len(args)
+    if missing > 0:
+        args = args + [UNASSIGNED] * missing
+    return Frame(layout, args, env)
+
+
+def make_layout(params, body):
+    """Maps parameters and then names defined in body to frame indices.
+
+    Internal definitions are scanned out, SICP 4.1.6, so that each
+    of them gets its own slot in the frame.
+    """
+    layout = {p: i for i, p in enumerate(params)}
+
+    def scan(exp):
+        if not isinstance(exp, COMPOUND) or not exp:
+            return
+        cmd = exp[0]
+        if cmd is QUOTE or cmd is LAMBDA:
+            return
+        if type(cmd) is Symbol and cmd in DERIVED:
+            # a let body is a scope of its own
+            scan(desugar(exp))
+            return
+        if cmd is DEFINE:
+            _, var, val = desugar(exp)
+            if var not in layout:
+                layout[var] = len(layout)
+            scan(val)
+            return
+        for x in exp:
+            scan(x)
+    scan(body)
+    return layout
+
+
+def apply(proc, args):
+    "Calls a procedure from a primitive"
+    if isinstance(proc, compound_procedure):
+        return vseval(proc.body, extend_frame(proc.layout, list(args), proc.env))
+    return proc(*args)
 
 
 def setup_global_env():
     import operator
-    from functools import reduce
-
-    class cons(namedtuple('cons', 'car, cdr')):
-        __slots__ = ()
-
-        def __str__(self):
-            elts = [str(self.car)]
-            cdr = self.cdr
-
-            while isinstance(cdr, cons):
-                elts.append(str(cdr.car))
-                cdr = cdr.cdr
-            if cdr != []:
-                elts.append('.')
-                elts.append(str(cdr))
-            return '(' + ' '.join(elts) + ')'
-
-    def lisp_list(*args):
-        args = list(args)
-        result = []
-        while args:
-            result = cons(args.pop(), result)
-        return result
+    from functools import partial, reduce
+    from itertools import islice
+    from SICP.vanilla_scheme import lists, vectors
 
     def lisp_compare(xs, pred):
-        for x1, x2 in zip(xs, xs[1:]):
-            if not pred(x1, x2):
-                return 'false'
-        return 'true'
+        return TRUE if all(map(pred, xs, islice(xs, 1, None))) else FALSE
 
     frame = GLOBAL_ENV.frame
 
-    frame['+'] = lambda *xs: sum(xs)
-    frame['-'] = lambda *xs: reduce(lambda x, y: x - y, xs)
-    frame['*'] = lambda *xs: reduce(lambda x, y: x * y, xs)
-    frame['/'] = lambda *xs: reduce(lambda x, y: x / y, xs)
+    def primitive(name, variadic, binary):
+        "variadic is bound to name, evaluators call binary with two args"
+        frame[name] = variadic
+        BINARY[id(variadic)] = (variadic, binary)
+
+    def arithmetic(name, op):
+        primitive(name, lambda *xs: reduce(op, xs), op)
+
+    def comparison(name, pred):
+        primitive(name, lambda *xs: lisp_compare(xs, pred),
+                  lambda a, b: TRUE if pred(a, b) else FALSE)
+
+    primitive('+', lambda *xs: sum(xs), operator.add)
+    arithmetic('-', operator.sub)
+    arithmetic('*', operator.mul)
+    arithmetic('/', operator.truediv)
     frame['rem'] = lambda a, b: a % b
 
-    frame['null?'] = lambda x: 'true' if x == [] else 'false'
-    frame['cons'] = cons
-    frame['car'] = lambda x: x.car
-    frame['cdr'] = lambda x: x.cdr
-    frame['list'] = lisp_list
-
-    frame['not'] = lambda x: 'true' if x == 'false' else 'false'
-    frame['='] = lambda *xs: lisp_compare(xs, operator.eq)
-    frame['equal?'] = lambda *xs: lisp_compare(xs, operator.eq)
-    frame['<'] = lambda *xs: lisp_compare(xs, operator.lt)
-    frame['>'] = lambda *xs: lisp_compare(xs, operator.gt)
-    frame['<='] = lambda *xs: lisp_compare(xs, operator.le)
-    frame['>='] = lambda *xs: lisp_compare(xs, operator.ge)
-
-    frame['display'] = print
+    frame['null?'] = lambda x: TRUE if x == [] else FALSE
+    frame['pair?'] = lambda x: TRUE if isinstance(x, lists.Pair) else FALSE
+    frame['cons'] = lists.Pair
+    frame['car'] = operator.attrgetter('car')
+    frame['cdr'] = operator.attrgetter('cdr')
+    frame['list'] = lists.lisp_list
+    frame['length'] = lists.length
+    frame['append'] = lists.append
+    frame['reverse'] = lists.reverse
+    frame['list-ref'] = lists.list_ref
+    frame['map'] = partial(lists.lisp_map, apply)
+    frame['for-each'] = partial(lists.for_each, apply)
+    frame['list->vector'] = lists.list_to_vector
+    frame['vector->list'] = lists.vector_to_list
+
+    frame['not'] = lambda x: TRUE if x is FALSE else FALSE
+    comparison('=', operator.eq)
+    comparison('equal?', operator.eq)
+    comparison('<', operator.lt)
+    comparison('>', operator.gt)
+    comparison('<=', operator.le)
+    comparison('>=', operator.ge)
+
+    frame['vector'] = vectors.vector
+    frame['vector?'] = lambda x: TRUE if isinstance(x, vectors.Vector) else FALSE
+    frame['make-vector'] = vectors.make_vector
+    frame['vector-range'] = vectors.vector_range
+    frame['vector-length'] = vectors.vector_length
+    frame['vector-ref'] = vectors.vector_ref
+    frame['vector-set!'] = vectors.vector_set
+    frame['vector-slice'] = vectors.vector_slice
+    frame['vector-map'] = partial(vectors.vector_map, apply)
+    frame['vector-reduce'] = partial(vectors.vector_reduce, apply, {
+        frame['+']: vectors.sum_reducer, frame['*']: vectors.product_reducer})
+    frame['vector-sum'] = vectors.vector_sum
+    frame['v+'] = vectors.add
+    frame['v*'] = vectors.multiply
+
+    frame['display'] = lists.display
 
 
 GLOBAL_ENV = Env()